@@ -0,0 +1,220 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from util import SingleFlight
+
+ACROSS_SUGGESTED_FEES_URL = 'https://app.across.to/api/suggested-fees'
+#(连接, 读取)超时
+ACROSS_TIMEOUT = (2, 5)
+ACROSS_FEE_TTL = 10
+#金额取2位有效数字分桶, 同一个桶共用一次报价, 桶只用作缓存key, 请求across用实际金额
+ACROSS_AMOUNT_DIGITS = 2
+#超过这个时间across没返回, 先用本地模型的报价
+ACROSS_LATENCY_BUDGET = 1.5
+
+#本地费用模型: 按(路线, 金额数量级)记录across报价里的比例费用, EWMA平滑
+FEE_MODEL_ALPHA = Decimal('0.3')
+FEE_MODEL_MAX_AGE = 60*60
+#估算目标链gas成本用的fillRelay gas limit
+FEE_MODEL_FILL_GAS = 200000
+
+
+def get_fee_total(res_json, name):
+    fee = res_json.get(name)
+    if isinstance(fee, dict) and fee.get('total') is not None:
+        return int(fee['total'])
+    return None
+
+
+def scale_suggested_fees(res_json, quote_amount, amount):
+    '''
+        缓存的报价是quote_amount的, 换算到amount: 比例费用(lp+relayer资金费)按金额缩放, gas费用不变
+        费用是input token单位, outputAmount是output token单位, 两边精度可能不同, 按报价里的换算率换回去
+    '''
+    quote_amount, amount = int(quote_amount), int(amount)
+    if quote_amount == amount or not quote_amount:
+        return res_json
+    output_amount = int(res_json['outputAmount'])
+    total_fee = get_fee_total(res_json, 'totalRelayFee')
+    if total_fee is None:
+        total_fee = quote_amount - output_amount
+    gas_fee = get_fee_total(res_json, 'relayerGasFee') or 0
+    net_amount = quote_amount - total_fee
+    if net_amount <= 0:
+        return {'message': 'amount too low'}
+    fee = gas_fee + max(total_fee - gas_fee, 0) * amount // quote_amount
+    if amount <= fee:
+        return {'message': 'amount too low'}
+    res_json = dict(res_json)
+    res_json['outputAmount'] = str((amount - fee) * output_amount // net_amount)
+    res_json['totalRelayFee'] = dict(res_json.get('totalRelayFee') or {}, total=str(fee))
+    return res_json
+
+
+def get_bucket_amount(amount, digits=ACROSS_AMOUNT_DIGITS):
+    '''
+        123456 -> 120000, 向下取整, 只用作缓存key
+    '''
+    amount = int(amount)
+    scale = 10 ** max(len(str(amount)) - digits, 0)
+    return amount // scale * scale
+
+
+class AcrossFeeClient(object):
+    '''
+        across suggested-fees客户端, keep-alive连接池 + 短时缓存 + 相同请求合并
+        缓存key: (origin, dst, token_group, 金额桶), 缓存的报价连同报价金额一起存, 同桶的其他金额换算费用
+    '''
+    def __init__(self, ttl=ACROSS_FEE_TTL, timeout=ACROSS_TIMEOUT):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=20)
+        self.session.mount('https://', adapter)
+        self._cache = {}
+        self._single_flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    def fetch(self, params):
+        response = self.session.get(ACROSS_SUGGESTED_FEES_URL, params=params, timeout=self.timeout)
+        return response.json()
+
+    def get_cached(self, key):
+        '''
+            返回(报价, 报价金额)
+        '''
+        cached = self._cache.get(key)
+        if cached and cached[0] > time.time():
+            return cached[1]
+        return None
+
+    def prune(self):
+        now = time.time()
+        for key, cached in list(self._cache.items()):
+            if cached[0] <= now:
+                self._cache.pop(key, None)
+
+    def get_bucket_fees(self, key, params):
+        cached = self.get_cached(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        #同样的请求正在进行, 等它的结果
+        cached, is_leader = self._single_flight.do(key, lambda: self.fetch_and_cache(key, params),
+                                    timeout=sum(self.timeout) + 1)
+        if is_leader:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached
+
+    def fetch_and_cache(self, key, params):
+        cached = self.get_cached(key)
+        if cached is not None:
+            return cached
+        res_json = self.fetch(params)
+        cached = (res_json, params['amount'])
+        #只缓存成功的报价
+        if res_json.get('outputAmount'):
+            self._cache[key] = (time.time() + self.ttl, cached)
+            if len(self._cache) > 1000:
+                self.prune()
+        return cached
+
+    def get_suggested_fees(self, origin_chain_id, dst_chain_id, token_group, input_token, output_token,
+                                amount, recipient):
+        amount = int(amount)
+        key = (origin_chain_id, dst_chain_id, token_group, get_bucket_amount(amount))
+        params = {
+            "originChainId": origin_chain_id,
+            "inputToken": input_token,
+            "amount": amount,
+            "destinationChainId": dst_chain_id,
+            "outputToken": output_token,
+            'recipient': recipient,
+        }
+        res_json, quote_amount = self.get_bucket_fees(key, params)
+        if not res_json.get('outputAmount'):
+            return res_json
+        return scale_suggested_fees(res_json, quote_amount, amount)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cache_size': len(self._cache)}
+
+
+across_client = AcrossFeeClient()
+
+
+def get_amount_band(amount_human):
+    '''
+        金额数量级: 0.05 -> -2, 150 -> 2
+    '''
+    return Decimal(str(amount_human)).adjusted()
+
+
+class FeeModel(object):
+    '''
+        根据最近的across报价估算费用, 纯内存计算, across慢或者挂了时兜底
+        费用 = 金额 * 比例费用(按路线和金额数量级的EWMA) + 目标链gas成本
+        across的报价里已经包含gas, 记录时先减掉我们自己估的gas成本, 估算时再加回来
+    '''
+    def __init__(self, alpha=FEE_MODEL_ALPHA, max_age=FEE_MODEL_MAX_AGE):
+        self.alpha = alpha
+        self.max_age = max_age
+        self._bands = {}
+        self._min_deposits = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route, input_amount_human, output_amount_human, gas_cost_human=None, min_deposit=None):
+        '''
+            route: (origin_chain_id, dst_chain_id, token_group)
+        '''
+        input_amount_human = Decimal(str(input_amount_human))
+        if input_amount_human <= 0:
+            return None
+        fee_human = input_amount_human - Decimal(str(output_amount_human)) - (gas_cost_human or 0)
+        pct = max(fee_human, Decimal(0)) / input_amount_human
+        key = (route, get_amount_band(input_amount_human))
+        with self._lock:
+            old = self._bands.get(key)
+            if old and time.time() - old[1] <= self.max_age:
+                pct = old[0] + self.alpha * (pct - old[0])
+            self._bands[key] = (pct, time.time())
+            if min_deposit is not None:
+                self._min_deposits[route] = int(min_deposit)
+        return pct
+
+    def get_pct(self, route, band):
+        '''
+            没有这个数量级的数据时用同一路线最近的数量级
+        '''
+        now = time.time()
+        candidates = [(abs(k[1] - band), v[0]) for k, v in list(self._bands.items())
+                            if k[0] == route and now - v[1] <= self.max_age]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda x: x[0])[1]
+
+    def estimate(self, route, input_amount_human, gas_cost_human=None):
+        '''
+            返回估算的到账金额(human), 没有可用数据返回None
+        '''
+        input_amount_human = Decimal(str(input_amount_human))
+        pct = self.get_pct(route, get_amount_band(input_amount_human))
+        if pct is None:
+            return None
+        return input_amount_human * (1 - pct) - (gas_cost_human or 0)
+
+    def get_min_deposit(self, route):
+        return self._min_deposits.get(route)
+
+
+fee_model = FeeModel()
+#across请求放到线程里, 超过延迟预算先返回模型报价, 请求继续跑完更新缓存和模型
+across_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='across_fee')
@@ -0,0 +1,28 @@
+from local_util import get_decode_calldata
+
+
+def get_alchemy_deposit_logs(data):
+    '''
+        webhook payload里所有deposit日志, 同一笔交易只留一条
+        alchemy会把同一个区块的多笔deposit合并成一次推送
+    '''
+    log_dicts = {}
+    for log_dict in data['event']['data']['block']['logs']:
+        tx_hash = log_dict['transaction']['hash']
+        if tx_hash in log_dicts:
+            continue
+        if get_decode_calldata(log_dict['transaction']['inputData']).get('contract_type','') != 'contract_deposit':
+            continue
+        log_dicts[tx_hash] = log_dict
+    return list(log_dicts.values())
+
+def split_alchemy_payload(data):
+    '''
+        按deposit拆成只有一条日志的payload, webhook每笔deposit单独入队
+    '''
+    res = []
+    for log_dict in get_alchemy_deposit_logs(data):
+        block_dict = dict(data['event']['data']['block'], logs=[log_dict])
+        event_dict = dict(data['event'], data=dict(data['event']['data'], block=block_dict))
+        res.append(dict(data, event=event_dict))
+    return res
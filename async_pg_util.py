@@ -0,0 +1,140 @@
+import asyncio
+import random
+import time
+
+import asyncpg
+
+from pg_util import REPLICA_MAX_LAG, REPLICA_LAG_CHECK_INTERVAL, REPLICA_CONNECT_TIMEOUT, REPLICA_LAG_SQL
+
+#副本连不上/连接断开/恢复冲突取消查询, 这些退回主库重试一次
+REPLICA_READ_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError,
+                        asyncpg.InterfaceError, asyncpg.QueryCanceledError)
+
+
+class AsyncReplicaPool(object):
+    '''
+        一个只读副本的asyncpg连接池, 定期查复制延迟, 和pg_util.ReplicaPool一样的规则
+    '''
+    def __init__(self, conn_kwargs, max_lag=REPLICA_MAX_LAG, max_size=50):
+        self.host = conn_kwargs['host']
+        self.conn_kwargs = conn_kwargs
+        self.max_lag = max_lag
+        self.max_size = max_size
+        self._pool = None
+        self._pool_lock = None
+        self.lag = None
+        self.checked = 0
+        self._checking = False
+
+    async def get_pool(self):
+        #min_size=0, 副本连不上不影响启动
+        if self._pool is None:
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(min_size=0, max_size=self.max_size,
+                                        **self.conn_kwargs)
+        return self._pool
+
+    async def check_lag(self):
+        pool = await self.get_pool()
+        return float(await pool.fetchval(REPLICA_LAG_SQL))
+
+    async def is_healthy(self):
+        if time.time() - self.checked > REPLICA_LAG_CHECK_INTERVAL and not self._checking:
+            self._checking = True
+            try:
+                self.lag = await self.check_lag()
+            except Exception as e:
+                print(f"⚠️ replica {self.host} 检查延迟失败: {e}")
+                self.lag = None
+            finally:
+                self.checked = time.time()
+                self._checking = False
+        return self.lag is not None and self.lag <= self.max_lag
+
+    def mark_unhealthy(self, error):
+        print(f"⚠️ replica {self.host} 读失败, 退回主库: {error}")
+        self.lag = None
+        self.checked = time.time()
+
+    async def close(self):
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await pool.close()
+
+
+class AsyncPostgresql(object):
+    '''
+        asyncpg连接池, 给FastAPI的async接口用, 和pg_util.Postgresql并存
+        sql用$1,$2...占位, asyncpg每个连接自动缓存prepared statement
+        连接池第一次用到时在当前事件循环里创建
+        读默认走延迟在范围内的副本, 副本出错退回主库; 写和primary=True的读走主库
+    '''
+    def __init__(self,host,db,user,pwd,port=5432,min_size=1,max_size=50,replica_hosts=None,
+                    max_replica_lag=REPLICA_MAX_LAG):
+        self._conn_kwargs = {
+            'host': host,
+            'database': db,
+            'user': user,
+            'password': pwd,
+            'port': port,
+        }
+        self.min_size = min_size
+        self.max_size = max_size
+        self._pool = None
+        self._pool_lock = None
+        self._replicas = [AsyncReplicaPool(dict(self._conn_kwargs, host=i, timeout=REPLICA_CONNECT_TIMEOUT),
+                                max_lag=max_replica_lag, max_size=max_size) for i in replica_hosts or []]
+
+    async def get_pool(self):
+        if self._pool is None:
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(min_size=self.min_size, max_size=self.max_size,
+                                        **self._conn_kwargs)
+        return self._pool
+
+    async def get_read_replica(self, primary=False):
+        if primary or not self._replicas:
+            return None
+        replicas = [i for i in self._replicas if await i.is_healthy()]
+        if not replicas:
+            return None
+        return random.choice(replicas)
+
+    async def read(self, method, sql, *args, primary=False):
+        '''
+            method: asyncpg pool的fetch/fetchrow, 副本出错时标记不可用, 在主库上重试一次
+        '''
+        replica = await self.get_read_replica(primary=primary)
+        if replica is not None:
+            try:
+                pool = await replica.get_pool()
+                return await getattr(pool, method)(sql, *args)
+            except REPLICA_READ_ERRORS as e:
+                replica.mark_unhealthy(e)
+        pool = await self.get_pool()
+        return await getattr(pool, method)(sql, *args)
+
+    async def close(self):
+        for replica in self._replicas:
+            await replica.close()
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def query(self, sql, *args, primary=False):
+        rows = await self.read('fetch', sql, *args, primary=primary)
+        return [dict(i) for i in rows]
+
+    async def query_one(self, sql, *args, primary=False):
+        row = await self.read('fetchrow', sql, *args, primary=primary)
+        return dict(row) if row else None
+
+    async def execute(self, sql, *args):
+        pool = await self.get_pool()
+        return await pool.execute(sql, *args)
@@ -0,0 +1,35 @@
+import os
+import time
+import socket
+import argparse
+from typing import Dict, Any
+
+from web3_call import call_fill_relay_by_alchemy
+from local_util import pg_obj
+from queue_util import JobWorker
+from registry_util import start_registry_listener
+
+def process_fill_relay(data: Dict[str, Any]):
+    """处理webhook写入队列的fillRelay任务, 抛异常会重试, 整个流程读主库"""
+    with pg_obj.use_primary():
+        res = call_fill_relay_by_alchemy(data)
+    for deposit_hash, tx_hash in res.items():
+        print('time: ', time.time(), 'tx_hash: ', tx_hash, 'depositHash: ', deposit_hash)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--name', type=str, default=None)
+    args = parser.parse_args()
+    start_registry_listener()
+    workers = []
+    name = args.name or f'{socket.gethostname()}-{os.getpid()}'
+    for i in range(args.workers):
+        worker = JobWorker(process_fill_relay, consumer=f'{name}-{i}')
+        worker.start()
+        workers.append(worker)
+    while True:
+        time.sleep(60)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import time
+import argparse
+
+from data_util import get_chains
+from gas_oracle_util import GasOracle
+from registry_util import start_registry_listener
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chain_id', type=int, nargs='*')
+    parser.add_argument('--is_mainnet', type=int, default=None)
+    parser.add_argument('--poll_interval', type=str, default='1')
+    args = parser.parse_args()
+    start_registry_listener()
+    is_mainnet = None if args.is_mainnet is None else bool(args.is_mainnet)
+    oracles = {}
+    while True:
+        #新加的链自动起oracle, 注册表里没有了的停掉
+        chain_dicts = get_chains(is_mainnet=is_mainnet)
+        if args.chain_id:
+            chain_dicts = [i for i in chain_dicts if i['chain_id'] in args.chain_id]
+        for chain_dict in chain_dicts:
+            chain_id = chain_dict['chain_id']
+            if chain_id not in oracles or not oracles[chain_id].is_alive():
+                print(f"gas oracle start: {chain_id} {chain_dict['chain_name']}")
+                oracles[chain_id] = GasOracle(chain_id, is_eip1559=chain_dict['is_eip1559'],
+                                        poll_interval=float(args.poll_interval))
+                oracles[chain_id].start()
+        #停用/删除的链停掉oracle
+        chain_ids = {i['chain_id'] for i in chain_dicts}
+        for chain_id in list(oracles):
+            if chain_id not in chain_ids:
+                print(f"gas oracle stop: {chain_id}")
+                oracles.pop(chain_id).stop()
+        time.sleep(60)
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,40 @@
 import time
-from web3_call import call_fill_relay_by_etherscan
+import asyncio
+from web3_call import call_fill_relay_by_etherscan,call_fill_relay_by_txlist
+from indexer_util import DepositIndexer,INDEXER_CONFIRMATIONS,WATCHER_MAX_CONCURRENCY,watch_chains
+from registry_util import start_registry_listener
 import argparse
 
 def main():
     parser = argparse.ArgumentParser()
+    #不传chain_id时一个进程扫所有active链
     parser.add_argument('--chain_id', type=int)
+    parser.add_argument('--is_mainnet', type=int, default=None)
+    parser.add_argument('--max_concurrency', type=int, default=WATCHER_MAX_CONCURRENCY)
     parser.add_argument('--limit', type=int, default=1)
     parser.add_argument('--time_sleep', type=str, default='0.5')
+    #logs: eth_getLogs增量索引, etherscan: 原来的txlist轮询, 节点不可用时备用
+    parser.add_argument('--source', type=str, default='logs', choices=['logs', 'etherscan'])
+    parser.add_argument('--confirmations', type=int, default=INDEXER_CONFIRMATIONS)
     args = parser.parse_args()
+    start_registry_listener()
+    if args.source == 'logs' and not args.chain_id:
+        is_mainnet = None if args.is_mainnet is None else bool(args.is_mainnet)
+        asyncio.run(watch_chains(call_fill_relay_by_txlist, is_mainnet=is_mainnet,
+                                max_concurrency=args.max_concurrency, confirmations=args.confirmations))
+        return
+    if args.source == 'logs':
+        indexer = DepositIndexer(args.chain_id, confirmations=args.confirmations)
+        indexer.run(call_fill_relay_by_txlist, time_sleep=float(args.time_sleep))
+        return
     while True:
         print(f"call_fill_relay_by_etherscan time: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-        call_fill_relay_by_etherscan(chain_id=args.chain_id,limit=args.limit)
+        #失败的deposit还在最新的txlist里, 下一轮重新fill
+        try:
+            call_fill_relay_by_etherscan(chain_id=args.chain_id,limit=args.limit)
+        except Exception as e:
+            print(f"⚠️ call_fill_relay_by_etherscan error: {e}")
         time.sleep(float(args.time_sleep))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,23 +1,17 @@
-import time
+import argparse
 
-from data_util import get_currency_prices,set_tmp_price,get_tmp_price
+from price_util import PriceFeed,PRICE_CURRENCIES,PRICE_POLL_INTERVAL
 
 def main():
-    while True:
-        currency_list = ['BTC','ETH','POL','BNB']
-        res_prices = {}
-        try:
-            res_prices = get_currency_prices(currency_list,exchange=None)
-        except Exception as e:
-            print(time.strftime('%Y-%m-%d %H:%M:%S'))
-            print(f"error: {e}")
-            continue
-        print(time.strftime('%Y-%m-%d %H:%M:%S'))
-        for currency,price in res_prices.items():
-            print(f"set {currency} price: {price}")
-            set_tmp_price(currency,price)
-        time.sleep(30)
-        print(f"sleep 30 seconds")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--currency', type=str, nargs='*', default=PRICE_CURRENCIES)
+    #0: 不用websocket, 只REST轮询
+    parser.add_argument('--use_ws', type=int, default=1)
+    parser.add_argument('--poll_interval', type=str, default=str(PRICE_POLL_INTERVAL))
+    args = parser.parse_args()
+    #ws订阅ticker, 价格写到redis, 给没有起price feed的进程用
+    PriceFeed(currency_list=args.currency, poll_interval=float(args.poll_interval),
+                use_ws=bool(args.use_ws)).run()
 
 if __name__ == '__main__':
-    main()  
\ No newline at end of file
+    main()
@@ -0,0 +1,31 @@
+import time
+import argparse
+
+from data_util import get_chains
+from receipt_util import ReceiptTracker
+from registry_util import start_registry_listener
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chain_id', type=int, nargs='*')
+    parser.add_argument('--is_mainnet', type=int, default=None)
+    parser.add_argument('--poll_interval', type=str, default='1')
+    args = parser.parse_args()
+    start_registry_listener()
+    is_mainnet = None if args.is_mainnet is None else bool(args.is_mainnet)
+    trackers = {}
+    while True:
+        #新加的链自动起tracker
+        chain_dicts = get_chains(is_mainnet=is_mainnet)
+        if args.chain_id:
+            chain_dicts = [i for i in chain_dicts if i['chain_id'] in args.chain_id]
+        for chain_dict in chain_dicts:
+            chain_id = chain_dict['chain_id']
+            if chain_id not in trackers or not trackers[chain_id].is_alive():
+                print(f"receipt tracker start: {chain_id} {chain_dict['chain_name']}")
+                trackers[chain_id] = ReceiptTracker(chain_id, poll_interval=float(args.poll_interval))
+                trackers[chain_id].start()
+        time.sleep(60)
+
+if __name__ == '__main__':
+    main()
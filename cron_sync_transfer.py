@@ -0,0 +1,23 @@
+import time
+import argparse
+from datetime import timedelta
+
+from data_util import backfill_transfers,repair_transfers,get_db_now
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start_id', type=int, default=0)
+    parser.add_argument('--batch_size', type=int, default=500)
+    parser.add_argument('--once', action='store_true')
+    #定期重算这段时间内写入/状态变过的txline, 往前多算overlap秒, 覆盖还没提交的事务
+    parser.add_argument('--overlap', type=int, default=60)
+    parser.add_argument('--time_sleep', type=int, default=600)
+    args = parser.parse_args()
+    since = get_db_now()
+    backfill_transfers(start_id=args.start_id, batch_size=args.batch_size)
+    while not args.once:
+        time.sleep(args.time_sleep)
+        since = repair_transfers(since - timedelta(seconds=args.overlap), batch_size=args.batch_size)
+
+if __name__ == '__main__':
+    main()
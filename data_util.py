@@ -1,31 +1,54 @@
-import random
+import threading
 import time
-import requests
 from decimal import Decimal
 
 from eth_utils import to_checksum_address,add_0x_prefix
 
-from util import func_left_join,to_tztime
+from util import to_tztime
 from local_util import get_web3_human_amount,get_decode_calldata,get_web3_wei_amount,\
-    pg_obj,str_to_int,get_tx_url,get_tmp_key,set_tmp_key,get_valid_evm_address
+    pg_obj,apg_obj,str_to_int,get_tx_url,get_tmp_key,set_tmp_key,set_tmp_keys,get_valid_evm_address,\
+    get_method_id
 
+from registry_util import chain_registry
+from etherscan_util import etherscan_pool
+from across_util import across_client,across_executor,fee_model,ACROSS_LATENCY_BUDGET,FEE_MODEL_FILL_GAS
+from gas_oracle_util import get_gas_state
 from my_ccxt import MyCcxt
 
-from my_conf import ETHERSCAN_API_KEYS,NOT_EIP1599_IDS,L1_CHAIN_IDS,\
-    VAULT,ACROSS_ETH_MAP,MAX_AMOUNT_HUMAN_ETH,MAX_AMOUNT_HUMAN_USDT
+from my_conf import VAULT,ACROSS_ETH_MAP,MAX_AMOUNT_HUMAN_ETH,MAX_AMOUNT_HUMAN_USDT
+
+#cron_get_prices每30秒刷新, 过期后get_price回退到实时请求
+PRICE_EX = 60*2
+
+#热点查询用prepared statement, 每个连接只解析/规划一次
+if pg_obj:
+    pg_obj.prepare('txline_by_hash', 'select * from txline where tx_hash = $1', 1)
+    pg_obj.prepare('refer_by_account', 'select * from refer where account_address = $1', 1)
+
+_exchange = None
+_exchange_lock = threading.Lock()
 
 
 def get_etherscan_apikey():
-    return random.choice(ETHERSCAN_API_KEYS)
+    '''
+        从key池里取一个有额度的key, 直接请求etherscan用etherscan_pool.get
+    '''
+    return etherscan_pool.acquire().api_key
 
 def get_refer(account_address):
     account_address = get_valid_evm_address(account_address)
     if not account_address:
         return None
-    sql = f"select * from refer where account_address='{account_address}'"
-    res = pg_obj.query(sql)
+    res = pg_obj.query_prepared('refer_by_account', (account_address,))
     return res[0]['refer_code'] if res else None
 
+async def async_get_refer(account_address):
+    account_address = get_valid_evm_address(account_address)
+    if not account_address:
+        return None
+    res = await apg_obj.query_one("select refer_code from refer where account_address = $1", account_address)
+    return res['refer_code'] if res else None
+
 def check_create_refer(create_dict):
     refer_code = get_valid_evm_address(create_dict['refer_code'])
     account_address = get_valid_evm_address(create_dict['account_address'])
@@ -33,8 +56,7 @@ def check_create_refer(create_dict):
         return False
     if refer_code == account_address:
         return False
-    sql = f"select * from refer where account_address='{account_address}'"
-    res = pg_obj.query(sql)
+    res = pg_obj.query_prepared('refer_by_account', (account_address,), primary=True)
     if res:
         return False
     res = pg_obj.insert('refer',{'refer_code':refer_code,'account_address':account_address})
@@ -54,138 +76,105 @@ def update_refer(account_address,refer_code):
     # if res_txl:
     #     return False
     #无下级
-    sql_refer_child = f"select id from refer where refer_code='{account_address}' limit 1"
-    res_refer_child = pg_obj.query(sql_refer_child)
+    sql_refer_child = "select id from refer where refer_code=%s limit 1"
+    res_refer_child = pg_obj.query(sql_refer_child, (account_address,), primary=True, as_tuple=True)
     if res_refer_child:
         return False
-    res = pg_obj.update('refer',{'refer_code':refer_code},condition=f"account_address='{account_address}'")
+    res = pg_obj.update('refer',{'refer_code':refer_code},condition="account_address=%s",params=(account_address,))
     return res
 
 def get_chain(chain_id=None,alchemy_network=None):
-    res = None
-    sql = ''
-    if chain_id:
-        sql = f'select * from chain where chain_id = {chain_id}'
-    if alchemy_network:
-        sql = f"select * from chain where alchemy_network = '{alchemy_network}'"
-    if not sql:
-        return res
-    chain_dicts = pg_obj.query(sql)
-    chain_dicts = [i for i in chain_dicts if i['is_active']]
-    [i.update({'chain_db_id': i['id']}) for i in chain_dicts]
-    [i.update({'is_eip1559': i['chain_id'] not in NOT_EIP1599_IDS}) for i in chain_dicts]
-    [i.update({'is_l2': i['chain_id'] not in L1_CHAIN_IDS}) for i in chain_dicts]
-    if chain_dicts:
-        res = chain_dicts[0]
-    return res
+    return chain_registry.get_chain(chain_id=chain_id,alchemy_network=alchemy_network)
 
 def get_chains(chain_ids=None,is_mainnet=None):
     '''
         is_mainnet: None 所有网络, True 主网, False 测试网
     '''
-    res = None
-    sql = 'select * from chain'
-    if is_mainnet is not None:
-        sql = f'select * from chain where is_mainnet = {is_mainnet}'
-    if chain_ids:
-        sql = f'select * from chain where id in ({','.join(map(str,chain_ids))})'
-    chain_dicts = pg_obj.query(sql)
-    chain_dicts = [i for i in chain_dicts if i['is_active']]
-    [i.update({'chain_db_id': i['id']}) for i in chain_dicts]
-    [i.update({'is_eip1559': i['chain_id'] not in NOT_EIP1599_IDS}) for i in chain_dicts]
-    [i.update({'is_l2': i['chain_id'] not in L1_CHAIN_IDS}) for i in chain_dicts]
-    res = chain_dicts
-    return res
+    return chain_registry.get_chains(chain_ids=chain_ids,is_mainnet=is_mainnet)
 
 def get_token(chain_id=None,token_symbol=None,token_address=None,token_group=None):
-    res = {}
-    if not chain_id:
-        return res
-    chain_dict = get_chain(chain_id=chain_id)
-    chain_db_id = chain_dict['chain_db_id']
-    if token_symbol:
-        token_symbol = token_symbol.upper()
-    if token_address:
-        token_address = to_checksum_address(token_address)
-    sql = ''
-    if token_group:
-        sql = f"select * from token where token_group = '{token_group}' and chain_db_id = {chain_db_id}"
-    if token_symbol:
-        sql = f"select * from token where token_symbol = '{token_symbol}' and chain_db_id = {chain_db_id}"
-    if token_address:
-        sql = f"select * from token where token_address = '{token_address}' and chain_db_id = {chain_db_id}"
-    if not sql:
-        return res
-    token_dicts = pg_obj.query(sql)
-    token_dicts = [i for i in token_dicts if i['is_active']]
-    [i.update({'token_db_id': i['id']}) for i in token_dicts]
-    if token_dicts:
-        res_dicts = func_left_join(token_dicts,[chain_dict],['chain_db_id'])
-        if res_dicts:
-            res = res_dicts[0]
-    return res
+    return chain_registry.get_token(chain_id=chain_id,token_symbol=token_symbol,
+                token_address=token_address,token_group=token_group)
+
+async def async_load_registry():
+    '''
+        chain/token查询都走内存, 只有还没加载时要查库, 用asyncpg查, 不阻塞事件循环
+    '''
+    if not chain_registry.loaded:
+        chain_rows = await apg_obj.query('select * from chain', primary=True)
+        token_rows = await apg_obj.query('select * from token', primary=True)
+        chain_registry.set_rows(chain_rows, token_rows)
+
+async def async_get_token(chain_id=None,token_symbol=None,token_address=None,token_group=None):
+    await async_load_registry()
+    return get_token(chain_id=chain_id,token_symbol=token_symbol,token_address=token_address,
+                token_group=token_group)
 
 def get_tokens(token_symbol=None,token_address=None,token_group=None):
-    res = {}
-    sql = 'select * from token'
-    if token_symbol:
-        token_symbol = token_symbol.upper()
-        sql = f"select * from token where token_symbol = '{token_symbol}'"
-    if token_address:
-        token_address = to_checksum_address(token_address)
-        sql = f"select * from token where token_address = '{token_address}'"
-    if token_group:
-        sql = f"select * from token where token_group = '{token_group}'"
-    # if not sql:
-    #     return res
-    token_dicts = pg_obj.query(sql)
-    token_dicts = [i for i in token_dicts if i['is_active']]
-    [i.update({'token_db_id': i['id']}) for i in token_dicts]
-    res = token_dicts
-    return res
+    return chain_registry.get_tokens(token_symbol=token_symbol,token_address=token_address,
+                token_group=token_group)
 
 def get_tokens_with_chains(token_symbol=None,token_address=None,token_group=None,is_mainnet=None):
-    res_tokens = get_tokens(token_symbol=token_symbol,token_address=token_address,token_group=token_group)
-    res_chains = get_chains(is_mainnet=is_mainnet)
-    res = func_left_join(res_tokens,res_chains,['chain_db_id'])
-    #有token，没关联上chain，过滤掉
-    res = [i for i in res if i.get('chain_name',None)]
-    return res
+    return chain_registry.get_tokens_with_chains(token_symbol=token_symbol,token_address=token_address,
+                token_group=token_group,is_mainnet=is_mainnet)
+
+def get_exchange():
+    '''
+        进程内复用一个binance实例, markets只加载一次
+    '''
+    global _exchange
+    if _exchange is None:
+        with _exchange_lock:
+            if _exchange is None:
+                exchange = MyCcxt(api_key='', secret='', ex_name='binance', proxies=None)
+                exchange.load_markets()
+                _exchange = exchange
+    return _exchange
 
 def get_currency_price(currency,exchange=None):
     if not exchange:
-        exchange = MyCcxt(api_key='', secret='', ex_name='binance', proxies=None)
+        exchange = get_exchange()
     res = exchange.fetch_symbol_last_price(currency=currency)
     return str(res)
 
 def get_currency_prices(currency_list,exchange=None):
+    '''
+        一次fetch_tickers取所有币的价格
+    '''
     if not exchange:
-        exchange = MyCcxt(api_key='', secret='', ex_name='binance', proxies=None)
-    res = {currency: str(get_currency_price(currency,exchange=exchange)) for currency in currency_list}
+        exchange = get_exchange()
+    res = exchange.fetch_currency_last_prices(currency_list)
+    res = {currency: str(price) for currency, price in res.items()}
     return res
 
-def set_tmp_price(currency,price):
-    res = set_tmp_key(f'{currency.lower()}:price',str(price))
+def set_tmp_price(currency,price,ex=PRICE_EX):
+    res = set_tmp_key(f'{currency.lower()}:price',str(price),ex=ex)
+    return res
+
+def set_tmp_prices(price_dict,ex=PRICE_EX):
+    '''
+        pipeline一次写入所有价格
+    '''
+    res = set_tmp_keys({f'{currency.lower()}:price': str(price) for currency, price in price_dict.items()},ex=ex)
     return res
 
 def get_tmp_price(currency):
     res = get_tmp_key(f'{currency.lower()}:price')
     return res
 
-def get_price(currency: str):
-    price = get_tmp_price(currency)
-    if not price:
-        price = get_currency_price(currency,exchange=None)
-        set_tmp_price(currency,price)
-    return price
+def get_price(currency: str, max_age=None):
+    '''
+        price_util进程内缓存, 过期时读redis, 再不行请求交易所(并发合并)
+    '''
+    from price_util import get_price_dict,PRICE_MAX_AGE
+    price_dict = get_price_dict(currency,max_age=PRICE_MAX_AGE if max_age is None else max_age)
+    return price_dict['price'] if price_dict else None
 
 def get_vault_address():
     return VAULT
 
 def get_token_set():
-    res_pg = pg_obj.query('select distinct token_group from token')
-    res = [i['token_group'] for i in res_pg]
-    return res
+    return chain_registry.get_token_groups()
 
 def get_chains_by_token_group(token_group):
     res_tokens = get_tokens(token_group=token_group)
@@ -193,70 +182,191 @@ def get_chains_by_token_group(token_group):
     res = get_chains(chain_ids=chain_db_ids)
     return res
 
+async def async_get_chains_by_token_group(token_group):
+    await async_load_registry()
+    return get_chains_by_token_group(token_group)
+
 def get_txl(tx_hash):
-    sql = f"select * from txline where tx_hash = '{tx_hash}'"
-    res = pg_obj.query(sql)
+    '''
+        fill流程写入前的判断, 读主库
+    '''
+    res = pg_obj.query_prepared('txline_by_hash', (tx_hash,), primary=True)
     return res[0] if res else {}
 
 def get_txls(addr):
-    sql_from = f"select * from txline where addr_from = '{addr}'"
-    res_from = pg_obj.query(sql_from)
-    sql_to = f"select * from txline where addr_to = '{addr}'"
-    res_to = pg_obj.query(sql_to)
+    res_from = pg_obj.query("select * from txline where addr_from = %s", (addr,))
+    res_to = pg_obj.query("select * from txline where addr_to = %s", (addr,))
     res = res_from + res_to
     return res
 
-def get_txls_pair(addr='',status=None, limit=50, offset=0):
-    res = []
-    sql_from = f'''
-        select txline.id as txl_related_id,num as num_from,chain.chain_id as chain_id_from,
-               token_id as token_db_id,addr_from,tx_hash as tx_hash_from,tx_time,status,txline.create_time as create_time,
+TRANSFER_COLUMNS = [
+    'txl_related_id','txl_fill_id','status','tx_time','create_time','token_db_id','token_group',
+    'addr_from','tx_hash_from','num_from','num_human_from','tx_url_from','decimals_from',
+    'chain_id_from','chain_alias_name_from','chain_logo_url_from','block_explorer_from','explorer_template_from',
+    'addr_to','tx_hash_to','num_to','num_human_to','tx_url_to','decimals_to',
+    'chain_id_to','chain_alias_name_to','chain_logo_url_to','block_explorer_to','explorer_template_to',
+]
+
+def get_transfer_pairs_sql(condition, params=()):
+    '''
+        从txline算transfer行的sql, condition是主单(f)的条件, 值用%s占位放在params里
+        主单是deposit, 子单按txl_related_id关联, 有多条时取最新的
+        返回 (sql, params)
+    '''
+    method_id_deposit = get_method_id("deposit(address,bytes32,address,uint256,uint256,bytes)")
+    sql = f'''
+        select f.id as txl_related_id,t.id as txl_fill_id,f.num as num_from,chain.chain_id as chain_id_from,
+               coalesce(t.token_id,f.token_id) as token_db_id,f.addr_from,f.tx_hash as tx_hash_from,
+               coalesce(f.tx_time,f.create_time) as tx_time,f.status,f.create_time as create_time,
                 chain.alias_name as chain_alias_name_from,chain.block_explorer as block_explorer_from,
                 chain.explorer_template as explorer_template_from,chain.chain_logo_url as chain_logo_url_from,
                 token.decimals as decimals_from,
-                token.token_group
-        from txline
-            left join chain on txline.chain_db_id = chain.id
-            left join token on txline.token_id = token.id
-        where addr_from= '{addr}'
-        {f'and status = {status}' if status!=None else ''}
-        order by txline.id DESC
-        limit {limit} OFFSET {offset}
-    '''
-    # print(f"sql_from: {sql_from}")
-    res_from = pg_obj.query(sql_from)
-    if not res_from:
-        return res
-    [i.update({
-        'num_human_from': str(get_web3_human_amount(i['num_from'],decimals=i['decimals_from'])),
-        'tx_url_from': get_tx_url(i["block_explorer_from"],i["tx_hash_from"],explorer_template=i["explorer_template_from"])
-        }) 
-        for i in res_from if i['num_from']]
-    txl_related_ids = [i['txl_related_id'] for i in res_from]
-    sql_to = f'''
-        select txl_related_id,num as num_to,chain.chain_id as chain_id_to,
-               token_id as token_db_id,addr_to,tx_hash as tx_hash_to,
-                chain.alias_name as chain_alias_name_to,chain.block_explorer as block_explorer_to,
-                chain.explorer_template as explorer_template_to,
-                chain.chain_logo_url as chain_logo_url_to,
-                token.decimals as decimals_to
-        from txline
-            left join chain on txline.chain_db_id = chain.id
-            left join token on txline.token_id = token.id
-        where 
-            addr_to= '{addr}' 
-            and txl_related_id in ({','.join(map(str,txl_related_ids))})
-    '''
-    res_to = pg_obj.query(sql_to)
-    [i.update({
-        'num_human_to': str(get_web3_human_amount(i['num_to'],decimals=i['decimals_to'])),
-        'tx_url_to': get_tx_url(i["block_explorer_to"],i["tx_hash_to"],explorer_template=i["explorer_template_to"])
-        }) 
-        for i in res_to if i['num_to']]
-    res = func_left_join(res_from,res_to,['txl_related_id'])
-    [i.update({'tx_time': i.get('tx_time') or i.get('create_time')}) for i in res]
-    res_sorted = sorted(res,key=lambda x: x['tx_time'],reverse=True)
-    return res_sorted
+                token.token_group,
+               t.num as num_to,chain_to.chain_id as chain_id_to,
+               t.addr_to,t.tx_hash as tx_hash_to,
+                chain_to.alias_name as chain_alias_name_to,chain_to.block_explorer as block_explorer_to,
+                chain_to.explorer_template as explorer_template_to,
+                chain_to.chain_logo_url as chain_logo_url_to,
+                token_to.decimals as decimals_to
+        from txline f
+            left join chain on f.chain_db_id = chain.id
+            left join token on f.token_id = token.id
+            left join lateral (
+                select * from txline
+                where txl_related_id = f.id
+                order by id DESC
+                limit 1
+            ) t on true
+            left join chain chain_to on t.chain_db_id = chain_to.id
+            left join token token_to on t.token_id = token_to.id
+        where f.calldata like %s and {condition}
+        order by f.id
+    '''
+    return sql, (method_id_deposit + '%',) + tuple(params)
+
+def get_transfer_pairs(condition, params=()):
+    sql, params = get_transfer_pairs_sql(condition, params)
+    return update_transfer_fields(pg_obj.query(sql, params, primary=True))
+
+def update_transfer_fields(res):
+    '''
+        补上human金额和浏览器链接
+    '''
+    for i in res:
+        if i['num_from']:
+            i.update({
+                'num_human_from': str(get_web3_human_amount(i['num_from'],decimals=i['decimals_from'])),
+                'tx_url_from': get_tx_url(i["block_explorer_from"],i["tx_hash_from"],explorer_template=i["explorer_template_from"])
+            })
+        if i['num_to']:
+            i.update({
+                'num_human_to': str(get_web3_human_amount(i['num_to'],decimals=i['decimals_to'])),
+                'tx_url_to': get_tx_url(i["block_explorer_to"],i["tx_hash_to"],explorer_template=i["explorer_template_to"])
+            })
+    return res
+
+def upsert_transfers(transfer_dicts):
+    update_time = to_tztime(time.time())
+    for transfer_dict in transfer_dicts:
+        transfer_dict = {k: transfer_dict.get(k) for k in TRANSFER_COLUMNS}
+        transfer_dict['update_time'] = update_time
+        pg_obj.upsert('transfer', transfer_dict, conflict='txl_related_id')
+    return len(transfer_dicts)
+
+def sync_transfers(txl_related_ids=None, tx_hashes=None):
+    '''
+        主单插入或者子单关联/状态变化后调用, 重算这些笔的transfer行
+        txl_related_ids: 主单的txline id, tx_hashes: 主单的tx_hash
+        transfer只是读优化, 失败不影响txline的写入, repair_transfers会补上
+    '''
+    txl_related_ids = [int(i) for i in txl_related_ids or []]
+    tx_hashes = list(tx_hashes or [])
+    if not txl_related_ids and not tx_hashes:
+        return 0
+    try:
+        return upsert_transfers(get_transfer_pairs("(f.id = any(%s) or f.tx_hash = any(%s))",
+                                    (txl_related_ids, tx_hashes)))
+    except Exception as e:
+        print(f"⚠️ sync_transfers失败: {txl_related_ids} {tx_hashes} {e}")
+        return None
+
+def sync_transfer(txl_related_id=None, tx_hash=None):
+    if txl_related_id is not None:
+        return sync_transfers(txl_related_ids=[txl_related_id])
+    return sync_transfers(tx_hashes=[tx_hash])
+
+def backfill_transfers(start_id=0, batch_size=500):
+    '''
+        重算id > start_id的所有transfer, 上线时全量回填, 之后定期跑修复漏掉的
+        服务端游标按batch_size分块读, 一次只占一块的内存
+        返回最后处理到的主单txline id
+    '''
+    last_id = int(start_id)
+    sql, params = get_transfer_pairs_sql("f.id > %s", (last_id,))
+    for res in pg_obj.iter_query(sql, params, chunk_size=batch_size, primary=True):
+        upsert_transfers(update_transfer_fields(res))
+        last_id = res[-1]['txl_related_id']
+        print(f"backfill_transfers: {res[0]['txl_related_id']}-{last_id} {len(res)}")
+    return last_id
+
+def get_db_now():
+    return pg_obj.query("select now()", primary=True, as_tuple=True)[0][0]
+
+def repair_transfers(since, batch_size=500):
+    '''
+        重算since之后写入(create_time)或状态变过(update_time)的txline对应的transfer, 补上同步失败的
+        子单按自己的写入时间找到主单, 晚到/后关联上的子单也能补上
+        返回这次开始时的数据库时间, 作为下次的since
+    '''
+    now = get_db_now()
+    sql, params = get_transfer_pairs_sql('''f.id in (
+                select coalesce(txl_related_id, id) from txline where create_time > %s or update_time > %s
+            )''', (since, since))
+    count = 0
+    for res in pg_obj.iter_query(sql, params, chunk_size=batch_size, primary=True):
+        upsert_transfers(update_transfer_fields(res))
+        count += len(res)
+    print(f"repair_transfers since {since}: {count}")
+    return now
+
+def get_txls_pair_sql(addr='',status=None, limit=50, offset=0, cursor=None, placeholder='%s'):
+    '''
+        get_txls_pair的sql和参数, psycopg2用%s占位, asyncpg用$n占位(placeholder='$')
+        cursor: 上一页最后一条的txl_related_id, 按(addr_from, txl_related_id)索引往后取
+        没有cursor时兼容offset
+    '''
+    params = []
+    def param(value):
+        params.append(value)
+        return placeholder if placeholder == '%s' else f'{placeholder}{len(params)}'
+    sql = f'''
+        select {','.join(TRANSFER_COLUMNS)}
+        from transfer
+        where addr_from= {param(addr)}
+        {f'and status = {param(int(status))}' if status!=None else ''}
+        {f'and txl_related_id < {param(int(cursor))}' if cursor else ''}
+        order by txl_related_id DESC
+        limit {param(int(limit))} {f'OFFSET {param(int(offset))}' if offset and not cursor else ''}
+    '''
+    return sql, params
+
+def get_txls_pair(addr='',status=None, limit=50, offset=0, cursor=None):
+    '''
+        读transfer表, 主单子单的配对和金额/链接在写入时已经算好
+    '''
+    sql, params = get_txls_pair_sql(addr=addr,status=status,limit=limit,offset=offset,cursor=cursor)
+    # print(f"sql: {sql}")
+    res = pg_obj.query(sql, params)
+    return res
+
+async def async_get_txls_pair(addr='',status=None, limit=50, offset=0, cursor=None):
+    '''
+        get_txls_pair的asyncpg版本, 参数和返回一样
+    '''
+    sql, params = get_txls_pair_sql(addr=addr,status=status,limit=limit,offset=offset,cursor=cursor,
+                        placeholder='$')
+    res = await apg_obj.query(sql, *params)
+    return res
 
 
 #for api
@@ -298,8 +408,13 @@ def api_get_token_groups():
     return res
 
 def api_get_chains_by_token_group(token_group):
+    return format_api_chains(get_chains_by_token_group(token_group))
+
+async def async_api_get_chains_by_token_group(token_group):
+    return format_api_chains(await async_get_chains_by_token_group(token_group))
+
+def format_api_chains(res_chains):
     res = []
-    res_chains = get_chains_by_token_group(token_group)
     if res_chains:
         res = [{
             'chain_id': i['chain_id'],
@@ -331,24 +446,22 @@ def get_suggested_fees(origin_chain_id,dst_chain_id,input_amount_human,token_gro
         max_amount_human = MAX_AMOUNT_HUMAN_USDT
     input_amount_wei = get_web3_wei_amount(input_amount_human,decimals=input_decimals)
     max_amount_wei = get_web3_wei_amount(max_amount_human,decimals=input_decimals)
-    url = "https://app.across.to/api/suggested-fees"
-    params = {
-        "originChainId": origin_chain_id,
-        "inputToken": input_token,
-        "amount": input_amount_wei,
-        "destinationChainId": dst_chain_id,
-        "outputToken": output_token,
-        'recipient': VAULT,
-    }
+    route = (origin_chain_id, dst_chain_id, token_group)
+    gas_cost_human = get_fill_gas_cost_human(dst_chain_id,token_group)
     res = {}
     res_json = {}
+    #across超过延迟预算或者失败, 用本地模型报价, across返回后照样更新缓存和模型
+    future = across_executor.submit(across_client.get_suggested_fees, origin_chain_id, dst_chain_id, token_group,
+                    input_token, output_token, input_amount_wei, VAULT)
+    future.add_done_callback(lambda f: observe_across_quote(f, route, input_amount_human,
+                    output_decimals, gas_cost_human))
     try:
-        response = requests.get(url, params=params)
-        res_json = response.json()
+        res_json = future.result(timeout=ACROSS_LATENCY_BUDGET)
         # print(f"res_json: {res_json}")
     except Exception as e:
-        print(f"Internal error: get_suggested_fees error: {e}")
-        return {}
+        print(f"Internal error: get_suggested_fees error: {e!r}, 使用本地模型")
+        return get_model_suggested_fees(route, input_amount_human, input_amount_wei, max_amount_wei,
+                    input_decimals, output_decimals, gas_cost_human)
     if res_json and res_json.get('outputAmount',None):
         output_amount = res_json.get('outputAmount',None)
         output_amount_human = get_web3_human_amount(int(output_amount),decimals=output_decimals)
@@ -370,6 +483,7 @@ def get_suggested_fees(origin_chain_id,dst_chain_id,input_amount_human,token_gro
             'min_amount': str(min_amount_wei),
             'max_amount': str(max_amount_wei),
             'message': '',
+            'source': 'across',
             # 'rate': str(Decimal(str(output_amount_human))/Decimal(str(input_amount_human))),
         }
     else:
@@ -378,47 +492,105 @@ def get_suggested_fees(origin_chain_id,dst_chain_id,input_amount_human,token_gro
         }
     return res
 
+def get_fill_gas_cost_human(dst_chain_id,token_group,gas_limit=FEE_MODEL_FILL_GAS):
+    '''
+        目标链fillRelay的gas成本, 换算成token数量, 没有gas oracle数据或者价格时返回None
+    '''
+    gas_state = get_gas_state(dst_chain_id)
+    chain_dict = get_chain(chain_id=dst_chain_id)
+    if not gas_state or not chain_dict:
+        return None
+    gas_cost_native = Decimal(gas_state['gas_price'] * gas_limit) / Decimal(10 ** int(chain_dict['native_token_decimals']))
+    native_token_name = (chain_dict['native_token_name'] or '').upper()
+    if native_token_name == token_group:
+        return gas_cost_native
+    native_price = get_tmp_price(native_token_name) if native_token_name else None
+    token_price = 1 if token_group in ['USDC','USDT'] else get_tmp_price(token_group)
+    if not native_price or not token_price:
+        return None
+    return gas_cost_native * Decimal(str(native_price)) / Decimal(str(token_price))
+
+def observe_across_quote(future,route,input_amount_human,output_decimals,gas_cost_human):
+    try:
+        res_json = future.result()
+        if res_json.get('outputAmount',None):
+            output_amount_human = get_web3_human_amount(int(res_json['outputAmount']),decimals=output_decimals)
+            fee_model.observe(route, input_amount_human, output_amount_human, gas_cost_human=gas_cost_human,
+                        min_deposit=res_json.get('limits',{}).get('minDeposit',None))
+    except Exception as e:
+        print(f"observe_across_quote error: {e!r}")
+
+def get_model_suggested_fees(route,input_amount_human,input_amount_wei,max_amount_wei,
+                                input_decimals,output_decimals,gas_cost_human):
+    '''
+        本地模型报价, source=model, 没有足够的报价数据返回{}
+    '''
+    output_amount_human = fee_model.estimate(route, input_amount_human, gas_cost_human=gas_cost_human)
+    if output_amount_human is None or output_amount_human <= 0:
+        return {}
+    min_amount_wei = fee_model.get_min_deposit(route)
+    if min_amount_wei and input_amount_wei<min_amount_wei:
+        min_amount_human = get_web3_human_amount(min_amount_wei,decimals=input_decimals)
+        return {'message': 'amount too low, min_amount: ' + str(min_amount_human), 'source': 'model'}
+    if input_amount_wei>max_amount_wei:
+        max_amount_human = get_web3_human_amount(max_amount_wei,decimals=input_decimals)
+        return {'message': 'amount too high, max_amount: ' + str(max_amount_human), 'source': 'model'}
+    output_amount = get_web3_wei_amount(output_amount_human,decimals=output_decimals)
+    output_amount_human = get_web3_human_amount(output_amount,decimals=output_decimals)
+    return {
+        'input_amount': str(input_amount_wei),
+        'input_amount_human': str(input_amount_human),
+        'output_amount': str(output_amount),
+        'output_amount_human': str(output_amount_human),
+        'min_amount': str(min_amount_wei or ''),
+        'max_amount': str(max_amount_wei),
+        'message': '',
+        'source': 'model',
+    }
 
 def get_etherscan_txs(chain_id='',limit=2,contract_type='contract_deposit'):
     res = []
-    api_key = get_etherscan_apikey()
     address = ''
     if contract_type == 'contract_deposit':
         address = to_checksum_address(get_chain(chain_id=chain_id).get('contract_deposit',''))
     if contract_type == 'contract_fillrelay':
         address = to_checksum_address(get_chain(chain_id=chain_id).get('contract_fillrelay',''))
     if address:
-        url = f'https://api.etherscan.io/v2/api?chainid={chain_id}&module=account&action=txlist&address={address}&page=1&offset={limit}&sort=desc&apikey={api_key}'
+        params = {'chainid': chain_id, 'module': 'account', 'action': 'txlist', 'address': address,
+                    'page': 1, 'offset': limit, 'sort': 'desc'}
         try:
-            response = requests.get(url)
-            res = response.json()['result']
+            res = etherscan_pool.get(params)['result']
         except Exception as e:
             print(f"get_etherscan_txs error: {e}")
-            time.sleep(2)
+            return []
+        #没有交易或者出错时result是字符串
+        if not isinstance(res, list):
+            print(f"get_etherscan_txs result: {res}")
             return []
     return res
 
 def get_etherscan_tx_by_hash(chain_id='',tx_hash=''):
-    api_key = get_etherscan_apikey()
-    url = f'https://api.etherscan.io/v2/api?chainid={chain_id}&module=proxy&action=eth_getTransactionByHash&txhash={tx_hash}&apikey={api_key}'
-    print(f"get_etherscan_tx_by_hash url: {url}")
-    response = requests.get(url)
-    res = response.json()['result']
+    params = {'chainid': chain_id, 'module': 'proxy', 'action': 'eth_getTransactionByHash', 'txhash': tx_hash}
+    print(f"get_etherscan_tx_by_hash: {chain_id} {tx_hash}")
+    res = etherscan_pool.get(params)['result']
     return res
     
 #eth_getTransactionReceipt    
 def get_etherscan_tx_receipt(chain_id='',tx_hash=''):
-    api_key = get_etherscan_apikey()
-    url = f'https://api.etherscan.io/v2/api?chainid={chain_id}&module=proxy&action=eth_getTransactionReceipt&txhash={tx_hash}&apikey={api_key}'
-    print(f"get_etherscan_tx_receipt url: {url}")
-    response = requests.get(url)
-    res = response.json()['result']
+    params = {'chainid': chain_id, 'module': 'proxy', 'action': 'eth_getTransactionReceipt', 'txhash': tx_hash}
+    print(f"get_etherscan_tx_receipt: {chain_id} {tx_hash}")
+    res = etherscan_pool.get(params)['result']
     return res
 
 def create_txl_webhook(tx_dict,calldata_dict):
 
     # print(f"tx_dict: {tx_dict}")
 
+    #重复推送/重试, 已经记录过的不再插入
+    txl_dict_search = get_txl(tx_hash=add_0x_prefix(tx_dict['hash']))
+    if txl_dict_search:
+        return None
+
     gas_price = str_to_int(tx_dict['effectiveGasPrice'])
     gas_used = tx_dict['gasUsed']
     tx_fee = gas_price*gas_used
@@ -456,6 +628,7 @@ def create_txl_webhook(tx_dict,calldata_dict):
             'eip_type': str_to_int(tx_dict['type']),
         })
     res = pg_obj.insert('txline',txl_dict)
+    sync_transfer(tx_hash=txl_dict['tx_hash'])
     return res
 
 def create_fill_txl_etherscan_by_hash(tx_hash,chain_id):
@@ -467,15 +640,24 @@ def create_fill_txl_etherscan_by_hash(tx_hash,chain_id):
             print(f"❌ tx_dict不存在: {tx_hash}")
             return None
     print('create_fill_txl_etherscan_by_hash tx_dict : ',tx_dict)
+    tx_receipt_dict = get_etherscan_tx_receipt(chain_id=chain_id,tx_hash=tx_hash)
+    return create_fill_txl(chain_id,tx_dict,tx_receipt_dict)
+
+def create_fill_txl(chain_id,tx_dict,tx_receipt_dict,txl_related_id=None,block_timestamp=None):
+    '''
+        tx_dict/tx_receipt_dict: eth_getTransactionByHash/eth_getTransactionReceipt的json-rpc结果
+        etherscan proxy接口和节点返回的格式一样, receipt_util直接用节点的batch结果
+    '''
     calldata_dict = get_decode_calldata(tx_dict['input'])
 
     chain_dict = get_chain(chain_id=chain_id)
     chain_db_id = chain_dict['chain_db_id']
     token_dict = get_token(chain_id=chain_id,token_address=calldata_dict['outputToken'])
     token_id = token_dict['token_db_id']
-    depositHash = add_0x_prefix(calldata_dict['depositHash'])
-    txl_related_dict = get_txl(tx_hash=depositHash)
-    txl_related_id = txl_related_dict['id']
+    if txl_related_id is None:
+        depositHash = add_0x_prefix(calldata_dict['depositHash'])
+        txl_related_dict = get_txl(tx_hash=depositHash)
+        txl_related_id = txl_related_dict['id']
 
     txl_dict = {
         'tx_hash': add_0x_prefix(tx_dict['hash']),
@@ -501,13 +683,12 @@ def create_fill_txl_etherscan_by_hash(tx_hash,chain_id):
         'estimate_gas_limit': str_to_int(tx_dict['gas']),
         # 'estimate_gas_price': '',
         'eip_type': str_to_int(tx_dict['type']),
-        'max_fee_per_gas': str_to_int(tx_dict['maxFeePerGas']),
-        'max_priority_fee_per_gas': str_to_int(tx_dict['maxPriorityFeePerGas']),
+        'max_fee_per_gas': str_to_int(tx_dict.get('maxFeePerGas')),
+        'max_priority_fee_per_gas': str_to_int(tx_dict.get('maxPriorityFeePerGas')),
         'calldata': calldata_dict['calldata'],
         'note': ''
     }
 
-    tx_receipt_dict = get_etherscan_tx_receipt(chain_id=chain_id,tx_hash=tx_hash)
     if str_to_int(tx_receipt_dict['status']) == 1:
         gas_used = str_to_int(tx_receipt_dict['gasUsed'])
         gas_price = str_to_int(tx_receipt_dict['effectiveGasPrice'])
@@ -522,114 +703,151 @@ def create_fill_txl_etherscan_by_hash(tx_hash,chain_id):
             'gas_used': gas_used,
             'gas_price': gas_price,
         })
-        blockTimestamp = tx_receipt_dict.get('blockTimestamp','')
+        blockTimestamp = tx_receipt_dict.get('blockTimestamp','') or block_timestamp
         if blockTimestamp:
             txl_dict.update({
                 'tx_time': to_tztime(str_to_int(blockTimestamp)),
             })
         #更新from单状态
-        update_sql = f'''
+        update_sql = '''
             UPDATE txline
-            SET status = 1
+            SET status = 1, update_time = NOW()
             WHERE id IN (
-                SELECT id FROM txline WHERE id = {txl_related_id} ORDER BY id LIMIT 1
+                SELECT id FROM txline WHERE id = %s ORDER BY id LIMIT 1
             );
         '''
-        pg_obj.execute(update_sql)
+        pg_obj.execute(update_sql, (txl_related_id,))
 
     res = pg_obj.insert('txline',txl_dict)
+    sync_transfer(txl_related_id=txl_related_id)
     return res
 
-def create_txl_etherscan_txlist(chain_id,tx_dict):
+def get_txl_dict_etherscan_txlist(chain_dict,tx_dict):
+    '''
+        etherscan txlist格式转成txline的字段, 不查库
+        返回 (txl_dict, fill单的depositHash), 不是deposit/fillRelay返回 (None, None)
+    '''
     tx_hash = add_0x_prefix(tx_dict['hash'])
     tx_status = str_to_int(tx_dict['txreceipt_status'])
-    txl_dict_search = get_txl(tx_hash=tx_hash)
+    calldata_dict = get_decode_calldata(tx_dict['input'])
+    contract_type = calldata_dict.get('contract_type','')
+    if not contract_type:
+        return None, None
+    gas_used = str_to_int(tx_dict['gasUsed'])
+    gas_price = str_to_int(tx_dict['gasPrice'])
+    tx_fee = gas_used*gas_price
+    tx_fee += str_to_int(tx_dict.get('L1FeesPaid',0))
+    txl_dict = {
+        'tx_hash': tx_hash,
+        # 'status': 0,  #todo
+        'contract_addr_call': to_checksum_address(tx_dict['to']),
+        # 'txl_related_id': '',
+        'tx_status': tx_status,
+        # 'is_refund': '',
+        # 'create_time': '',
+        # 'update_time': '',
+        'tx_time': to_tztime(tx_dict['timeStamp']),
+        'addr_from': to_checksum_address(tx_dict['from']),
+        # 'addr_to': '',     #todo
+        # 'recipient': '',   #todo
+        # 'chain_db_id': '',  #todo
+        # 'dst_chain_db_id': '',  #todo
+        # 'token_id': '',  #todo
+        # 'num': '',  #todo
+        'tx_fee': tx_fee,
+        'nonce': str_to_int(tx_dict['nonce']),
+        'gas_used': gas_used,
+        'gas_price': gas_price,
+        # 'estimate_gas_limit': '',  #todo
+        # 'estimate_gas_price': '',
+        # 'eip_type': '0x2',
+        # 'max_fee_per_gas': '',  #todo
+        # 'max_priority_fee_per_gas': '',  #todo
+        'calldata': calldata_dict['calldata'],
+        'note': ''
+    }
+    deposit_hash = None
+    if contract_type == 'contract_deposit':
+        # dst_chain_dict = get_chain(chain_id=calldata_dict['destinationChainId'])
+        token_dict = get_token(chain_id=chain_dict['chain_id'],token_address=calldata_dict['inputToken'])
+        txl_dict.update({
+            'addr_to': to_checksum_address(calldata_dict['vault']),
+            'recipient': to_checksum_address(calldata_dict['recipient']),
+            'chain_db_id': chain_dict['chain_db_id'],
+            # 'dst_chain_db_id': dst_chain_dict['chain_db_id'],
+            'token_id': token_dict['token_db_id'],
+            'num': calldata_dict['inputAmount'],
+        })
+    if contract_type == 'contract_fillrelay':
+        token_dict = get_token(chain_id=chain_dict['chain_id'],token_address=calldata_dict['outputToken'])
+        txl_dict.update({
+            'addr_to': to_checksum_address(calldata_dict['recipient']),
+            'recipient': to_checksum_address(calldata_dict['recipient']),
+            'chain_db_id': chain_dict['chain_db_id'],
+            'token_id': token_dict['token_db_id'],
+            'num': calldata_dict['outputAmount'],
+        })
+        deposit_hash = add_0x_prefix(calldata_dict['depositHash'])
+    return txl_dict, deposit_hash
 
-    res_create = None
+def get_txls_by_hashes(tx_hashes):
+    '''
+        返回 {tx_hash: txline}
+    '''
+    if not tx_hashes:
+        return {}
+    res = pg_obj.query("select * from txline where tx_hash = any(%s)", (list(tx_hashes),), primary=True)
+    return {i['tx_hash']: i for i in res}
 
-    if not txl_dict_search:
-        calldata_dict = get_decode_calldata(tx_dict['input'])
-        contract_type = calldata_dict.get('contract_type','')
-        if not contract_type:
-            return res_create
-        gas_used = str_to_int(tx_dict['gasUsed'])
-        gas_price = str_to_int(tx_dict['gasPrice'])
-        tx_fee = gas_used*gas_price
-        tx_fee += str_to_int(tx_dict.get('L1FeesPaid',0))
-        txl_dict = {
-            'tx_hash': tx_hash,
-            # 'status': 0,  #todo
-            'contract_addr_call': to_checksum_address(tx_dict['to']),
-            # 'txl_related_id': '',
-            'tx_status': tx_status,
-            # 'is_refund': '',
-            # 'create_time': '',
-            # 'update_time': '',
-            'tx_time': to_tztime(tx_dict['timeStamp']),
-            'addr_from': to_checksum_address(tx_dict['from']),
-            # 'addr_to': '',     #todo
-            # 'recipient': '',   #todo
-            # 'chain_db_id': '',  #todo
-            # 'dst_chain_db_id': '',  #todo
-            # 'token_id': '',  #todo
-            # 'num': '',  #todo
-            'tx_fee': tx_fee,
-            'nonce': str_to_int(tx_dict['nonce']),
-            'gas_used': gas_used,
-            'gas_price': gas_price,
-            # 'estimate_gas_limit': '',  #todo
-            # 'estimate_gas_price': '',
-            # 'eip_type': '0x2',
-            # 'max_fee_per_gas': '',  #todo
-            # 'max_priority_fee_per_gas': '',  #todo
-            'calldata': calldata_dict['calldata'],
-            'note': ''
-        }
-        chain_dict = get_chain(chain_id=chain_id)
-        if contract_type == 'contract_deposit':
-            # dst_chain_dict = get_chain(chain_id=calldata_dict['destinationChainId'])
-            token_dict = get_token(chain_id=chain_id,token_address=calldata_dict['inputToken'])
-            txl_dict.update({
-                'addr_to': to_checksum_address(calldata_dict['vault']),
-                'recipient': to_checksum_address(calldata_dict['recipient']),
-                'chain_db_id': chain_dict['chain_db_id'],
-                # 'dst_chain_db_id': dst_chain_dict['chain_db_id'],
-                'token_id': token_dict['token_db_id'],
-                'num': calldata_dict['inputAmount'],
-            })
-        if contract_type == 'contract_fillrelay':
-            token_dict = get_token(chain_id=chain_id,token_address=calldata_dict['outputToken'])
-            txl_dict.update({
-                'addr_to': to_checksum_address(calldata_dict['recipient']),
-                'recipient': to_checksum_address(calldata_dict['recipient']),
-                'chain_db_id': chain_dict['chain_db_id'],
-                'token_id': token_dict['token_db_id'],
-                'num': calldata_dict['outputAmount'],
-            })
-            depositHash = add_0x_prefix(calldata_dict['depositHash'])
-            txl_related_dict = get_txl(tx_hash=depositHash)
-            txl_related_id = txl_related_dict['id']
-            update_sql = f'''
-                UPDATE txline
-                SET status = 1
-                WHERE id IN (
-                    SELECT id FROM txline WHERE id = {txl_related_id} ORDER BY id LIMIT 1
-                );
-            '''
-            pg_obj.execute(update_sql)
-        res_create = pg_obj.insert('txline',txl_dict)
-        print(f"res_create: {res_create}")
-    else:
-        print(f"tx_hash: {tx_hash} 已存在")
-    return res_create
+def create_txls_etherscan_txlist(chain_id,tx_dicts):
+    '''
+        批量写入etherscan txlist格式的交易, 追块/回填时一次写几千笔
+        一条insert写所有行, tx_hash已存在的跳过(没关联上deposit的fill单补txl_related_id)
+        fill单的deposit一次查出, deposit状态一条update
+        返回实际插入/补关联的 [{'id','tx_hash','txl_related_id'}]
+    '''
+    chain_dict = get_chain(chain_id=chain_id)
+    txl_dicts = {}
+    deposit_hashes = {}
+    for tx_dict in tx_dicts:
+        txl_dict, deposit_hash = get_txl_dict_etherscan_txlist(chain_dict,tx_dict)
+        if not txl_dict:
+            continue
+        txl_dicts[txl_dict['tx_hash']] = txl_dict
+        if deposit_hash:
+            deposit_hashes[txl_dict['tx_hash']] = deposit_hash
+    if not txl_dicts:
+        return []
+
+    txl_related_dicts = get_txls_by_hashes(set(deposit_hashes.values()))
+    for tx_hash, deposit_hash in deposit_hashes.items():
+        txl_dicts[tx_hash].update({
+            'txl_related_id': txl_related_dicts.get(deposit_hash,{}).get('id'),
+        })
+    #deposit还没入库的fill单先写null, 之后再扫到时补上txl_related_id
+    res = pg_obj.insert_many('txline',list(txl_dicts.values()),conflict='tx_hash',
+                returning='id,tx_hash,txl_related_id',fill_null=['txl_related_id'])
+
+    #新插入/新关联上的fill单, 更新from单状态
+    txl_related_ids = list({i['txl_related_id'] for i in res if i['txl_related_id']})
+    if txl_related_ids:
+        pg_obj.execute("UPDATE txline SET status = 1, update_time = NOW() WHERE id = any(%s)", (txl_related_ids,))
+    sync_transfers(txl_related_ids=txl_related_ids,
+                    tx_hashes=[i['tx_hash'] for i in res if i['tx_hash'] not in deposit_hashes])
+    return res
+
+def create_txl_etherscan_txlist(chain_id,tx_dict):
+    res_create = create_txls_etherscan_txlist(chain_id,[tx_dict])
+    if not res_create:
+        print(f"tx_hash: {add_0x_prefix(tx_dict['hash'])} 已存在或不是deposit/fillRelay")
+        return None
+    print(f"res_create: {res_create[0]}")
+    return res_create[0]
 
 def get_create_txls_etherscan_txlist(chain_id,limit=1,contract_type=''):
     print(f"get_create_txl_etherscan chain_id: {chain_id}, limit: {limit}, contract_type: {contract_type}")
     tx_dicts = get_etherscan_txs(chain_id=chain_id,limit=limit,contract_type=contract_type)
-    for tx_dict in tx_dicts:
-        tx_status = str_to_int(tx_dict['txreceipt_status'])
-        if tx_status == 1:
-            print(f"tx_dict: {tx_dict}")
-
-            res_create = create_txl_etherscan_txlist(chain_id=chain_id,tx_dict=tx_dict)
-            print(f"res_create: {res_create}")
\ No newline at end of file
+    tx_dicts = [i for i in tx_dicts if str_to_int(i['txreceipt_status']) == 1]
+    res_create = create_txls_etherscan_txlist(chain_id=chain_id,tx_dicts=tx_dicts)
+    print(f"res_create: {len(res_create)}/{len(tx_dicts)}")
+    return res_create
@@ -0,0 +1,149 @@
+import hashlib
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from local_util import redis_obj
+
+from my_conf import ETHERSCAN_API_KEYS
+
+ETHERSCAN_API_URL = 'https://api.etherscan.io/v2/api'
+#免费key每秒5次
+ETHERSCAN_RATE_LIMIT = 5
+ETHERSCAN_TIMEOUT = 10
+#所有key都没额度时最多排队等这么久
+ETHERSCAN_WAIT_TIMEOUT = 30
+ETHERSCAN_MAX_RETRIES = 3
+#触发每日限额的key暂停使用
+ETHERSCAN_DAILY_COOLDOWN = 60*60
+ETHERSCAN_BUCKET_KEY = 'etherscan_bucket:{key_id}'
+ETHERSCAN_BLOCK_KEY = 'etherscan_block:{key_id}'
+
+#KEYS: 所有key的令牌桶, 再是所有key的暂停标记; 取额度最多的key扣一个令牌
+#返回{序号(从1开始), 0}, 都没额度返回{0, 最短等待秒数}
+ETHERSCAN_ACQUIRE_LUA = '''
+local rate = tonumber(ARGV[1])
+local now = tonumber(ARGV[2])
+local n = #KEYS / 2
+local best, best_tokens, wait = 0, 0, nil
+for i = 1, n do
+    local w
+    local blocked = tonumber(redis.call('GET', KEYS[n + i]) or '0')
+    if blocked > now then
+        w = blocked - now
+    else
+        local bucket = redis.call('HMGET', KEYS[i], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or rate
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(rate, tokens + math.max(now - updated, 0) * rate)
+        if tokens >= 1 and tokens > best_tokens then
+            best, best_tokens = i, tokens
+        end
+        w = math.max(0, (1 - tokens) / rate)
+    end
+    if wait == nil or w < wait then
+        wait = w
+    end
+end
+if best > 0 then
+    redis.call('HSET', KEYS[best], 'tokens', tostring(best_tokens - 1), 'updated', ARGV[2])
+    redis.call('EXPIRE', KEYS[best], 60)
+    return {best, '0'}
+end
+return {0, tostring(wait)}
+'''
+
+#清空额度, ARGV[2]>0时暂停这么多秒
+ETHERSCAN_PENALIZE_LUA = '''
+redis.call('HSET', KEYS[1], 'tokens', '0', 'updated', ARGV[1])
+redis.call('EXPIRE', KEYS[1], 60)
+if tonumber(ARGV[2]) > 0 then
+    redis.call('SET', KEYS[2], tostring(tonumber(ARGV[1]) + tonumber(ARGV[2])), 'EX', ARGV[2])
+end
+return 1
+'''
+
+
+class EtherscanRateLimitError(Exception):
+    pass
+
+
+class KeyBucket(object):
+    '''
+        单个key, 令牌桶状态在redis里, 所有进程共用同一个额度
+    '''
+    def __init__(self, api_key):
+        self.api_key = api_key
+        #redis key里不放api key本身
+        key_id = hashlib.sha1(api_key.encode()).hexdigest()[:12]
+        self.bucket_key = ETHERSCAN_BUCKET_KEY.format(key_id=key_id)
+        self.block_key = ETHERSCAN_BLOCK_KEY.format(key_id=key_id)
+
+
+class EtherscanKeyPool(object):
+    '''
+        多个etherscan key按令牌桶调度, 每次请求用当前额度最多的key
+        令牌桶在redis里, 多个cron进程加起来不超过每个key的限额
+        所有key都没额度时排队等待, 而不是直接失败
+        返回限流时这个key清空额度(每日限额暂停1小时), 换key重试
+    '''
+    def __init__(self, api_keys, redis=None, rate=ETHERSCAN_RATE_LIMIT, timeout=ETHERSCAN_TIMEOUT):
+        self.buckets = [KeyBucket(i) for i in dict.fromkeys(api_keys) if i]
+        self.redis = redis
+        self.rate = rate
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=20)
+        self.session.mount('https://', adapter)
+
+    def acquire(self, wait_timeout=ETHERSCAN_WAIT_TIMEOUT):
+        #没配置key时按限流处理, 调用方统一走这个异常
+        if not self.buckets:
+            raise EtherscanRateLimitError("没有可用的etherscan key")
+        keys = [i.bucket_key for i in self.buckets] + [i.block_key for i in self.buckets]
+        time_start = time.time()
+        while True:
+            index, wait = self.redis.eval(ETHERSCAN_ACQUIRE_LUA, keys=keys, args=[self.rate, time.time()])
+            if int(index):
+                return self.buckets[int(index) - 1]
+            wait = max(float(wait), 0.01)
+            if time.time() + wait - time_start > wait_timeout:
+                raise EtherscanRateLimitError(f"所有etherscan key都没有额度, 等待超过{wait_timeout}s")
+            time.sleep(wait)
+
+    def penalize(self, bucket, message):
+        self.redis.eval(ETHERSCAN_PENALIZE_LUA, keys=[bucket.bucket_key, bucket.block_key],
+                args=[time.time(), ETHERSCAN_DAILY_COOLDOWN if 'daily' in message.lower() else 0])
+        if 'daily' in message.lower():
+            print(f"⚠️ etherscan key每日限额, 暂停{ETHERSCAN_DAILY_COOLDOWN}s: {bucket.api_key[:6]}")
+
+    def is_rate_limited(self, data):
+        res = data.get('result') if isinstance(data, dict) else None
+        if isinstance(data, dict) and isinstance(data.get('error'), dict):
+            res = data['error'].get('message')
+        return isinstance(res, str) and 'rate limit' in res.lower()
+
+    def get(self, params, max_retries=ETHERSCAN_MAX_RETRIES):
+        '''
+            params不用带apikey, 返回json
+        '''
+        error = None
+        for _ in range(max_retries):
+            bucket = self.acquire()
+            try:
+                response = self.session.get(ETHERSCAN_API_URL, params=dict(params, apikey=bucket.api_key),
+                                timeout=self.timeout)
+                data = response.json()
+            except Exception as e:
+                error = e
+                continue
+            if self.is_rate_limited(data):
+                self.penalize(bucket, str(data.get('result') or data.get('error')))
+                error = EtherscanRateLimitError(str(data))
+                continue
+            return data
+        raise error
+
+
+etherscan_pool = EtherscanKeyPool(ETHERSCAN_API_KEYS, redis=redis_obj)
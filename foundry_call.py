@@ -22,12 +22,12 @@ def deploy_contract_one(chain_dict,contract_type):
         sql = f'''
             update chain
             set 
-            {contract_field} = '{deploy_address}',
+            {contract_field} = %s,
             update_time = now()
-            where chain_id = {chain_dict['chain_id']}
+            where chain_id = %s
         '''
         print(sql)
-        res = pg_obj.execute(sql)
+        res = pg_obj.execute(sql, (deploy_address, chain_dict['chain_id']))
         print(chain_dict['chain_name'],'update contract_deposit:',res)
 
 # chain_dict = get_chain(chain_id=300)
@@ -0,0 +1,147 @@
+import json
+import threading
+import time
+
+from web3.datastructures import AttributeDict
+
+from local_util import redis_obj,get_w3
+from web3_util import get_batch_results
+
+GAS_ORACLE_KEY = 'gas_oracle:{chain_id}'
+#超过这个时间的数据不用, get_gas_params回退到实时rpc
+GAS_ORACLE_MAX_AGE = 15
+GAS_ORACLE_POLL_INTERVAL = 1
+GAS_ORACLE_FEE_HISTORY_BLOCKS = 20
+GAS_ORACLE_PERCENTILES = [10, 50, 90]
+
+#本进程跑oracle时直接读内存
+_gas_states = {}
+
+
+def get_median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[len(values) // 2]
+
+def fetch_gas_state(w3, chain_id, is_eip1559=True):
+    """
+    一个batch取最新区块、gasPrice、feeHistory, 算出baseFee、优先费用分位数、区块利用率
+    """
+    requests = [
+        ('latest_block', lambda: w3.eth.get_block('latest')),
+        ('gas_price', lambda: w3.eth.gas_price),
+    ]
+    if is_eip1559:
+        requests.append(('fee_history', lambda: w3.eth.fee_history(GAS_ORACLE_FEE_HISTORY_BLOCKS, 'latest', GAS_ORACLE_PERCENTILES)))
+    res = get_batch_results(w3, requests)
+    latest_block = res.get('latest_block')
+    if latest_block is None or res.get('gas_price') is None:
+        return None
+    gas_state = {
+        'chain_id': chain_id,
+        'block_number': latest_block.number,
+        'base_fee': latest_block.get('baseFeePerGas'),
+        'gas_used': latest_block.gasUsed,
+        'gas_limit': latest_block.gasLimit,
+        'gas_price': res['gas_price'],
+        'utilization': latest_block.gasUsed / latest_block.gasLimit if latest_block.gasLimit else None,
+        'timestamp': time.time(),
+    }
+    fee_history = res.get('fee_history')
+    if fee_history and fee_history.get('reward'):
+        #每个分位数取最近N个区块的中位数, 过滤掉空块的0
+        priority_fees = {}
+        for index, percentile in enumerate(GAS_ORACLE_PERCENTILES):
+            rewards = [i[index] for i in fee_history['reward'] if i and i[index]]
+            priority_fees[str(percentile)] = get_median(rewards)
+        gas_state.update({
+            'next_base_fee': fee_history['baseFeePerGas'][-1],
+            'priority_fees': priority_fees,
+            'max_priority_fee': priority_fees.get('50'),
+            'utilization_avg': sum(fee_history['gasUsedRatio']) / len(fee_history['gasUsedRatio']),
+        })
+    return gas_state
+
+def set_gas_state(gas_state, ex=GAS_ORACLE_MAX_AGE*4):
+    _gas_states[gas_state['chain_id']] = gas_state
+    return redis_obj.set(GAS_ORACLE_KEY.format(chain_id=gas_state['chain_id']), json.dumps(gas_state), ex)
+
+def get_gas_state(chain_id, max_age=GAS_ORACLE_MAX_AGE):
+    """
+    取oracle数据, 优先内存, 其次redis, 超过max_age返回None
+    """
+    if not chain_id:
+        return None
+    chain_id = int(chain_id)
+    gas_state = _gas_states.get(chain_id)
+    if not gas_state or time.time() - gas_state['timestamp'] > max_age:
+        try:
+            res = redis_obj.get(GAS_ORACLE_KEY.format(chain_id=chain_id))
+        except Exception as e:
+            print(f"⚠️ 读取gas oracle失败: {e}")
+            return None
+        gas_state = json.loads(res) if res else None
+    if not gas_state or time.time() - gas_state['timestamp'] > max_age:
+        return None
+    return gas_state
+
+def get_oracle_chain_state(chain_id, max_age=GAS_ORACLE_MAX_AGE):
+    """
+    转成get_gas_params的chain_state格式(latest_block/gas_price/max_priority_fee)
+    """
+    gas_state = get_gas_state(chain_id, max_age=max_age)
+    if not gas_state:
+        return {}
+    latest_block = {
+        'number': gas_state['block_number'],
+        'gasUsed': gas_state['gas_used'],
+        'gasLimit': gas_state['gas_limit'],
+    }
+    if gas_state.get('base_fee') is not None:
+        latest_block['baseFeePerGas'] = gas_state['base_fee']
+    chain_state = {
+        'latest_block': AttributeDict(latest_block),
+        'gas_price': gas_state['gas_price'],
+    }
+    if gas_state.get('max_priority_fee'):
+        chain_state['max_priority_fee'] = gas_state['max_priority_fee']
+    return chain_state
+
+
+class GasOracle(threading.Thread):
+    """
+    跟踪一条链的新区块, 每个新区块刷新一次gas数据写到内存和redis
+    """
+    def __init__(self, chain_id, is_eip1559=True, poll_interval=GAS_ORACLE_POLL_INTERVAL):
+        super().__init__(name=f'gas_oracle_{chain_id}', daemon=True)
+        self.chain_id = int(chain_id)
+        self.is_eip1559 = is_eip1559
+        self.poll_interval = poll_interval
+        self.block_number = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def poll_once(self):
+        w3 = get_w3(chain_id=self.chain_id)
+        block_number = w3.eth.block_number
+        #没出新块, 只要数据没过期就不刷新
+        if block_number == self.block_number:
+            gas_state = _gas_states.get(self.chain_id)
+            if gas_state and time.time() - gas_state['timestamp'] < GAS_ORACLE_MAX_AGE / 2:
+                return gas_state
+        gas_state = fetch_gas_state(w3, self.chain_id, is_eip1559=self.is_eip1559)
+        if gas_state:
+            self.block_number = gas_state['block_number']
+            set_gas_state(gas_state)
+        return gas_state
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"⚠️ gas oracle {self.chain_id} error: {e}")
+            self._stop_event.wait(self.poll_interval)
@@ -0,0 +1,232 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from eth_utils import to_checksum_address
+
+from local_util import pg_obj,get_w3,str_to_int,get_decode_calldata
+from data_util import get_chain,get_chains
+from receipt_util import get_rpc_batch
+
+#只索引到 最新区块-确认数, 更浅的区块可能重组
+INDEXER_CONFIRMATIONS = 5
+#没有checkpoint时从最新区块往前这么多开始
+INDEXER_START_BLOCKS_BACK = 5000
+INDEXER_RANGE_INIT = 2000
+INDEXER_RANGE_MIN = 10
+INDEXER_RANGE_MAX = 10000
+INDEXER_BATCH_SIZE = 50
+#轮询间隔按出块时间, 限制在这个范围
+INDEXER_POLL_MIN = 0.5
+INDEXER_POLL_MAX = 15
+#多链watcher同时在跑的链数, 所有链共用rpc/pg连接
+WATCHER_MAX_CONCURRENCY = 4
+WATCHER_REFRESH_INTERVAL = 60
+
+
+if pg_obj:
+    pg_obj.prepare('deposit_checkpoint_by_chain', 'select block_number from deposit_checkpoint where chain_db_id = $1', 1)
+
+def get_checkpoint(chain_db_id):
+    res = pg_obj.query_prepared('deposit_checkpoint_by_chain', (int(chain_db_id),), primary=True, as_tuple=True)
+    return res[0][0] if res else None
+
+def set_checkpoint(chain_db_id, block_number):
+    sql = '''
+        INSERT INTO deposit_checkpoint(chain_db_id, block_number, update_time)
+        VALUES (%s, %s, NOW())
+        ON CONFLICT (chain_db_id) DO UPDATE
+        SET block_number = EXCLUDED.block_number, update_time = NOW();
+    '''
+    return pg_obj.execute(sql, (int(chain_db_id), int(block_number)))
+
+def get_rpc_result(w3, method, params):
+    response = w3.provider.make_request(method, params)
+    if response.get('error'):
+        raise Exception(f"{method} error: {response['error']}")
+    return response['result']
+
+def get_rpc_batch_chunked(w3, batch_requests, size=INDEXER_BATCH_SIZE):
+    res = []
+    for i in range(0, len(batch_requests), size):
+        res += get_rpc_batch(w3, batch_requests[i:i+size])
+    return res
+
+
+class DepositIndexer(object):
+    '''
+        从checkpoint开始用eth_getLogs按区块范围扫deposit合约, 处理完一个范围才推进checkpoint
+        合约abi里没有事件定义, 不按topic过滤, 取合约的所有日志再按交易calldata判断是不是deposit
+        返回etherscan txlist格式, 和call_fill_relay_by_etherscan走同一套处理
+    '''
+    def __init__(self, chain_id, confirmations=INDEXER_CONFIRMATIONS, range_size=INDEXER_RANGE_INIT):
+        self.chain_id = int(chain_id)
+        self.confirmations = confirmations
+        self.range_size = range_size
+
+    def get_block_time(self, w3=None, sample=100):
+        w3 = w3 or get_w3(chain_id=self.chain_id)
+        latest_block = w3.eth.get_block('latest')
+        old_block = w3.eth.get_block(max(latest_block.number - sample, 0))
+        if latest_block.number == old_block.number:
+            return INDEXER_POLL_MAX
+        return (latest_block.timestamp - old_block.timestamp) / (latest_block.number - old_block.number)
+
+    def shrink_range(self):
+        self.range_size = max(self.range_size // 2, INDEXER_RANGE_MIN)
+
+    def grow_range(self):
+        self.range_size = min(int(self.range_size * 1.5), INDEXER_RANGE_MAX)
+
+    def get_logs(self, w3, address, from_block, to_block):
+        return get_rpc_result(w3, 'eth_getLogs', [{
+            'address': address,
+            'fromBlock': hex(from_block),
+            'toBlock': hex(to_block),
+        }])
+
+    def get_deposit_txs(self, w3, logs):
+        '''
+            日志按交易去重, 一个batch取交易和receipt, 再一个batch取区块时间
+        '''
+        tx_hashes = list(dict.fromkeys(i['transactionHash'] for i in
+                        sorted(logs, key=lambda x: (str_to_int(x['blockNumber']), str_to_int(x['logIndex'])))))
+        if not tx_hashes:
+            return []
+        batch_requests = []
+        for tx_hash in tx_hashes:
+            batch_requests.append(('eth_getTransactionByHash', [tx_hash]))
+            batch_requests.append(('eth_getTransactionReceipt', [tx_hash]))
+        results = get_rpc_batch_chunked(w3, batch_requests)
+        txs = []
+        for index, tx_hash in enumerate(tx_hashes):
+            tx_dict, tx_receipt_dict = results[index*2], results[index*2+1]
+            if not tx_dict or not tx_receipt_dict:
+                raise Exception(f"交易或receipt不存在: {tx_hash}")
+            if get_decode_calldata(tx_dict['input']).get('contract_type','') != 'contract_deposit':
+                continue
+            txs.append((tx_dict, tx_receipt_dict))
+
+        block_numbers = list(dict.fromkeys(i[1]['blockNumber'] for i in txs))
+        blocks = get_rpc_batch_chunked(w3, [('eth_getBlockByNumber', [i, False]) for i in block_numbers])
+        block_timestamps = {k: v['timestamp'] for k, v in zip(block_numbers, blocks) if v}
+
+        res = []
+        for tx_dict, tx_receipt_dict in txs:
+            #转成etherscan txlist的字段
+            res.append({
+                'hash': tx_dict['hash'],
+                'blockNumber': str_to_int(tx_receipt_dict['blockNumber']),
+                'timeStamp': str_to_int(block_timestamps[tx_receipt_dict['blockNumber']]),
+                'from': tx_dict['from'],
+                'to': tx_dict['to'],
+                'nonce': tx_dict['nonce'],
+                'input': tx_dict['input'],
+                'txreceipt_status': str_to_int(tx_receipt_dict['status']),
+                'gasUsed': tx_receipt_dict['gasUsed'],
+                'gasPrice': tx_receipt_dict.get('effectiveGasPrice') or tx_dict['gasPrice'],
+                'L1FeesPaid': tx_receipt_dict.get('l1Fee', 0),
+            })
+        return res
+
+    def poll_once(self, handler):
+        '''
+            handler(chain_id, tx_dicts): 处理一个范围内的deposit, 抛异常时checkpoint不推进, 下次重扫
+            异常带tx_dicts(失败的deposit, 例如web3_call.FillRelayError)时推进到第一笔失败的区块之前
+            返回处理的deposit数, 没有新的确认区块返回None
+        '''
+        chain_dict = get_chain(chain_id=self.chain_id)
+        chain_db_id = chain_dict['chain_db_id']
+        address = to_checksum_address(chain_dict['contract_deposit'])
+        w3 = get_w3(chain_id=self.chain_id)
+        safe_block = w3.eth.block_number - self.confirmations
+        checkpoint = get_checkpoint(chain_db_id)
+        if checkpoint is None:
+            checkpoint = max(safe_block - INDEXER_START_BLOCKS_BACK, 0)
+        from_block = checkpoint + 1
+        if from_block > safe_block:
+            return None
+        to_block = min(from_block + self.range_size - 1, safe_block)
+        try:
+            logs = self.get_logs(w3, address, from_block, to_block)
+        except Exception as e:
+            #超过节点的范围/结果数限制, 缩小范围重试
+            print(f"⚠️ eth_getLogs失败, 缩小范围 {self.range_size} -> {max(self.range_size // 2, INDEXER_RANGE_MIN)}: {e}")
+            self.shrink_range()
+            raise
+        tx_dicts = self.get_deposit_txs(w3, logs)
+        print(f"📦 Chain {self.chain_id} 区块 {from_block}-{to_block}: logs={len(logs)}, deposits={len(tx_dicts)}")
+        if tx_dicts:
+            try:
+                handler(self.chain_id, tx_dicts)
+            except Exception as e:
+                failed_blocks = [i['blockNumber'] for i in getattr(e, 'tx_dicts', None) or []]
+                if failed_blocks and min(failed_blocks) - 1 > checkpoint:
+                    checkpoint = min(failed_blocks) - 1
+                    set_checkpoint(chain_db_id, checkpoint)
+                print(f"❌ Chain {self.chain_id} deposit处理失败, checkpoint停在 {checkpoint}")
+                raise
+        set_checkpoint(chain_db_id, to_block)
+        self.grow_range()
+        return len(tx_dicts)
+
+    def run(self, handler, time_sleep=1):
+        while True:
+            try:
+                res = self.poll_once(handler)
+            except Exception as e:
+                print(f"⚠️ deposit indexer {self.chain_id} error: {e}")
+                time.sleep(time_sleep)
+                continue
+            #追上最新区块后再sleep
+            if res is None:
+                time.sleep(time_sleep)
+
+
+async def watch_chain(chain_id, handler, semaphore, executor, confirmations=INDEXER_CONFIRMATIONS):
+    '''
+        单条链的协程, 追赶时连续扫, 追上后按出块时间sleep
+        扫描本身在线程池里跑, semaphore控制所有链同时占用的连接数
+    '''
+    loop = asyncio.get_running_loop()
+    indexer = DepositIndexer(chain_id, confirmations=confirmations)
+    poll_interval = None
+    while True:
+        try:
+            async with semaphore:
+                if poll_interval is None:
+                    block_time = await loop.run_in_executor(executor, indexer.get_block_time)
+                    poll_interval = min(max(block_time, INDEXER_POLL_MIN), INDEXER_POLL_MAX)
+                    print(f"⏱️ Chain {chain_id} 出块时间 {block_time:.2f}s, 轮询间隔 {poll_interval:.2f}s")
+                res = await loop.run_in_executor(executor, indexer.poll_once, handler)
+        except Exception as e:
+            print(f"⚠️ deposit watcher {chain_id} error: {e}")
+            await asyncio.sleep(poll_interval or INDEXER_POLL_MAX)
+            continue
+        #还在追赶也让出一次, 其他链排队的先跑
+        await asyncio.sleep(poll_interval if res is None else 0)
+
+async def watch_chains(handler, is_mainnet=None, chain_ids=None, max_concurrency=WATCHER_MAX_CONCURRENCY,
+                        confirmations=INDEXER_CONFIRMATIONS):
+    '''
+        一个进程扫所有active链, 定期按get_chains刷新, 新加的链自动开始, 下线的链停止
+    '''
+    semaphore = asyncio.Semaphore(max_concurrency)
+    executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='deposit_watcher')
+    tasks = {}
+    while True:
+        chain_dicts = [i for i in get_chains(is_mainnet=is_mainnet) if i['contract_deposit']]
+        if chain_ids:
+            chain_dicts = [i for i in chain_dicts if i['chain_id'] in chain_ids]
+        active_chain_ids = {i['chain_id'] for i in chain_dicts}
+        for chain_id in list(tasks):
+            if chain_id not in active_chain_ids:
+                print(f"deposit watcher stop: {chain_id}")
+                tasks.pop(chain_id).cancel()
+        for chain_dict in chain_dicts:
+            chain_id = chain_dict['chain_id']
+            if chain_id not in tasks or tasks[chain_id].done():
+                print(f"deposit watcher start: {chain_id} {chain_dict['chain_name']}")
+                tasks[chain_id] = asyncio.create_task(watch_chain(chain_id, handler, semaphore, executor,
+                                        confirmations=confirmations))
+        await asyncio.sleep(WATCHER_REFRESH_INTERVAL)
@@ -0,0 +1,158 @@
+import uuid
+
+from eth_utils import add_0x_prefix
+
+from local_util import redis_obj
+
+LEASE_KEY = 'fill_lease:{deposit_hash}'
+FENCE_KEY = 'fill_fence:{deposit_hash}'
+#租约时间, 一次fill(报价+估gas+发送)远小于这个时间, 发送前续约
+LEASE_TTL_MS = 60*1000
+#fill交易发出后, 这笔deposit保持锁定这么久, 重复推送/cron直接跳过, 不用再查链上isRelayFilled
+#比receipt_util.RECEIPT_MAX_AGE略长, 交易失败/超时未上链由poll_receipts提前清掉
+LEASE_DONE_EX_MS = 35*60*1000
+#确定不能fill的deposit(报价错误/金额超出范围/参数不对), 这段时间内不再报价和查链
+LEASE_REJECT_EX_MS = 10*60*1000
+#链上已经被填充过, 没有我们自己的交易hash
+LEASE_FILLED_VALUE = 'filled'
+
+#抢到租约时fencing计数器+1, 返回给持有者, 没抢到返回nil
+LEASE_ACQUIRE_LUA = '''
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    local token = redis.call('INCR', KEYS[2])
+    redis.call('PEXPIRE', KEYS[2], ARGV[3])
+    return token
+end
+return nil
+'''
+
+#只有持有者能续约/释放/标记完成, 租约过期被别人抢走后的旧持有者操作无效
+#续约和标记完成还要比对fencing计数器, 计数器变了说明中间有别人抢到过, 不能再发交易
+LEASE_RENEW_LUA = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] and redis.call('GET', KEYS[2]) == ARGV[2] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[3])
+end
+return 0
+'''
+
+LEASE_RELEASE_LUA = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+LEASE_COMPLETE_LUA = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] and redis.call('GET', KEYS[2]) == ARGV[2] then
+    redis.call('SET', KEYS[1], ARGV[3], 'PX', ARGV[4])
+    return 1
+end
+return 0
+'''
+
+
+class FillLease(object):
+    '''
+        一笔deposit的fill租约, with里没有complete的话退出时释放, 失败的可以被重试拿到
+        fence: 单调递增的fencing token, 每次抢到加1, 发送前续约时和redis里的计数器比对
+    '''
+    def __init__(self, manager, deposit_hash, owner, fence):
+        self.manager = manager
+        self.deposit_hash = deposit_hash
+        self.owner = owner
+        self.fence = fence
+        self.done = False
+
+    def renew(self):
+        '''
+            续约同时检查owner和fence, 发交易前调用, 返回False说明租约已经丢了, 不能发
+        '''
+        return self.manager.renew(self)
+
+    def release(self):
+        return self.manager.release(self)
+
+    def complete(self, tx_hash):
+        self.done = self.manager.complete(self, tx_hash)
+        return self.done
+
+    def reject(self, reason):
+        self.done = self.manager.reject(self, reason)
+        return self.done
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.done:
+            self.release()
+
+
+class FillLeaseManager(object):
+    '''
+        SET NX PX + owner token的分布式租约, webhook worker和etherscan/indexer cron共用
+        同一笔deposit同时只有一个进程在fill, 没抢到的在任何rpc请求之前就返回
+    '''
+    def __init__(self, redis=None, ttl_ms=LEASE_TTL_MS, done_ex_ms=LEASE_DONE_EX_MS,
+                    reject_ex_ms=LEASE_REJECT_EX_MS):
+        self.redis = redis
+        self.ttl_ms = ttl_ms
+        self.done_ex_ms = done_ex_ms
+        self.reject_ex_ms = reject_ex_ms
+
+    def get_keys(self, deposit_hash):
+        deposit_hash = deposit_hash.lower()
+        if not deposit_hash.startswith('0x'):
+            deposit_hash = '0x' + deposit_hash
+        return [LEASE_KEY.format(deposit_hash=deposit_hash), FENCE_KEY.format(deposit_hash=deposit_hash)]
+
+    def acquire(self, deposit_hash):
+        '''
+            返回FillLease, 已经有人在fill或者已经fill过返回None
+        '''
+        owner = uuid.uuid4().hex
+        fence = self.redis.eval(LEASE_ACQUIRE_LUA, keys=self.get_keys(deposit_hash),
+                    args=[owner, self.ttl_ms, self.done_ex_ms])
+        if fence is None:
+            return None
+        return FillLease(self, deposit_hash, owner, int(fence))
+
+    def renew(self, lease):
+        return bool(self.redis.eval(LEASE_RENEW_LUA, keys=self.get_keys(lease.deposit_hash),
+                        args=[lease.owner, lease.fence, self.ttl_ms]))
+
+    def release(self, lease):
+        return bool(self.redis.eval(LEASE_RELEASE_LUA, keys=self.get_keys(lease.deposit_hash)[:1],
+                        args=[lease.owner]))
+
+    def complete(self, lease, tx_hash):
+        '''
+            交易已经发出, 租约换成完成标记, 之后的重复推送直接跳过
+            tx_hash=None: 链上已经被填充过, 标记为filled
+        '''
+        value = self.get_done_value(tx_hash) if tx_hash else LEASE_FILLED_VALUE
+        return self.mark(lease, value, self.done_ex_ms)
+
+    def reject(self, lease, reason):
+        '''
+            确定不能fill, 租约换成拒绝标记, reject_ex_ms内重复推送/cron直接跳过
+        '''
+        return self.mark(lease, f'rejected:{reason[:200]}', self.reject_ex_ms)
+
+    def mark(self, lease, value, ex_ms):
+        return bool(self.redis.eval(LEASE_COMPLETE_LUA, keys=self.get_keys(lease.deposit_hash),
+                        args=[lease.owner, lease.fence, value, ex_ms]))
+
+    def get_done_value(self, tx_hash):
+        return f'done:{add_0x_prefix(str(tx_hash)).lower()}'
+
+    def clear(self, deposit_hash, tx_hash):
+        '''
+            fill交易失败或者超时未上链, 删掉完成标记, 这笔deposit可以重新fill
+            值还是这笔交易的完成标记才删, 不会删掉之后别人的租约
+        '''
+        return bool(self.redis.eval(LEASE_RELEASE_LUA, keys=self.get_keys(deposit_hash)[:1],
+                        args=[self.get_done_value(tx_hash)]))
+
+
+fill_lease_manager = FillLeaseManager(redis=redis_obj)
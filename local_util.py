@@ -8,9 +8,10 @@ from web3 import Web3
 import arrow
 
 from pg_util import Postgresql
+from async_pg_util import AsyncPostgresql
 from redis_util import Redis
 
-from my_conf import DB_HOST,DB_DB,DB_USER,DB_PWD,TZ,POA_CHAIN_IDS
+from my_conf import DB_HOST,DB_DB,DB_USER,DB_PWD,DB_REPLICA_HOSTS,TZ,POA_CHAIN_IDS
 
 DECIMALS_WEI_DICT = {len(str(v))-1:k for k,v in units.items()}
 # support decimals
@@ -19,14 +20,21 @@ DECIMALS_WEI_DICT = {len(str(v))-1:k for k,v in units.items()}
 
 redis_obj = Redis()
 
-def get_pg_obj(host=DB_HOST,db=DB_DB,user=DB_USER,pwd=DB_PWD):
+def get_pg_obj(host=DB_HOST,db=DB_DB,user=DB_USER,pwd=DB_PWD,replica_hosts=DB_REPLICA_HOSTS):
     if not host:
         return None
-    pg_obj = Postgresql(host,db,user,pwd)
+    pg_obj = Postgresql(host,db,user,pwd,replica_hosts=replica_hosts)
     return pg_obj
 
 pg_obj = get_pg_obj()
 
+def get_apg_obj(host=DB_HOST,db=DB_DB,user=DB_USER,pwd=DB_PWD,replica_hosts=DB_REPLICA_HOSTS):
+    if not host:
+        return None
+    return AsyncPostgresql(host,db,user,pwd,replica_hosts=replica_hosts)
+
+apg_obj = get_apg_obj()
+
 def read_json_file(file_path):
     try:
         with open(file_path, 'r') as file:
@@ -72,6 +80,9 @@ def get_address_url(block_explorer,address,explorer_template='{domain}/address/{
 def set_tmp_key(k,v,ex=None):
     return redis_obj.set(k,v,ex)
 
+def set_tmp_keys(kv_dict,ex=None):
+    return redis_obj.set_many(kv_dict,ex=ex)
+
 def get_tmp_key(k):
     return redis_obj.get(k)
 
@@ -222,6 +233,10 @@ def inject_poa_middleware(w3):
 
 def auto_inject_poa_middleware_if_needed(w3):
     """自动检测并注入POA中间件（如果需要）"""
+    #连接池里的w3已经检测过了
+    poa_result = getattr(w3, 'poa_result', None)
+    if poa_result:
+        return poa_result
     try:
         # 先检测是否为POA链
         is_poa, extra_data_len = is_poa_chain(w3)
@@ -268,19 +283,10 @@ def auto_inject_poa_middleware_if_needed(w3):
             return None
 
 def get_w3(rpc_url='',chain_id=''):
-    if chain_id:
-        sql = f'select rpc_url from chain where chain_id = {chain_id}'
-        res_pg = pg_obj.query(sql)
-        if res_pg:
-            rpc_url = res_pg[0]['rpc_url']
-    if not rpc_url:
-        return
-    w3 = Web3(Web3.HTTPProvider(rpc_url))
-    
-    # 自动检测并注入POA中间件（如果需要）
-    poa_result = auto_inject_poa_middleware_if_needed(w3)
-    if poa_result and poa_result not in ["not_needed", "already_exists"]:
-        print(f"🔗 Chain {chain_id} POA中间件状态: {poa_result}")
-    
+    '''
+        从rpc_util.w3_pool取长期复用的客户端, 不再每次查库/新建连接/检测POA
+    '''
+    from rpc_util import w3_pool
+    w3 = w3_pool.get(chain_id=chain_id,rpc_url=rpc_url)
     # print(w3.isConnected())
-    return w3
\ No newline at end of file
+    return w3
@@ -1,13 +1,16 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Query
 # from typing import Dict, Any, Optional
 from pydantic import BaseModel, Field
 from starlette.middleware.cors import CORSMiddleware
 
 from data_util import get_vault_address, api_get_token_groups, \
-    api_get_chains_by_token_group, get_txls_pair, get_deposit_args,\
-    get_suggested_fees, get_price, check_create_refer, get_refer, update_refer
+    async_api_get_chains_by_token_group, async_get_txls_pair, get_deposit_args,\
+    get_suggested_fees, get_price, check_create_refer, async_get_refer, update_refer
+from local_util import apg_obj
 
 from web3_call import call_erc_allowance
+from registry_util import start_registry_listener
+from price_util import start_price_feed
 
 
 class CreateRefer(BaseModel):
@@ -47,6 +50,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def startup():
+    start_registry_listener()
+    start_price_feed()
+
+@app.on_event("shutdown")
+async def shutdown():
+    if apg_obj:
+        await apg_obj.close()
+
 @app.get("/get_vault_address",summary='get vault address',
         description='''
             get vault address
@@ -65,8 +78,8 @@ def fast_get_token_groups():
         description='''
             get chains by token group
         ''')
-def fast_get_chains_by_token_group(token_group: str):
-    return api_get_chains_by_token_group(token_group)
+async def fast_get_chains_by_token_group(token_group: str):
+    return await async_api_get_chains_by_token_group(token_group)
 
 @app.get("/get_deposit_args",summary='get deposit args',
         description='''
@@ -97,25 +110,26 @@ def fast_get_suggested_fees(origin_chain_id: int, dst_chain_id: int, input_amoun
 
 @app.get("/get_txls_pair",summary='get_txls_pair',
         description='''
-            get_txls_pair get transfer details
+            get_txls_pair get transfer details,
+            cursor: txl_related_id of the last row of the previous page
         ''')
-def fast_get_txls_pair(addr: str, status: int = None, limit: int = 50, offset: int = 0):
-    res = get_txls_pair(addr=addr, status=status, limit=limit, offset=offset)
+async def fast_get_txls_pair(addr: str, status: int = None, limit: int = 50, offset: int = 0, cursor: int = None):
+    res = await async_get_txls_pair(addr=addr, status=status, limit=limit, offset=offset, cursor=cursor)
     return res
 
 @app.get("/get_price",summary='get price',
         description='''
             get price
         ''')
-def fast_get_price(currency: str):
-    return get_price(currency)
+def fast_get_price(currency: str, max_age: float = Query(None, ge=0)):
+    return get_price(currency, max_age=max_age)
 
 @app.get("/get_refer",summary='get refer',
         description='''
             get refer
         ''')
-def fast_get_refer(account_address: str):
-    res = get_refer(account_address)
+async def fast_get_refer(account_address: str):
+    res = await async_get_refer(account_address)
     return res
 
 @app.post("/create_refer", summary='create refer',
@@ -64,6 +64,28 @@ class MyCcxt(object):
         if symbol:
             return self.exchange.fetch_ticker(symbol)['last']
         
+    def fetch_currency_last_prices(self, currency_list):
+        '''
+            一次fetch_tickers取所有币的USDT价格, 返回 {currency: last}
+        '''
+        res = {}
+        symbol_dict = {}
+        for currency in currency_list:
+            if currency.upper()=='USDT':
+                res[currency] = 1
+            else:
+                symbol_dict[f'{currency.upper()}/USDT'] = currency
+        if symbol_dict:
+            tickers = self.exchange.fetch_tickers(list(symbol_dict))
+            for symbol, currency in symbol_dict.items():
+                if symbol in tickers:
+                    res[currency] = tickers[symbol]['last']
+        return res
+
+    def load_markets(self):
+        #markets加载后缓存在exchange实例上, 长期复用的实例只加载一次
+        return self.exchange.load_markets()
+
     def fetch_ohlcv(self, symbol, timeframe='1h', since=None, limit=None, params={}):
         # [1675210740000, 23083.46, 23083.99, 23067.37, 23075.56, 124.87217]
         # [t,o,h,l,c,v]
@@ -112,5 +112,8 @@ ETHERSCAN_API_KEYS = [
 ]
 '''
 
+#只读副本host, 空的话所有查询走主库, 在my_private_conf里覆盖
+DB_REPLICA_HOSTS = []
+
 from abi_conf import *
 from my_private_conf import *
@@ -0,0 +1,126 @@
+import threading
+import time
+
+from local_util import redis_obj
+
+NONCE_KEY = 'nonce:{chain_id}:{address}'
+NONCE_EX = 60*60*24
+#本地分配的nonce比链上已确认的多出这么多, 认为中间有空洞, 重新同步
+NONCE_MAX_GAP = 64
+#本地已经分配到pending之后, 链上已确认nonce这么久没动, 说明中间有交易被丢掉了(underpriced/被挤出), 重新同步补上
+NONCE_STALL_SECONDS = 120
+
+#key不存在且没有传链上nonce时返回nil, 由调用方取链上nonce再调一次
+#传了链上pending nonce时, 取本地计数和链上的较大值, 别的账户管理工具发过交易也不会冲突
+NONCE_ALLOCATE_LUA = '''
+local v = redis.call('GET', KEYS[1])
+if ARGV[1] ~= '' then
+    local floor = tonumber(ARGV[1])
+    if (not v) or tonumber(v) < floor then v = floor end
+elseif not v then
+    return nil
+end
+v = tonumber(v)
+redis.call('SET', KEYS[1], v + 1, 'EX', ARGV[2])
+return v
+'''
+
+#刚分配的nonce没发出去, 后面也没人再分配, 直接退回
+NONCE_RELEASE_LUA = '''
+local v = redis.call('GET', KEYS[1])
+if v and tonumber(v) == tonumber(ARGV[1]) + 1 then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+return 0
+'''
+
+
+class NonceManager(object):
+    '''
+        每个(chain_id, 地址)一个redis计数器, 多进程共享, 本地连续分配nonce
+        不再等上一笔交易确认, 同一条链可以同时有多笔fill在pending
+        发送失败时退回nonce, 退不回(后面已经分配过)就删掉计数器, 下次从链上重新同步
+    '''
+    def __init__(self, redis=None, max_gap=NONCE_MAX_GAP, ex=NONCE_EX, stall_seconds=NONCE_STALL_SECONDS):
+        self.redis = redis
+        self.max_gap = max_gap
+        self.ex = ex
+        self.stall_seconds = stall_seconds
+        #key: (最近看到的已确认nonce, 从什么时候开始没变)
+        self._confirmed = {}
+        self._lock = threading.Lock()
+
+    def get_key(self, chain_id, address):
+        return NONCE_KEY.format(chain_id=int(chain_id), address=address.lower())
+
+    def _allocate(self, key, floor=None):
+        res = self.redis.eval(NONCE_ALLOCATE_LUA, keys=[key], args=['' if floor is None else int(floor), self.ex])
+        return None if res is None else int(res)
+
+    def is_stalled(self, key, nonce, confirmed_nonce, pending_nonce):
+        '''
+            分配的nonce超过节点的pending nonce(中间有空洞, 后面的交易都卡在queue里), 且已确认nonce很久没动
+        '''
+        now = time.time()
+        with self._lock:
+            last = self._confirmed.get(key)
+            if not last or last[0] != confirmed_nonce:
+                self._confirmed[key] = (confirmed_nonce, now)
+                return False
+            return nonce > pending_nonce and now - last[1] > self.stall_seconds
+
+    def allocate(self, w3, chain_id, address, chain_state=None):
+        '''
+            chain_state: get_chain_state批量预取的nonce_latest/nonce_pending, 有的话顺便检查空洞和卡住
+        '''
+        key = self.get_key(chain_id, address)
+        chain_state = chain_state or {}
+        nonce = self._allocate(key, chain_state.get('nonce_pending'))
+        if nonce is None:
+            nonce = self._allocate(key, w3.eth.get_transaction_count(address, 'pending'))
+            print(f"🔄 nonce从链上同步: Chain {chain_id} {address} -> {nonce}")
+        confirmed_nonce = chain_state.get('nonce_latest')
+        pending_nonce = chain_state.get('nonce_pending')
+        if confirmed_nonce is not None and nonce - confirmed_nonce > self.max_gap:
+            print(f"⚠️ nonce空洞: 分配={nonce}, 已确认={confirmed_nonce}, 重新同步")
+            self.resync(chain_id, address)
+            nonce = self._allocate(key, w3.eth.get_transaction_count(address, 'pending'))
+        elif confirmed_nonce is not None and pending_nonce is not None \
+                and self.is_stalled(key, nonce, confirmed_nonce, pending_nonce):
+            print(f"⚠️ nonce卡住: 分配={nonce}, pending={pending_nonce}, 已确认={confirmed_nonce} "
+                  f"超过{self.stall_seconds}s没动, 从pending重新分配")
+            self.resync(chain_id, address)
+            with self._lock:
+                self._confirmed.pop(key, None)
+            nonce = self._allocate(key, pending_nonce)
+        print(f"📊 分配nonce: Chain {chain_id} {address} -> {nonce}")
+        return nonce
+
+    def release(self, chain_id, address, nonce):
+        '''
+            nonce没用掉(发送失败), 能退回就退回, 否则重新同步
+        '''
+        key = self.get_key(chain_id, address)
+        if self.redis.eval(NONCE_RELEASE_LUA, keys=[key], args=[int(nonce), self.ex]):
+            print(f"↩️ 退回nonce: Chain {chain_id} {address} {nonce}")
+            return True
+        self.resync(chain_id, address)
+        return False
+
+    def handle_send_error(self, chain_id, address, nonce, error_message):
+        '''
+            发送失败时根据错误处理nonce: already known说明nonce已经用掉, nonce too low说明计数器落后了
+        '''
+        if 'already known' in error_message:
+            return None
+        if 'nonce too low' in error_message:
+            return self.resync(chain_id, address)
+        return self.release(chain_id, address, nonce)
+
+    def resync(self, chain_id, address):
+        print(f"🔄 nonce计数器重置: Chain {chain_id} {address}")
+        return self.redis.delete(self.get_key(chain_id, address))
+
+
+nonce_manager = NonceManager(redis=redis_obj)
@@ -1,8 +1,26 @@
+import random
+import threading
+import time
+import uuid
+
 import psycopg2.extras
 from psycopg2.pool import ThreadedConnectionPool
 from contextlib import contextmanager
 # from loguru import logger
 
+#副本落后超过这个秒数不再读, 退回主库
+REPLICA_MAX_LAG = 5
+REPLICA_LAG_CHECK_INTERVAL = 5
+#写过之后这个线程的读在这段时间内走主库, 保证读到自己的写入
+REPLICA_STICKY_SECONDS = 10
+#副本连不上时尽快失败退回主库, 不要卡在默认的tcp超时上
+REPLICA_CONNECT_TIMEOUT = 3
+#wal已经全部回放时延迟算0, 否则主库空闲时replay时间戳也会一直变旧
+REPLICA_LAG_SQL = '''
+    select case when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+        else coalesce(extract(epoch from now() - pg_last_xact_replay_timestamp()), 0) end as lag
+'''
+
 @contextmanager
 def get_conn(self):
     try:
@@ -14,30 +32,218 @@ def get_conn(self):
     finally:
         self.putconn(conn)
 
+@contextmanager
+def get_read_conn(pool):
+    '''
+        读连接是autocommit的, 不用with conn开事务, 查完不用commit
+    '''
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+
+class PreparedConnection(psycopg2.extensions.connection):
+    '''
+        记录这个连接上已经PREPARE过的语句, prepared statement是会话级的
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class ReadOnlyConnection(PreparedConnection):
+    '''
+        只读 + autocommit, SELECT不再有BEGIN/COMMIT的往返
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_session(readonly=True, autocommit=True)
+
+
+class ReplicaPool(object):
+    '''
+        一个只读副本的连接池, 定期查复制延迟
+    '''
+    def __init__(self, conn_kwargs, max_lag=REPLICA_MAX_LAG):
+        self.host = conn_kwargs['host']
+        self.max_lag = max_lag
+        #minconn=0, 副本连不上不影响启动, 检查延迟失败时读退回主库
+        self.pool = ThreadedConnectionPool(
+                minconn=0,
+                maxconn=50,
+                connection_factory=ReadOnlyConnection,
+                **conn_kwargs
+            )
+        self.lag = None
+        self.checked = 0
+        self._lock = threading.Lock()
+
+    def check_lag(self):
+        with get_read_conn(self.pool) as conn:
+            cur = conn.cursor()
+            cur.execute(REPLICA_LAG_SQL)
+            return float(cur.fetchone()[0])
+
+    def is_healthy(self):
+        if time.time() - self.checked > REPLICA_LAG_CHECK_INTERVAL and self._lock.acquire(blocking=False):
+            try:
+                self.lag = self.check_lag()
+            except Exception as e:
+                print(f"⚠️ replica {self.host} 检查延迟失败: {e}")
+                self.lag = None
+            finally:
+                self.checked = time.time()
+                self._lock.release()
+        return self.lag is not None and self.lag <= self.max_lag
+
+    def mark_unhealthy(self, error):
+        '''
+            读副本时连接出错, 到下次检查延迟之前不再读它
+        '''
+        print(f"⚠️ replica {self.host} 读失败, 退回主库: {error}")
+        self.lag = None
+        self.checked = time.time()
+
+
 class Postgresql(object):
     """docstring for postgresql"""
-    def __init__(self,host,db,user,pwd,port=5432):
+    def __init__(self,host,db,user,pwd,port=5432,replica_hosts=None,max_replica_lag=REPLICA_MAX_LAG):
+        self._conn_kwargs = {
+            'host': host,
+            'database': db,
+            'user': user,
+            'password': pwd,
+            'port': port,
+        }
         self._pool = ThreadedConnectionPool(
                 minconn=1,
                 maxconn=100,
-                host=host,
-                database=db,
-                user=user,
-                password=pwd,
-                port=port
+                connection_factory=PreparedConnection,
+                **self._conn_kwargs
+            )
+        #主库上的读单独一个只读autocommit连接池, 写连接池不受影响
+        self._read_pool = ThreadedConnectionPool(
+                minconn=0,
+                maxconn=50,
+                connection_factory=ReadOnlyConnection,
+                **self._conn_kwargs
             )
+        #读默认走副本, 写/粘主库/副本都延迟太大时走主库
+        self._replicas = [ReplicaPool(dict(self._conn_kwargs, host=i, connect_timeout=REPLICA_CONNECT_TIMEOUT),
+                                max_lag=max_replica_lag) for i in replica_hosts or []]
+        self._local = threading.local()
+        #name: (sql, 参数个数), sql里用$1,$2..., 每个连接第一次用到时PREPARE
+        self._statements = {}
 
-    def query(self, sql):
-        with get_conn(self._pool) as conn:
-            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cur.execute(sql)
-            conn.commit()
+    @contextmanager
+    def use_primary(self):
+        '''
+            with pg_obj.use_primary(): 里面这个线程的读都走主库, fill流程用, 读到刚写的数据
+        '''
+        depth = getattr(self._local, 'primary_depth', 0)
+        self._local.primary_depth = depth + 1
+        try:
+            yield self
+        finally:
+            self._local.primary_depth = depth
+
+    def mark_write(self):
+        self._local.last_write = time.time()
+
+    def get_read_replica(self, primary=False):
+        '''
+            返回这次读要用的ReplicaPool, 读主库时返回None
+        '''
+        if primary or not self._replicas or getattr(self._local, 'primary_depth', 0):
+            return None
+        if time.time() - getattr(self._local, 'last_write', 0) < REPLICA_STICKY_SECONDS:
+            return None
+        replicas = [i for i in self._replicas if i.is_healthy()]
+        if not replicas:
+            return None
+        return random.choice(replicas)
+
+    def read(self, func, primary=False):
+        '''
+            func(conn)在读连接上执行, 副本连接出错时标记副本不可用, 在主库上重试一次
+        '''
+        replica = self.get_read_replica(primary=primary)
+        if replica is not None:
+            try:
+                with get_read_conn(replica.pool) as conn:
+                    return func(conn)
+            except psycopg2.OperationalError as e:
+                replica.mark_unhealthy(e)
+        with get_read_conn(self._read_pool) as conn:
+            return func(conn)
+
+    def connect(self, autocommit=True):
+        '''
+            独立连接, 不走连接池, 给LISTEN这类长期占用连接的场景用
+        '''
+        conn = psycopg2.connect(**self._conn_kwargs)
+        conn.autocommit = autocommit
+        return conn
+
+    def query(self, sql, params=None, primary=False, as_tuple=False):
+        '''
+            params: sql里用%s占位, 值由驱动转义, 不要自己拼进sql
+            primary: 强制读主库
+            as_tuple: 返回tuple, 不给每行建dict, 内部的热点查询用
+        '''
+        def func(conn):
+            cur = conn.cursor(cursor_factory=None if as_tuple else psycopg2.extras.RealDictCursor)
+            cur.execute(sql, params)
             return cur.fetchall()
+        return self.read(func, primary=primary)
+
+    def iter_query(self, sql, params=None, chunk_size=2000, primary=False, as_tuple=False):
+        '''
+            服务端命名游标, 每次取chunk_size行, 按块yield, 导出/回填大结果集用, 内存只占一块
+            副本在第一块之前出错时退回主库, 已经yield过的不能重来, 直接抛出
+        '''
+        replica = self.get_read_replica(primary=primary)
+        if replica is not None:
+            chunks = self._iter_query(replica.pool, sql, params, chunk_size, as_tuple)
+            try:
+                first = next(chunks, None)
+            except psycopg2.OperationalError as e:
+                replica.mark_unhealthy(e)
+            else:
+                if first is not None:
+                    yield first
+                    yield from chunks
+                return
+        yield from self._iter_query(self._read_pool, sql, params, chunk_size, as_tuple)
 
-    def execute(self, sql, return_id=False):
+    def _iter_query(self, pool, sql, params, chunk_size, as_tuple):
+        '''
+            命名游标要在事务里, 用完回滚再恢复autocommit
+        '''
+        with get_read_conn(pool) as conn:
+            conn.autocommit = False
+            try:
+                cur = conn.cursor(name=f'iter_{uuid.uuid4().hex}',
+                            cursor_factory=None if as_tuple else psycopg2.extras.RealDictCursor)
+                cur.itersize = chunk_size
+                cur.execute(sql, params)
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+                cur.close()
+            finally:
+                if not conn.closed:
+                    conn.rollback()
+                    conn.autocommit = True
+
+    def execute(self, sql, params=None, return_id=False):
+        self.mark_write()
         with get_conn(self._pool) as conn:
             cur = conn.cursor()
-            cur.execute(sql)
+            cur.execute(sql, params)
             conn.commit()
             if return_id:
                 res = cur.fetchone()[0]
@@ -46,37 +252,94 @@ class Postgresql(object):
                 res = cur.rowcount
             return res
 
+    def prepare(self, name, sql, param_count):
+        '''
+            注册热点查询, 例如 prepare('txline_by_hash', 'select * from txline where tx_hash = $1', 1)
+            服务端只解析和生成一次计划, 之后每次只传参数
+        '''
+        self._statements[name] = (sql, param_count)
+
+    def query_prepared(self, name, params=(), primary=False, as_tuple=False):
+        sql, param_count = self._statements[name]
+        if len(params) != param_count:
+            raise ValueError(f"{name} 需要 {param_count} 个参数, 传了 {len(params)} 个")
+        def func(conn):
+            cur = conn.cursor(cursor_factory=None if as_tuple else psycopg2.extras.RealDictCursor)
+            if name not in conn.prepared:
+                cur.execute(f'PREPARE {name} AS {sql}')
+                conn.prepared.add(name)
+            if params:
+                cur.execute(f"EXECUTE {name} ({','.join(['%s'] * len(params))})", params)
+            else:
+                cur.execute(f'EXECUTE {name}')
+            return cur.fetchall()
+        return self.read(func, primary=primary)
+
     def insert(self, table, tdict, return_id=False):
-        column = ''
-        value = ''
-        for key in tdict:
-            # print(key,tdict[key])
-            column += ',' + key
-            value += "','" + str(tdict[key])
-        column = column[1:]
-        value = value[2:] + "'"
+        column = ','.join(tdict)
+        value = ','.join(['%s'] * len(tdict))
         sql = "insert into %s(%s) values(%s)" % (table, column, value)
         print(sql)
         if return_id:
             sql = sql + ' RETURNING id;'
         # print(sql)
         # logging.info('insert sql: %s' % sql)
-        return self.execute(sql,return_id=return_id)
+        return self.execute(sql,params=[tdict[key] for key in tdict],return_id=return_id)
+
+    def insert_many(self, table, tdicts, conflict=None, returning='id', page_size=1000, fill_null=None):
+        '''
+            多行一条insert(execute_values), 列不一样的按列分组, 每组一条, 同一个事务
+            conflict: 唯一约束的列, 冲突的行跳过(ON CONFLICT DO NOTHING)
+            fill_null: 冲突时这些列只在已有行是null时补上新值, 例如先写入的fill单后补txl_related_id
+            返回实际插入/补值的行的returning列, 例如 [{'id': 1}]
+        '''
+        groups = {}
+        for tdict in tdicts:
+            groups.setdefault(tuple(tdict), []).append(tdict)
+        res = []
+        self.mark_write()
+        with get_conn(self._pool) as conn:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            for columns, rows in groups.items():
+                sql = "insert into %s(%s) values %%s" % (table, ','.join(columns))
+                fill_columns = [i for i in fill_null or [] if i in columns]
+                if conflict and fill_columns:
+                    sql += " on conflict (%s) do update set %s where %s" % (conflict,
+                                ','.join('%s=coalesce(%s.%s,EXCLUDED.%s)' % (i, table, i, i) for i in fill_columns),
+                                ' or '.join('(%s.%s is null and EXCLUDED.%s is not null)' % (table, i, i) for i in fill_columns))
+                elif conflict:
+                    sql += " on conflict (%s) do nothing" % conflict
+                sql += " returning %s" % returning
+                res += psycopg2.extras.execute_values(cur, sql, [[i[k] for k in columns] for i in rows],
+                                page_size=page_size, fetch=True)
+            conn.commit()
+        print(f"insert_many {table}: {len(tdicts)} rows, inserted/filled {len(res)}")
+        return res
+
+    def upsert(self, table, tdict, conflict):
+        '''
+            conflict: 唯一约束的列, 冲突时用新值覆盖, None的列不写
+        '''
+        tdict = {k: v for k, v in tdict.items() if v is not None}
+        column = ','.join(tdict)
+        value = ','.join(['%s'] * len(tdict))
+        update_value = ','.join('%s=EXCLUDED.%s' % (k, k) for k in tdict if k != conflict)
+        sql = "insert into %s(%s) values(%s) on conflict (%s) do update set %s" % (
+                    table, column, value, conflict, update_value)
+        return self.execute(sql, params=list(tdict.values()))
 
-    def update(self, table, tdict, condition=''):
+    def update(self, table, tdict, condition='', params=None):
+        '''
+            condition里的值用%s占位, 放在params里
+        '''
         if not condition:
             # logging.info("must have update condition")
             return
         else:
             condition = 'where ' + condition
-        value = ''
-        for key in tdict:
-            value += ",%s='%s'" % (key, tdict[key])
-        value = value[1:]
+        value = ','.join("%s=%%s" % key for key in tdict)
         sql = "update %s set %s %s" % (table, value, condition)
         print(condition,sql)
         # logging.info('update sql: %s'%sql)
         # logging.info('success update sql: %s' % sql)
-        return self.execute(sql)
-
-
+        return self.execute(sql, params=[tdict[key] for key in tdict] + list(params or []))
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import threading
+import time
+
+from local_util import redis_obj
+from util import SingleFlight
+from data_util import get_exchange,set_tmp_prices
+
+PRICE_KEY = 'price:{currency}'
+#get_price默认能接受的最大延迟
+PRICE_MAX_AGE = 60
+PRICE_EX = 60*2
+#ws不可用时REST轮询的间隔
+PRICE_POLL_INTERVAL = 2
+#写redis的最小间隔, ws推送很频繁
+PRICE_PUBLISH_INTERVAL = 1
+PRICE_CURRENCIES = ['BTC','ETH','POL','BNB']
+
+
+class PriceStore(object):
+    '''
+        进程内最新价格, 带时间戳和来源(ws/rest/redis)
+    '''
+    def __init__(self):
+        self._prices = {}
+
+    def set(self, currency, price, timestamp=None, source=''):
+        price_dict = {
+            'price': str(price),
+            'timestamp': timestamp or time.time(),
+            'source': source,
+        }
+        self._prices[currency.upper()] = price_dict
+        return price_dict
+
+    def get(self, currency, max_age=PRICE_MAX_AGE):
+        price_dict = self._prices.get(currency.upper())
+        if price_dict and time.time() - price_dict['timestamp'] <= max_age:
+            return price_dict
+        return None
+
+    def items(self):
+        return list(self._prices.items())
+
+
+price_store = PriceStore()
+_price_single_flight = SingleFlight()
+
+
+def publish_prices(price_dicts):
+    '''
+        price_dicts: {currency: {'price','timestamp','source'}}
+        带时间戳的json给get_price判断新鲜度, 旧的{currency}:price也一起写, 兼容老代码
+    '''
+    pipe_dict = {PRICE_KEY.format(currency=k.upper()): json.dumps(v) for k, v in price_dicts.items()}
+    redis_obj.set_many(pipe_dict, ex=PRICE_EX)
+    return set_tmp_prices({k: v['price'] for k, v in price_dicts.items()})
+
+def get_redis_price(currency):
+    res = redis_obj.get(PRICE_KEY.format(currency=currency.upper()))
+    return json.loads(res) if res else None
+
+def fetch_price(currency, max_age=PRICE_MAX_AGE):
+    #等锁期间可能已经有别的请求取到了
+    price_dict = price_store.get(currency, max_age=max_age)
+    if price_dict:
+        return price_dict
+    price = get_exchange().fetch_symbol_last_price(currency=currency)
+    #刚取到的价格直接返回, 不再按max_age读回来, max_age=0时读回来是None
+    price_dict = price_store.set(currency, price, source='rest')
+    publish_prices({currency: price_dict})
+    return price_dict
+
+def get_price_dict(currency, max_age=PRICE_MAX_AGE):
+    '''
+        内存 -> redis -> 交易所, 交易所请求按币种合并, 并发的miss只请求一次
+    '''
+    price_dict = price_store.get(currency, max_age=max_age)
+    if price_dict:
+        return price_dict
+    price_dict = get_redis_price(currency)
+    if price_dict and time.time() - price_dict['timestamp'] <= max_age:
+        price_store.set(currency, price_dict['price'], timestamp=price_dict['timestamp'], source='redis')
+        return price_dict
+    price_dict, _ = _price_single_flight.do(currency.upper(), lambda: fetch_price(currency, max_age=max_age),
+                            timeout=15)
+    return price_dict
+
+
+class PriceFeed(threading.Thread):
+    '''
+        订阅交易所ticker, 价格写到内存和redis
+        优先ccxt.pro的websocket, 没有安装或者连续出错时退回REST轮询
+    '''
+    def __init__(self, currency_list=PRICE_CURRENCIES, poll_interval=PRICE_POLL_INTERVAL, use_ws=True):
+        super().__init__(name='price_feed', daemon=True)
+        self.currency_list = [i.upper() for i in currency_list]
+        self.poll_interval = poll_interval
+        self.use_ws = use_ws
+        self.last_publish = 0
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def on_prices(self, prices, source, timestamps=None):
+        for currency, price in prices.items():
+            if price is not None:
+                price_store.set(currency, price, timestamp=(timestamps or {}).get(currency), source=source)
+        if time.time() - self.last_publish >= PRICE_PUBLISH_INTERVAL:
+            self.last_publish = time.time()
+            publish_prices({k: v for k, v in price_store.items() if k in self.currency_list})
+
+    async def watch_ws(self):
+        import ccxt.pro
+        exchange = ccxt.pro.binance()
+        symbol_dict = {f'{i}/USDT': i for i in self.currency_list if i != 'USDT'}
+        errors = 0
+        try:
+            while not self._stop_event.is_set() and errors < 5:
+                try:
+                    tickers = await exchange.watch_tickers(list(symbol_dict))
+                    errors = 0
+                except Exception as e:
+                    errors += 1
+                    print(f"⚠️ price ws error({errors}): {e}")
+                    await asyncio.sleep(1)
+                    continue
+                prices = {symbol_dict[k]: v['last'] for k, v in tickers.items() if k in symbol_dict}
+                #ticker时间是毫秒
+                timestamps = {symbol_dict[k]: v['timestamp'] / 1000 for k, v in tickers.items()
+                                if k in symbol_dict and v.get('timestamp')}
+                self.on_prices(prices, 'ws', timestamps=timestamps)
+        finally:
+            await exchange.close()
+
+    def poll_rest(self):
+        while not self._stop_event.is_set():
+            try:
+                self.on_prices(get_exchange().fetch_currency_last_prices(self.currency_list), 'rest')
+            except Exception as e:
+                print(f"⚠️ price poll error: {e}")
+            self._stop_event.wait(self.poll_interval)
+
+    def run(self):
+        if self.use_ws:
+            try:
+                asyncio.run(self.watch_ws())
+            except Exception as e:
+                print(f"⚠️ price ws不可用, 改用REST轮询: {e}")
+        self.poll_rest()
+
+
+_price_feed = None
+_price_feed_lock = threading.Lock()
+
+def start_price_feed(currency_list=PRICE_CURRENCIES, use_ws=True):
+    '''
+        每个进程起一个, 重复调用只会起一个
+    '''
+    global _price_feed
+    with _price_feed_lock:
+        if _price_feed is None or not _price_feed.is_alive():
+            _price_feed = PriceFeed(currency_list=currency_list, use_ws=use_ws)
+            _price_feed.start()
+    return _price_feed
@@ -0,0 +1,114 @@
+import json
+import os
+import socket
+import threading
+import time
+
+from local_util import redis_obj
+
+FILL_STREAM = 'fill_jobs'
+FILL_GROUP = 'fill_workers'
+FILL_DEAD_STREAM = 'fill_jobs_dead'
+#重试任务 score为到期时间
+FILL_RETRY_KEY = 'fill_jobs_retry'
+FILL_STREAM_MAXLEN = 100000
+FILL_MAX_ATTEMPTS = 5
+FILL_RETRY_BASE = 2
+FILL_RETRY_MAX = 300
+#消费者挂了(部署重启), 超过这个时间没ack的消息由其他消费者认领
+FILL_CLAIM_IDLE = 60*1000
+FILL_BLOCK = 5*1000
+
+#ARGV[1]: zset里的任务, ARGV[2]: maxlen, 后面是stream的field/value
+RETRY_MOVE_LUA = '''
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*', unpack(ARGV, 3))
+    return 1
+end
+return 0
+'''
+
+
+def enqueue_job(payload, attempt=0, stream=FILL_STREAM, **fields):
+    job = {'payload': json.dumps(payload), 'attempt': attempt, 'enqueue_time': time.time()}
+    job.update(fields)
+    return redis_obj.xadd(stream, job, maxlen=FILL_STREAM_MAXLEN)
+
+def get_retry_delay(attempt):
+    return min(FILL_RETRY_BASE * 2 ** attempt, FILL_RETRY_MAX)
+
+def move_due_retries(stream=FILL_STREAM, retry_key=FILL_RETRY_KEY):
+    '''
+        到期的重试任务放回stream, zrem成功的那个进程才放, 多个worker不会重复
+        zrem和xadd在一个lua里, 中途挂掉不会丢任务
+    '''
+    res = 0
+    for job in redis_obj.zrangebyscore(retry_key, 0, time.time()):
+        fields = [str(i) for kv in json.loads(job).items() for i in kv]
+        res += redis_obj.eval(RETRY_MOVE_LUA, keys=[retry_key, stream], args=[job, FILL_STREAM_MAXLEN] + fields)
+    return res
+
+
+class JobWorker(threading.Thread):
+    '''
+        redis stream消费组的一个消费者, 处理完才ack
+        handler抛异常按指数退避重试, 超过次数进死信stream
+    '''
+    def __init__(self, handler, consumer=None, stream=FILL_STREAM, group=FILL_GROUP,
+                    dead_stream=FILL_DEAD_STREAM, retry_key=FILL_RETRY_KEY,
+                    max_attempts=FILL_MAX_ATTEMPTS, count=1):
+        consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+        super().__init__(name=f'job_worker_{consumer}', daemon=True)
+        self.handler = handler
+        self.consumer = consumer
+        self.stream = stream
+        self.group = group
+        self.dead_stream = dead_stream
+        self.retry_key = retry_key
+        self.max_attempts = max_attempts
+        self.count = count
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def handle(self, message_id, job):
+        attempt = int(job.get('attempt', 0))
+        try:
+            self.handler(json.loads(job['payload']))
+        except Exception as e:
+            print(f"❌ job失败: {message_id} attempt={attempt} {e}")
+            job = dict(job, attempt=attempt + 1, error=str(e)[:500])
+            if attempt + 1 >= self.max_attempts:
+                print(f"💀 job进入死信: {message_id}")
+                redis_obj.xadd(self.dead_stream, dict(job, message_id=message_id), maxlen=FILL_STREAM_MAXLEN)
+            else:
+                delay = get_retry_delay(attempt)
+                print(f"🔁 job {delay}s后重试: {message_id}")
+                redis_obj.zadd(self.retry_key, {json.dumps(job): time.time() + delay})
+        #失败的也已经转到重试/死信, 都ack
+        redis_obj.xack(self.stream, self.group, message_id)
+
+    def poll_once(self):
+        move_due_retries(stream=self.stream, retry_key=self.retry_key)
+        #先处理别的消费者挂掉留下的消息
+        _, messages, *_ = redis_obj.xautoclaim(self.stream, self.group, self.consumer,
+                                FILL_CLAIM_IDLE, count=self.count)
+        if not messages:
+            res = redis_obj.xreadgroup(self.group, self.consumer, {self.stream: '>'},
+                                count=self.count, block=FILL_BLOCK)
+            messages = res[0][1] if res else []
+        for message_id, job in messages:
+            #xautoclaim会带回已经被删掉的消息
+            if job:
+                self.handle(message_id, job)
+        return len(messages)
+
+    def run(self):
+        redis_obj.xgroup_create(self.stream, self.group)
+        while not self._stop_event.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"⚠️ job worker {self.consumer} error: {e}")
+                time.sleep(1)
@@ -0,0 +1,152 @@
+import json
+import threading
+import time
+
+from eth_utils import add_0x_prefix
+from psycopg2.errors import UniqueViolation
+
+from local_util import redis_obj,get_w3,str_to_int
+from data_util import create_fill_txl
+from lease_util import fill_lease_manager
+
+RECEIPT_TRACKER_KEY = 'receipt_tracker:{chain_id}'
+RECEIPT_POLL_INTERVAL = 1
+#超过这个时间还没上链(被节点丢掉了), 不再跟踪
+RECEIPT_MAX_AGE = 60*30
+#已上链但一直写不进txline的, 重试这么多次后移到死信hash, 不再每个区块都查
+RECEIPT_MAX_ATTEMPTS = 20
+RECEIPT_DEAD_KEY = 'receipt_tracker_dead:{chain_id}'
+
+
+def track_tx(chain_id, tx_hash, txl_related_id=None, deposit_hash=None):
+    '''
+        广播后登记, receipt由cron_receipt_tracker批量取回写入txline
+        txl_related_id: deposit单的txline id
+        deposit_hash: 交易失败或超时未上链时清掉这笔deposit的fill完成标记
+    '''
+    tx_hash = add_0x_prefix(tx_hash)
+    value = json.dumps({'txl_related_id': txl_related_id, 'deposit_hash': deposit_hash, 'track_time': time.time()})
+    return redis_obj.hset(RECEIPT_TRACKER_KEY.format(chain_id=int(chain_id)), tx_hash, value)
+
+def get_tracked_txs(chain_id):
+    res = redis_obj.hgetall(RECEIPT_TRACKER_KEY.format(chain_id=int(chain_id)))
+    return {k: json.loads(v) for k, v in res.items()}
+
+def untrack_tx(chain_id, tx_hash):
+    return redis_obj.hdel(RECEIPT_TRACKER_KEY.format(chain_id=int(chain_id)), tx_hash)
+
+def retry_or_dead(chain_id, tx_hash, tracked_tx, error):
+    '''
+        写txline失败次数+1, 超过RECEIPT_MAX_ATTEMPTS移到死信hash, 人工处理
+    '''
+    tracked_tx = dict(tracked_tx, attempts=tracked_tx.get('attempts', 0) + 1, error=str(error)[:500])
+    if tracked_tx['attempts'] >= RECEIPT_MAX_ATTEMPTS:
+        print(f"💀 create_fill_txl失败{tracked_tx['attempts']}次, 移到死信: Chain {chain_id} {tx_hash}")
+        redis_obj.hset(RECEIPT_DEAD_KEY.format(chain_id=int(chain_id)), tx_hash, json.dumps(tracked_tx))
+        return untrack_tx(chain_id, tx_hash)
+    return redis_obj.hset(RECEIPT_TRACKER_KEY.format(chain_id=int(chain_id)), tx_hash, json.dumps(tracked_tx))
+
+def clear_fill_lease(tracked_tx, tx_hash):
+    '''
+        fill没成功, 删掉完成标记, 重复推送/cron可以重新fill, 已经填充的会在链上检查时跳过
+    '''
+    if tracked_tx.get('deposit_hash'):
+        fill_lease_manager.clear(tracked_tx['deposit_hash'], tx_hash)
+
+def get_rpc_batch(w3, batch_requests):
+    '''
+        直接发json-rpc batch, 返回原始结果(十六进制字符串), 和etherscan proxy接口格式一样
+        没上链的receipt是null, 不会像w3.eth.get_transaction_receipt一样抛异常让整个batch失败
+    '''
+    if not batch_requests:
+        return []
+    response = w3.provider.make_batch_request(batch_requests)
+    if not isinstance(response, list):
+        raise Exception(f"rpc batch error: {response}")
+    return [i.get('result') for i in response]
+
+def poll_receipts(chain_id, w3=None):
+    '''
+        一个batch取所有跟踪中的交易的receipt和交易, 上链的写入txline
+    '''
+    tracked_txs = get_tracked_txs(chain_id)
+    if not tracked_txs:
+        return []
+    w3 = w3 or get_w3(chain_id=chain_id)
+    tx_hashes = list(tracked_txs)
+    batch_requests = []
+    for tx_hash in tx_hashes:
+        batch_requests.append(('eth_getTransactionReceipt', [tx_hash]))
+        batch_requests.append(('eth_getTransactionByHash', [tx_hash]))
+    results = get_rpc_batch(w3, batch_requests)
+    mined = []
+    for index, tx_hash in enumerate(tx_hashes):
+        tx_receipt_dict, tx_dict = results[index*2], results[index*2+1]
+        if tx_receipt_dict and tx_dict:
+            mined.append((tx_hash, tx_dict, tx_receipt_dict))
+        elif time.time() - tracked_txs[tx_hash]['track_time'] > RECEIPT_MAX_AGE:
+            print(f"⏰ 交易超时未上链, 停止跟踪: Chain {chain_id} {tx_hash}")
+            clear_fill_lease(tracked_txs[tx_hash], tx_hash)
+            untrack_tx(chain_id, tx_hash)
+    if not mined:
+        return []
+
+    #节点的receipt一般没有blockTimestamp, 同一个batch取区块时间
+    block_numbers = list(dict.fromkeys(i[2]['blockNumber'] for i in mined))
+    blocks = get_rpc_batch(w3, [('eth_getBlockByNumber', [i, False]) for i in block_numbers])
+    block_timestamps = {k: v['timestamp'] for k, v in zip(block_numbers, blocks) if v}
+
+    res = []
+    for tx_hash, tx_dict, tx_receipt_dict in mined:
+        print(f"✅ 交易上链: Chain {chain_id} {tx_hash}, 状态: {str_to_int(tx_receipt_dict['status'])}")
+        try:
+            create_fill_txl(chain_id, tx_dict, tx_receipt_dict,
+                    txl_related_id=tracked_txs[tx_hash]['txl_related_id'],
+                    block_timestamp=block_timestamps.get(tx_receipt_dict['blockNumber']))
+        except UniqueViolation:
+            #已经写过了(etherscan cron等其他路径), 不用再跟踪
+            print(f"⚠️ txline已存在: {tx_hash}")
+        except Exception as e:
+            #deposit单还没入库/数据库临时错误等, 继续跟踪, 下次轮询重试, 不影响其他交易
+            print(f"❌ create_fill_txl失败, 下次重试: {tx_hash} {e}")
+            retry_or_dead(chain_id, tx_hash, tracked_txs[tx_hash], e)
+            continue
+        if str_to_int(tx_receipt_dict['status']) == 0:
+            clear_fill_lease(tracked_txs[tx_hash], tx_hash)
+        untrack_tx(chain_id, tx_hash)
+        res.append(tx_hash)
+    return res
+
+
+class ReceiptTracker(threading.Thread):
+    '''
+        一条链一个线程, 每出一个新区块批量查一次receipt
+    '''
+    def __init__(self, chain_id, poll_interval=RECEIPT_POLL_INTERVAL):
+        super().__init__(name=f'receipt_tracker_{chain_id}', daemon=True)
+        self.chain_id = int(chain_id)
+        self.poll_interval = poll_interval
+        self.block_number = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def poll_once(self):
+        if not redis_obj.hlen(RECEIPT_TRACKER_KEY.format(chain_id=self.chain_id)):
+            return []
+        w3 = get_w3(chain_id=self.chain_id)
+        block_number = w3.eth.block_number
+        if block_number == self.block_number:
+            return []
+        res = poll_receipts(self.chain_id, w3=w3)
+        self.block_number = block_number
+        return res
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"⚠️ receipt tracker {self.chain_id} error: {e}")
+            self._stop_event.wait(self.poll_interval)
@@ -92,6 +92,9 @@ class Redis(object):
     def hgetall(self,key):
         return self.r.hgetall(key)
 
+    def hlen(self,key):
+        return self.r.hlen(key)
+
     def hvals(self,key):
         return self.r.hvals(key)      
 
@@ -117,4 +120,40 @@ class Redis(object):
     
     """ 将 key 所储存的值加上增量 increment """
     def incrby(self, key, increment):
-        return self.r.incrby(key, increment)
\ No newline at end of file
+        return self.r.incrby(key, increment)
+
+    """ 执行lua脚本, 脚本内的多条命令原子执行 """
+    def eval(self, script, keys=None, args=None):
+        keys = keys or []
+        return self.r.eval(script, len(keys), *keys, *(args or []))
+
+    """ stream 追加消息, maxlen近似裁剪 """
+    def xadd(self, key, fields, maxlen=None):
+        return self.r.xadd(key, fields, maxlen=maxlen, approximate=True)
+
+    """ 创建消费组, 已存在时忽略 """
+    def xgroup_create(self, key, group, id='0'):
+        try:
+            return self.r.xgroup_create(key, group, id=id, mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+            return False
+
+    """ 消费组读取新消息 """
+    def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        return self.r.xreadgroup(group, consumer, streams, count=count, block=block)
+
+    def xack(self, key, group, *ids):
+        return self.r.xack(key, group, *ids)
+
+    """ 认领其他消费者超时未ack的消息 """
+    def xautoclaim(self, key, group, consumer, min_idle_time, start_id='0-0', count=None):
+        return self.r.xautoclaim(key, group, consumer, min_idle_time, start_id=start_id, count=count)
+
+    """ pipeline一次写入多个key mapping={key: value} """
+    def set_many(self, mapping, ex=None):
+        pipe = self.r.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(key, value, ex)
+        return pipe.execute()
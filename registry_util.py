@@ -0,0 +1,260 @@
+import select
+import threading
+import time
+from types import MappingProxyType
+
+from eth_utils import to_checksum_address
+
+from local_util import pg_obj
+
+from my_conf import NOT_EIP1599_IDS,L1_CHAIN_IDS
+
+REGISTRY_CHANNEL = 'chain_token_changed'
+
+
+class RegistrySnapshot(object):
+    '''
+        chain/token表的只读快照, 加载后不再修改, reload时整体替换
+    '''
+    def __init__(self, chain_rows, token_rows):
+        chains = []
+        for row in sorted(chain_rows, key=lambda x: x['id']):
+            if not row['is_active']:
+                continue
+            chain_dict = dict(row)
+            chain_dict.update({
+                'chain_db_id': chain_dict['id'],
+                'is_eip1559': chain_dict['chain_id'] not in NOT_EIP1599_IDS,
+                'is_l2': chain_dict['chain_id'] not in L1_CHAIN_IDS,
+            })
+            chains.append(MappingProxyType(chain_dict))
+        tokens = []
+        for row in sorted(token_rows, key=lambda x: x['id']):
+            if not row['is_active']:
+                continue
+            token_dict = dict(row)
+            token_dict.update({'token_db_id': token_dict['id']})
+            tokens.append(MappingProxyType(token_dict))
+
+        self.chains = tuple(chains)
+        self.tokens = tuple(tokens)
+        self.token_groups = tuple(sorted({i['token_group'] for i in token_rows if i['token_group']}))
+
+        #索引 同一个key有多条时取id最小的一条
+        self.chain_by_db_id = {}
+        self.chain_by_chain_id = {}
+        self.chain_by_alchemy_network = {}
+        for i in self.chains:
+            self.chain_by_db_id.setdefault(i['id'], i)
+            if i['chain_id'] is not None:
+                self.chain_by_chain_id.setdefault(i['chain_id'], i)
+            if i['alchemy_network']:
+                self.chain_by_alchemy_network.setdefault(i['alchemy_network'], i)
+
+        self.token_by_address = {}
+        self.token_by_group = {}
+        self.token_by_symbol = {}
+        self.tokens_by_address = {}
+        self.tokens_by_group = {}
+        self.tokens_by_symbol = {}
+        for i in self.tokens:
+            chain_db_id = i['chain_db_id']
+            if i['token_address']:
+                self.token_by_address.setdefault((chain_db_id, i['token_address']), i)
+                self.tokens_by_address.setdefault(i['token_address'], []).append(i)
+            if i['token_group']:
+                self.token_by_group.setdefault((chain_db_id, i['token_group']), i)
+                self.tokens_by_group.setdefault(i['token_group'], []).append(i)
+            if i['token_symbol']:
+                self.token_by_symbol.setdefault((chain_db_id, i['token_symbol']), i)
+                self.tokens_by_symbol.setdefault(i['token_symbol'], []).append(i)
+
+
+class ChainTokenRegistry(object):
+    '''
+        进程内chain/token缓存, 第一次用到时从pg加载
+        查询都走内存索引, 返回的是dict副本, 调用方可以随意修改
+    '''
+    def __init__(self, pg=None):
+        self._pg = pg
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def load_snapshot(self):
+        #NOTIFY在主库提交后马上发出, 副本可能还没回放, 读主库
+        chain_rows = self._pg.query('select * from chain', primary=True)
+        token_rows = self._pg.query('select * from token', primary=True)
+        return RegistrySnapshot(chain_rows, token_rows)
+
+    def reload(self):
+        snapshot = self.load_snapshot()
+        #整体替换引用, 读线程要么拿到旧快照要么拿到新快照
+        self._snapshot = snapshot
+        return snapshot
+
+    def set_rows(self, chain_rows, token_rows):
+        '''
+            用别处查好的行加载快照, async接口用asyncpg查
+        '''
+        self._snapshot = RegistrySnapshot(chain_rows, token_rows)
+        return self._snapshot
+
+    @property
+    def loaded(self):
+        return self._snapshot is not None
+
+    @property
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    snapshot = self.reload()
+        return snapshot
+
+    def get_chain(self, chain_id=None, alchemy_network=None):
+        snapshot = self.snapshot
+        chain_dict = None
+        if chain_id:
+            chain_dict = snapshot.chain_by_chain_id.get(int(chain_id))
+        if alchemy_network:
+            chain_dict = snapshot.chain_by_alchemy_network.get(alchemy_network)
+        return dict(chain_dict) if chain_dict else None
+
+    def get_chains(self, chain_ids=None, is_mainnet=None):
+        '''
+            chain_ids: chain表id
+            is_mainnet: None 所有网络, True 主网, False 测试网
+        '''
+        snapshot = self.snapshot
+        if chain_ids:
+            chain_db_ids = set(map(int, chain_ids))
+            chain_dicts = [i for i in snapshot.chains if i['chain_db_id'] in chain_db_ids]
+        elif is_mainnet is not None:
+            chain_dicts = [i for i in snapshot.chains if i['is_mainnet'] == bool(is_mainnet)]
+        else:
+            chain_dicts = snapshot.chains
+        return [dict(i) for i in chain_dicts]
+
+    def get_token(self, chain_id=None, token_symbol=None, token_address=None, token_group=None):
+        '''
+            优先级 token_address > token_symbol > token_group, 返回token和chain合并后的dict
+        '''
+        res = {}
+        if not chain_id:
+            return res
+        snapshot = self.snapshot
+        chain_dict = snapshot.chain_by_chain_id.get(int(chain_id))
+        if not chain_dict:
+            return res
+        chain_db_id = chain_dict['chain_db_id']
+        token_dict = None
+        if token_address:
+            token_dict = snapshot.token_by_address.get((chain_db_id, to_checksum_address(token_address)))
+        elif token_symbol:
+            token_dict = snapshot.token_by_symbol.get((chain_db_id, token_symbol.upper()))
+        elif token_group:
+            token_dict = snapshot.token_by_group.get((chain_db_id, token_group))
+        if token_dict:
+            res = dict(token_dict, **chain_dict)
+        return res
+
+    def get_tokens(self, token_symbol=None, token_address=None, token_group=None):
+        '''
+            优先级 token_group > token_address > token_symbol, 和原来sql的覆盖顺序一致
+        '''
+        snapshot = self.snapshot
+        if token_group:
+            token_dicts = snapshot.tokens_by_group.get(token_group, [])
+        elif token_address:
+            token_dicts = snapshot.tokens_by_address.get(to_checksum_address(token_address), [])
+        elif token_symbol:
+            token_dicts = snapshot.tokens_by_symbol.get(token_symbol.upper(), [])
+        else:
+            token_dicts = snapshot.tokens
+        return [dict(i) for i in token_dicts]
+
+    def get_tokens_with_chains(self, token_symbol=None, token_address=None, token_group=None, is_mainnet=None):
+        snapshot = self.snapshot
+        res = []
+        for token_dict in self.get_tokens(token_symbol=token_symbol, token_address=token_address,
+                                          token_group=token_group):
+            chain_dict = snapshot.chain_by_db_id.get(token_dict['chain_db_id'])
+            #有token，没关联上chain，过滤掉
+            if not chain_dict:
+                continue
+            if is_mainnet is not None and chain_dict['is_mainnet'] != bool(is_mainnet):
+                continue
+            res.append(dict(token_dict, **chain_dict))
+        return sorted(res, key=lambda x: x['chain_db_id'])
+
+    def get_token_groups(self):
+        return list(self.snapshot.token_groups)
+
+
+class RegistryListener(threading.Thread):
+    '''
+        LISTEN chain/token表的变更通知, 收到后重新加载快照
+        触发器见README: chain_token_notify
+    '''
+    def __init__(self, registry, pg, channel=REGISTRY_CHANNEL, timeout=30, retry_sleep=3):
+        super().__init__(name='registry_listener', daemon=True)
+        self.registry = registry
+        self.pg = pg
+        self.channel = channel
+        self.timeout = timeout
+        self.retry_sleep = retry_sleep
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def listen_once(self):
+        conn = self.pg.connect(autocommit=True)
+        try:
+            cur = conn.cursor()
+            cur.execute(f'LISTEN {self.channel}')
+            #(重)连之后先全量加载一次, 断线期间的通知会丢
+            self.registry.reload()
+            print(f"✅ registry listener: LISTEN {self.channel}")
+            while not self._stop_event.is_set():
+                if select.select([conn], [], [], self.timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                if not conn.notifies:
+                    continue
+                #一次事务里改多行会有多条通知, 合并成一次reload
+                payloads = {i.payload for i in conn.notifies}
+                conn.notifies.clear()
+                self.registry.reload()
+                print(f"🔄 registry reloaded: {sorted(payloads)}")
+        finally:
+            conn.close()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.listen_once()
+            except Exception as e:
+                print(f"⚠️ registry listener error: {e}")
+                time.sleep(self.retry_sleep)
+
+
+chain_registry = ChainTokenRegistry(pg=pg_obj)
+
+_registry_listener = None
+_registry_listener_lock = threading.Lock()
+
+def start_registry_listener():
+    '''
+        每个进程起一个监听线程, 重复调用只会起一个
+    '''
+    global _registry_listener
+    if pg_obj is None:
+        return None
+    with _registry_listener_lock:
+        if _registry_listener is None or not _registry_listener.is_alive():
+            _registry_listener = RegistryListener(chain_registry, pg_obj)
+            _registry_listener.start()
+    return _registry_listener
@@ -0,0 +1,297 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+from web3 import Web3
+from web3.providers.base import JSONBaseProvider
+
+from local_util import auto_inject_poa_middleware_if_needed,inject_poa_middleware
+from registry_util import chain_registry
+
+from my_conf import POA_CHAIN_IDS
+
+RPC_TIMEOUT = 10
+RPC_POOL_MAXSIZE = 20
+#链不变的请求, 缓存后get_eip1559_params等每次取chain_id不再走rpc
+RPC_CACHEABLE_REQUESTS = {'eth_chainId', 'net_version'}
+
+#主节点超过这个时间没返回, 同时发给备用节点, 谁先返回用谁
+RPC_HEDGE_AFTER = 1.5
+RPC_HEDGE_MIN = 0.2
+#连续失败次数达到后熔断, 熔断期间排到最后
+RPC_BREAKER_FAILURES = 3
+RPC_BREAKER_COOLDOWN = 30
+RPC_STATS_WINDOW = 200
+
+#只读且幂等的请求才对冲
+RPC_HEDGE_METHODS = {
+    'eth_call', 'eth_getCode', 'eth_getBalance', 'eth_blockNumber', 'eth_chainId',
+    'eth_getBlockByNumber', 'eth_getBlockByHash', 'eth_gasPrice', 'eth_maxPriorityFeePerGas',
+    'eth_feeHistory', 'eth_getTransactionCount', 'eth_getTransactionByHash',
+    'eth_getTransactionReceipt', 'eth_getLogs', 'eth_estimateGas',
+}
+#节点限流, 也算节点故障
+RPC_LIMIT_ERROR_CODES = {-32005, 429}
+
+
+def get_rpc_session(pool_maxsize=RPC_POOL_MAXSIZE):
+    '''
+        keep-alive连接池, 同一个节点的请求复用tcp/tls连接
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def get_http_provider(rpc_url, timeout=RPC_TIMEOUT, session=None):
+    if session is None:
+        session = get_rpc_session()
+    return Web3.HTTPProvider(rpc_url, request_kwargs={'timeout': timeout}, session=session,
+                cache_allowed_requests=True, cacheable_requests=RPC_CACHEABLE_REQUESTS,
+                request_cache_validation_threshold=None)
+
+class RpcEndpointError(Exception):
+    pass
+
+
+class RpcEndpoint(object):
+    '''
+        单个节点, 记录最近的延迟和错误, 连续失败后熔断
+    '''
+    def __init__(self, rpc_url, timeout=RPC_TIMEOUT, window=RPC_STATS_WINDOW):
+        self.rpc_url = rpc_url
+        #失败马上切节点, 不在单个节点上重试
+        self.provider = Web3.HTTPProvider(rpc_url, request_kwargs={'timeout': timeout},
+                            session=get_rpc_session(), exception_retry_configuration=None,
+                            cache_allowed_requests=True, cacheable_requests=RPC_CACHEABLE_REQUESTS,
+                            request_cache_validation_threshold=None)
+        self.latencies = deque(maxlen=window)
+        self.results = deque(maxlen=window)
+        self.failures = 0
+        self.open_until = 0
+        self._lock = threading.Lock()
+
+    def percentile(self, pct):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * pct), len(latencies) - 1)]
+
+    @property
+    def error_rate(self):
+        results = list(self.results)
+        return (results.count(False) / len(results)) if results else 0
+
+    @property
+    def is_open(self):
+        return self.open_until > time.time()
+
+    def score(self):
+        #没有样本时按0算, 配置在前的节点优先; 只有失败没有成功的排到最后
+        p50 = self.percentile(0.5)
+        if p50 is None:
+            return float('inf') if self.error_rate else 0
+        return p50 * (1 + 10 * self.error_rate)
+
+    def record_success(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            self.results.append(True)
+            self.failures = 0
+            self.open_until = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.results.append(False)
+            self.failures += 1
+            if self.failures >= RPC_BREAKER_FAILURES:
+                self.open_until = time.time() + RPC_BREAKER_COOLDOWN
+                print(f"⚠️ rpc熔断 {RPC_BREAKER_COOLDOWN}s: {self.rpc_url}")
+
+    def stats(self):
+        return {
+            'rpc_url': self.rpc_url,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'error_rate': self.error_rate,
+            'is_open': self.is_open,
+        }
+
+    def call(self, method, params):
+        time_start = time.time()
+        try:
+            response = self.provider.make_request(method, params)
+        except Exception:
+            self.record_failure()
+            raise
+        error = response.get('error') if isinstance(response, dict) else None
+        if isinstance(error, dict) and error.get('code') in RPC_LIMIT_ERROR_CODES:
+            self.record_failure()
+            raise RpcEndpointError(f"{self.rpc_url}: {error}")
+        self.record_success(time.time() - time_start)
+        return response
+
+    def call_batch(self, batch_requests):
+        time_start = time.time()
+        try:
+            response = self.provider.make_batch_request(batch_requests)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success(time.time() - time_start)
+        return response
+
+
+class FailoverHTTPProvider(JSONBaseProvider):
+    '''
+        rpc_url(付费节点) + rpc_url_bak(官方节点)
+        读请求发给最健康的节点, 超过对冲时间没返回就同时发给下一个节点
+        写请求按健康度依次尝试, 只在网络错误时换节点
+    '''
+    def __init__(self, rpc_urls, timeout=RPC_TIMEOUT, hedge_after=RPC_HEDGE_AFTER, max_workers=16):
+        super().__init__()
+        self.endpoints = [RpcEndpoint(i, timeout=timeout) for i in dict.fromkeys(rpc_urls) if i]
+        self.hedge_after = hedge_after
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rpc_hedge')
+
+    @property
+    def endpoint_uri(self):
+        return self.get_endpoints()[0].rpc_url
+
+    def get_endpoints(self):
+        #熔断的排最后, 其余按延迟和错误率排序
+        return sorted(self.endpoints, key=lambda x: (x.is_open, x.score()))
+
+    def stats(self):
+        return [i.stats() for i in self.endpoints]
+
+    def get_hedge_delay(self, endpoint):
+        p99 = endpoint.percentile(0.99)
+        if p99 is None:
+            return self.hedge_after
+        return min(max(p99, RPC_HEDGE_MIN), self.hedge_after)
+
+    def make_request(self, method, params):
+        endpoints = self.get_endpoints()
+        if method in RPC_HEDGE_METHODS and len(endpoints) > 1:
+            return self.make_hedged_request(endpoints, method, params)
+        error = None
+        for endpoint in endpoints:
+            try:
+                return endpoint.call(method, params)
+            except Exception as e:
+                print(f"⚠️ rpc失败, 切换节点: {endpoint.rpc_url} {method} {e}")
+                error = e
+        raise error
+
+    def make_hedged_request(self, endpoints, method, params):
+        pending = {}
+        error = None
+        endpoints = list(endpoints)
+        endpoint = endpoints.pop(0)
+        pending[self._executor.submit(endpoint.call, method, params)] = endpoint
+        timeout = self.get_hedge_delay(endpoint)
+        while pending:
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                endpoint = pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    print(f"⚠️ rpc失败, 切换节点: {endpoint.rpc_url} {method} {e}")
+                    error = e
+            #超时没返回或者已经失败, 加一个节点
+            if endpoints and (not done or not pending):
+                endpoint = endpoints.pop(0)
+                pending[self._executor.submit(endpoint.call, method, params)] = endpoint
+                timeout = self.get_hedge_delay(endpoint)
+            elif not endpoints:
+                timeout = None
+        raise error
+
+    def make_batch_request(self, batch_requests):
+        error = None
+        for endpoint in self.get_endpoints():
+            try:
+                return endpoint.call_batch(batch_requests)
+            except Exception as e:
+                print(f"⚠️ rpc batch失败, 切换节点: {endpoint.rpc_url} {e}")
+                error = e
+        raise error
+
+
+def init_poa(w3, chain_id=None):
+    '''
+        POA只判断一次, 结果记在w3.poa_result上, 之后auto_inject_poa_middleware_if_needed直接返回
+    '''
+    if chain_id in POA_CHAIN_IDS:
+        poa_result = inject_poa_middleware(w3)
+    else:
+        poa_result = auto_inject_poa_middleware_if_needed(w3)
+    if poa_result:
+        w3.poa_result = poa_result
+    if poa_result and poa_result not in ["not_needed", "already_exists"]:
+        print(f"🔗 Chain {chain_id} POA中间件状态: {poa_result}")
+    return poa_result
+
+
+class Web3Pool(object):
+    '''
+        每条链一个长期复用的Web3客户端, rpc_url变了(registry重新加载)才重建
+    '''
+    def __init__(self, registry, timeout=RPC_TIMEOUT, pool_maxsize=RPC_POOL_MAXSIZE):
+        self.registry = registry
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def build(self, rpc_urls, chain_id=None):
+        if len(rpc_urls) > 1:
+            provider = FailoverHTTPProvider(rpc_urls, timeout=self.timeout)
+        else:
+            provider = get_http_provider(rpc_urls[0], timeout=self.timeout,
+                            session=get_rpc_session(pool_maxsize=self.pool_maxsize))
+        w3 = Web3(provider)
+        init_poa(w3, chain_id=chain_id)
+        return w3
+
+    def get(self, chain_id=None, rpc_url=''):
+        rpc_urls = (rpc_url,)
+        if chain_id:
+            chain_dict = self.registry.get_chain(chain_id=chain_id)
+            if chain_dict and chain_dict.get('rpc_url'):
+                rpc_urls = tuple(dict.fromkeys(i for i in (chain_dict['rpc_url'], chain_dict.get('rpc_url_bak')) if i))
+        if not rpc_urls[0]:
+            return None
+        key = int(chain_id) if chain_id else rpc_url
+        client = self._clients.get(key)
+        if client is None or client[0] != rpc_urls:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None or client[0] != rpc_urls:
+                    client = (rpc_urls, self.build(rpc_urls, chain_id=int(chain_id) if chain_id else None))
+                    self._clients[key] = client
+        w3 = client[1]
+        #上次POA检测失败(网络问题), 再试一次
+        if not hasattr(w3, 'poa_result'):
+            init_poa(w3, chain_id=int(chain_id) if chain_id else None)
+        return w3
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+
+    def stats(self):
+        res = {}
+        for key, (rpc_urls, w3) in list(self._clients.items()):
+            if isinstance(w3.provider, FailoverHTTPProvider):
+                res[key] = w3.provider.stats()
+        return res
+
+
+w3_pool = Web3Pool(chain_registry)
@@ -1,3 +1,6 @@
+import threading
+from concurrent.futures import Future
+
 import arrow
 
 from my_conf import TZ
@@ -18,3 +21,34 @@ def to_tztime(time_int,format_time=True):
         res = res.format('YYYY-MM-DD HH:mm:ss')
     return res
 
+
+class SingleFlight(object):
+    '''
+        相同key的并发调用合并成一次, 其他调用方等第一个的结果
+    '''
+    def __init__(self):
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, timeout=None):
+        '''
+            返回 (结果, 是否是自己执行的)
+        '''
+        with self._lock:
+            future = self._inflight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._inflight[key] = future
+        if not is_leader:
+            return future.result(timeout=timeout), False
+        try:
+            res = func()
+            future.set_result(res)
+            return res, True
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
@@ -1,24 +1,44 @@
 
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from decimal import Decimal
 
-from eth_utils import to_checksum_address
+from eth_utils import to_checksum_address,add_0x_prefix
 from web3 import Web3
 
-from local_util import get_tmp_key,set_tmp_key,\
-    get_bytes32_address,get_decode_calldata,\
+from local_util import get_bytes32_address,get_decode_calldata,\
     str_to_int,get_w3,get_web3_wei_amount,get_web3_human_amount
 
 from web3_util import decode_contract_error,get_gas_params,\
-        handle_already_known_transaction,get_erc_allowance
-
-from data_util import get_chain,get_token,create_txl_webhook,\
-    create_fill_txl_etherscan_by_hash,get_etherscan_txs,\
-    create_txl_etherscan_txlist,get_suggested_fees
+        handle_already_known_transaction,get_erc_allowance,\
+        get_batch_results,get_chain_state_requests
+
+from gas_oracle_util import get_oracle_chain_state
+from nonce_util import nonce_manager
+from lease_util import fill_lease_manager
+from receipt_util import track_tx
+from alchemy_util import get_alchemy_deposit_logs
+from data_util import get_chain,get_token,get_txl,create_txl_webhook,\
+    get_etherscan_txs,\
+    create_txls_etherscan_txlist,get_txls_by_hashes,get_suggested_fees
 
 from my_conf import DEPOSIT_ABI,FILL_RELAY_ABI,CHECK_RELAY_FILLED_ABI,VAULTS,FILL_RATE,\
     VAULT_PRIVATE_KEY
 
+class FillRelayError(Exception):
+    '''
+        call_fill_relay_by_txlist里有deposit fill失败(rpc/网络等), tx_dicts是失败的那些
+    '''
+    def __init__(self, tx_dicts):
+        super().__init__(f"{len(tx_dicts)}笔deposit fill失败: {[i['hash'] for i in tx_dicts]}")
+        self.tx_dicts = tx_dicts
+
+class FillRejectedError(Exception):
+    '''
+        这笔deposit确定不能fill(报价返回错误/金额超出范围/参数检查不通过), 重试也不会成功
+    '''
+    pass
+
 def call_erc_allowance(chain_id, token_address, spender_address, 
             owner_address, human=False):
     w3 = get_w3(chain_id=chain_id)
@@ -88,10 +108,11 @@ def call_deposit(vault, recipient, inputToken, inputAmount, destinationChainId,
             estimated_gas = 150000  # 为deposit设置一个保守的默认值
             print(f"📊 使用默认gas估算: {estimated_gas:,}")
     
-    # 使用实际估算的gas获取优化的gas参数（在这里统一设置nonce）
+    # 使用实际估算的gas获取优化的gas参数（nonce在发送前分配）
     tx_params = get_gas_params(w3, account_address, block_chainid, 
                              priority='standard', tx_type='contract_call', 
-                             estimated_gas=estimated_gas, is_eip1559=is_eip1559, is_l2=is_l2)
+                             estimated_gas=estimated_gas, is_eip1559=is_eip1559, is_l2=is_l2,
+                             with_nonce=False)
     
     if inputToken == '0x0000000000000000000000000000000000000000':
         tx_params['value'] = inputAmount
@@ -128,18 +149,22 @@ def call_deposit(vault, recipient, inputToken, inputAmount, destinationChainId,
             # 其他类型的错误（包括InsufficientBalance）
             return None
     
+    tx_params['nonce'] = nonce_manager.allocate(w3, block_chainid, account_address)
+    tx_hash = None
     try:
         tx = contract.functions.deposit(vault, recipient, inputToken, inputAmount, destinationChainId, message).build_transaction(tx_params)
         print(f"交易参数: {tx_params}")
         signed_tx = w3.eth.account.sign_transaction(tx, private_key=private_key)
         tx_hash = w3.eth.send_raw_transaction(signed_tx.raw_transaction)
         print(f"交易已发送，哈希: {tx_hash.hex()}")
-        receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
-        print(f"交易确认，状态: {receipt.status}")
+        # 不等receipt; deposit的txline由webhook/indexer写入, 不走receipt_util(它只写fill单)
         res = tx_hash.hex()
     except Exception as e:
         error_message = str(e)
         print(f"交易失败: {e}")
+        # 交易没发出去, nonce退回或者重新同步
+        if tx_hash is None:
+            nonce_manager.handle_send_error(block_chainid, account_address, tx_params['nonce'], error_message)
         
         # 处理特定的错误情况
         if 'already known' in error_message:
@@ -193,8 +218,34 @@ def check_relay_filled(originChainId, depositHash, recipient, outputToken, contr
         return None
 
 
+def get_relay_filled_requests(originChainId, depositHash, recipient, outputToken, contract_address, w3):
+    """check_relay_filled的批量版本, 和其他读请求放进同一个batch"""
+    contract = w3.eth.contract(address=contract_address, abi=CHECK_RELAY_FILLED_ABI)
+    return [
+        ('code', lambda: w3.eth.get_code(contract_address)),
+        ('relay_filled', lambda: contract.functions.isRelayFilled(originChainId, depositHash, recipient, outputToken)),
+    ]
+
+def check_relay_filled_by_state(chain_state, contract_address):
+    """根据batch结果判断relay是否已经被填充, 和check_relay_filled返回值一致"""
+    code = chain_state.get('code')
+    if code is None or chain_state.get('relay_filled') is None:
+        print(f"❌ 检查relay状态失败")
+        return None
+    if code == b'':
+        print(f"❌ 地址 {contract_address} 没有合约代码，可能未部署")
+        return None
+    print(f"✅ 合约地址有效，代码长度: {len(code)} bytes")
+    is_filled = chain_state['relay_filled']
+    print(f"✅ relay状态检查成功: {is_filled}")
+    return is_filled
+
+
 def call_fill_relay(recipient, outputToken, outputAmount, originChainId, depositHash, message, 
-                        block_chainid, private_key):
+                        block_chainid, private_key, lease=None):
+    '''
+        lease: lease_util.FillLease, 持有租约时发送前只续约确认, 不再查链上relay状态
+    '''
     res = None
     w3 = get_w3(chain_id=block_chainid)
     chain_dict = get_chain(chain_id=block_chainid)
@@ -205,14 +256,23 @@ def call_fill_relay(recipient, outputToken, outputAmount, originChainId, deposit
 
     print(f"call_fill_relay 入参 时间: {time.time()}: {recipient}, {outputToken}, {outputAmount}, {originChainId}, {depositHash.hex()}, {message}")
 
-    relay_filled = check_relay_filled(originChainId, depositHash, recipient, outputToken, contract_address, w3)
-    if relay_filled is True:
-        print(f"❌ RelayAlreadyFilled: 这个relay已经被填充过了,{depositHash.hex()}")
+    if not w3.is_address(contract_address):
+        print(f"❌ 无效的合约地址: {contract_address}")
         return None
-            
+
     contract = w3.eth.contract(address=contract_address, abi=FILL_RELAY_ABI)
     account = w3.eth.account.from_key(private_key)
     account_address = account.address
+
+    # 合约代码、relay状态、nonce、最新区块、gas价格 一个batch取回, gas oracle数据新鲜时不取区块和gas价格
+    oracle_state = get_oracle_chain_state(block_chainid)
+    chain_state = get_batch_results(w3, 
+                    get_relay_filled_requests(originChainId, depositHash, recipient, outputToken, contract_address, w3)
+                    + get_chain_state_requests(w3, account_address, is_eip1559=is_eip1559, with_gas=not oracle_state))
+    relay_filled = check_relay_filled_by_state(chain_state, contract_address)
+    if relay_filled is True:
+        print(f"❌ RelayAlreadyFilled: 这个relay已经被填充过了,{depositHash.hex()}")
+        return None
     
     # 首先构建基础交易参数来估算gas（不包含nonce，避免冲突）
     base_tx_params = {
@@ -245,25 +305,13 @@ def call_fill_relay(recipient, outputToken, outputAmount, originChainId, deposit
             estimated_gas = 200000  # 为fillRelay设置一个保守的默认值
             print(f"📊 使用默认gas估算: {estimated_gas:,}")
     
-    # 使用实际估算的gas获取优化的gas参数（在这里统一设置nonce）
+    # 使用实际估算的gas获取优化的gas参数（nonce在发送前分配, 不用等pending交易确认）
     tx_params = get_gas_params(w3, account_address, block_chainid, 
                              priority='standard', tx_type='contract_call', 
-                             estimated_gas=estimated_gas, is_eip1559=is_eip1559, is_l2=is_l2)
+                             estimated_gas=estimated_gas, is_eip1559=is_eip1559, is_l2=is_l2,
+                             chain_state=chain_state, with_nonce=False)
     
-    # 如果等待pending交易完成后需要重新检查relay状态
-    if tx_params == "pending_completed_recheck_needed":
-        print(f"🔍 Pending交易完成后重新检查relay状态...")
-        relay_filled = check_relay_filled(originChainId, depositHash, recipient, outputToken, contract_address, w3)
-        if relay_filled is True:
-            print(f"❌ RelayAlreadyFilled: Pending交易完成后发现relay已被填充,{depositHash.hex()}")
-            return None
-        
-        # 重新获取gas参数
-        tx_params = get_gas_params(w3, account_address, block_chainid, 
-                                 priority='standard', tx_type='contract_call', 
-                                 estimated_gas=estimated_gas, is_eip1559=is_eip1559, is_l2=is_l2)
-    
-    if not tx_params or tx_params == "pending_completed_recheck_needed":
+    if not tx_params:
         print(f"❌ 无法获取有效的gas参数")
         return None
     
@@ -311,13 +359,21 @@ def call_fill_relay(recipient, outputToken, outputAmount, originChainId, deposit
             # 其他类型的错误
             return None
 
-    # 发送交易前再次检查relay状态（防止pending交易已经填充了这个relay）
-    print(f"🔍 发送交易前再次检查relay状态...")
-    relay_filled = check_relay_filled(originChainId, depositHash, recipient, outputToken, contract_address, w3)
-    if relay_filled is True:
-        print(f"❌ RelayAlreadyFilled: 在准备发送交易时发现relay已被填充,{depositHash.hex()}")
-        return None
+    if lease is not None:
+        # 租约保证同一笔deposit只有一个worker在发送, 续约失败(owner或fence对不上)说明租约过期被别人拿走了
+        if not lease.renew():
+            print(f"❌ fill租约已失效, 不发送: {depositHash.hex()} fence={lease.fence}")
+            return None
+    else:
+        # 发送交易前再次检查relay状态（防止pending交易已经填充了这个relay）
+        print(f"🔍 发送交易前再次检查relay状态...")
+        relay_filled = check_relay_filled(originChainId, depositHash, recipient, outputToken, contract_address, w3)
+        if relay_filled is True:
+            print(f"❌ RelayAlreadyFilled: 在准备发送交易时发现relay已被填充,{depositHash.hex()}")
+            return None
     
+    tx_params['nonce'] = nonce_manager.allocate(w3, block_chainid, account_address, chain_state=chain_state)
+    tx_hash = None
     try:
         # print(f"交易参数: {tx_params}")
         tx = contract.functions.fillRelay(recipient, outputToken, outputAmount, originChainId,
@@ -325,12 +381,14 @@ def call_fill_relay(recipient, outputToken, outputAmount, originChainId, deposit
         signed_tx = w3.eth.account.sign_transaction(tx, private_key=private_key)
         tx_hash = w3.eth.send_raw_transaction(signed_tx.raw_transaction)
         print(f"交易已发送，哈希: {tx_hash.hex()}")
-        receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
-        print(f"交易确认，状态: {receipt.status}")
+        # 不等receipt, 由receipt_util批量跟踪
         res = tx_hash.hex()
     except Exception as e:
         error_message = str(e)
         print(f"交易失败: {e}")
+        # 交易没发出去, nonce退回或者重新同步
+        if tx_hash is None:
+            nonce_manager.handle_send_error(block_chainid, account_address, tx_params['nonce'], error_message)
         
         # 处理特定的错误情况
         if 'already known' in error_message:
@@ -353,12 +411,6 @@ def check_fill_args(vault,depositHash,originChainId,block_chainid,outputToken):
     if vault not in VAULTS:
         print(f"❌  vault not in VAULTS: {vault}")
         return False
-    tx_hash = depositHash.hex()
-    if get_tmp_key(f"depositHash_{tx_hash}"):
-        print(f"❌ depositHash已经存在: {tx_hash}")
-        return False
-    #2minutes
-    set_tmp_key(f"depositHash_{tx_hash}",'1',ex=60*2)
     if not outputToken:
         print(f"❌ outputToken代币不存在")
         return False
@@ -375,37 +427,19 @@ def check_fill_args(vault,depositHash,originChainId,block_chainid,outputToken):
         return False
     return True
 
-def call_fill_relay_by_alchemy(data):
-    '''
-        calldata_dict = {'vault': '0xbA37D7ed1cFF3dDab5f23ee99525291dcA00999D',
-            'recipient': '0xd45F62ae86E01Da43a162AA3Cd320Fca3C1B178d', 
-            'inputToken': '0x0000000000000000000000000000000000000000', 
-            'inputAmount': 100000000000000, 
-            'destinationChainId': 84532, 'message': b'hello'}
-    '''
-    res = None
-
-    # print(f"data: {data}")
-
-    log_dict = data['event']['data']['block']['logs'][0]
-    tx_dict = log_dict['transaction']
-    calldata = tx_dict['inputData']
-    calldata_dict = get_decode_calldata(calldata)
-
-    alchemy_network = data['event']['network']
-    print(f"alchemy_network: {alchemy_network}")
-    chain_dict = get_chain(alchemy_network=alchemy_network)
-    # dst_chain_dict = get_chain(chain_id=calldata_dict['destinationChainId'])
+def call_fill_relay_by_alchemy_log(log_dict, chain_dict, token_dicts, timestamp):
+    tx_dict = dict(log_dict['transaction'])
+    calldata_dict = get_decode_calldata(tx_dict['inputData'])
 
     originChainId = chain_dict['chain_id']
     depositHash = get_bytes32_address(tx_dict['hash'])
 
-    token_dict = get_token(chain_id=originChainId,token_address=calldata_dict['inputToken'])
+    token_dict = token_dicts[calldata_dict['inputToken']]
     # print(f"token_dict: {token_dict}")
 
     tx_dict.update({
         'contract_addr_call': to_checksum_address(log_dict['account']['address']),
-        'timestamp': data['event']['data']['block']['timestamp'],
+        'timestamp': timestamp,
     })
     calldata_dict.update({
         'chain_db_id': chain_dict['chain_db_id'],
@@ -422,26 +456,123 @@ def call_fill_relay_by_alchemy(data):
     res = call_fill_relay_by_calldata(calldata_dict,originChainId,depositHash)
     return res
 
+def call_fill_relay_by_alchemy(data, max_workers=8):
+    '''
+        处理payload里的所有deposit, 多笔时并发, 返回 {depositHash: fillRelay结果}
+        calldata_dict = {'vault': '0xbA37D7ed1cFF3dDab5f23ee99525291dcA00999D',
+            'recipient': '0xd45F62ae86E01Da43a162AA3Cd320Fca3C1B178d', 
+            'inputToken': '0x0000000000000000000000000000000000000000', 
+            'inputAmount': 100000000000000, 
+            'destinationChainId': 84532, 'message': b'hello'}
+    '''
+    res = {}
+
+    # print(f"data: {data}")
+
+    log_dicts = get_alchemy_deposit_logs(data)
+    if not log_dicts:
+        print(f"❌ payload里没有deposit日志")
+        return res
+
+    #同一个区块, chain和token只查一次
+    alchemy_network = data['event']['network']
+    print(f"alchemy_network: {alchemy_network}, deposits: {len(log_dicts)}")
+    chain_dict = get_chain(alchemy_network=alchemy_network)
+    timestamp = data['event']['data']['block']['timestamp']
+    token_dicts = {}
+    for log_dict in log_dicts:
+        token_address = get_decode_calldata(log_dict['transaction']['inputData'])['inputToken']
+        if token_address not in token_dicts:
+            token_dicts[token_address] = get_token(chain_id=chain_dict['chain_id'],token_address=token_address)
+
+    if len(log_dicts) == 1:
+        log_dict = log_dicts[0]
+        res[log_dict['transaction']['hash']] = call_fill_relay_by_alchemy_log(log_dict, chain_dict, token_dicts, timestamp)
+        return res
+
+    error = None
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(log_dicts))) as executor:
+        futures = {executor.submit(call_fill_relay_by_alchemy_log, log_dict, chain_dict, token_dicts, timestamp):
+                        log_dict['transaction']['hash'] for log_dict in log_dicts}
+        for future in as_completed(futures):
+            deposit_hash = futures[future]
+            try:
+                res[deposit_hash] = future.result()
+            except Exception as e:
+                print(f"❌ call_fill_relay_by_alchemy失败: {deposit_hash} {e}")
+                error = e
+    #有失败的抛出去, 队列重试时已经成功的会被去重跳过
+    if error:
+        raise error
+    return res
+
 def call_fill_relay_by_etherscan(chain_id='',limit=1, contract_type='contract_deposit'):
     tx_dicts = get_etherscan_txs(chain_id=chain_id,limit=limit,contract_type=contract_type)
+    call_fill_relay_by_txlist(chain_id,tx_dicts)
+
+def call_fill_relay_by_txlist(chain_id,tx_dicts):
+    '''
+        tx_dicts: etherscan txlist格式, indexer_util.DepositIndexer也转成这个格式
+        先一次批量写入txline, 再逐笔fill
+    '''
+    tx_dicts = [i for i in tx_dicts if str_to_int(i['txreceipt_status']) == 1]
+    if not tx_dicts:
+        return None
+    #批量写入前的状态, 已经fill过的(status=1)不再处理
+    txl_dicts = get_txls_by_hashes([add_0x_prefix(i['hash']) for i in tx_dicts])
+    res_create = create_txls_etherscan_txlist(chain_id=chain_id,tx_dicts=tx_dicts)
+    print(f"create_txls_etherscan_txlist: {len(res_create)}/{len(tx_dicts)}")
+    failed = []
     for tx_dict in tx_dicts:
         print(f"tx_dict: {tx_dict}")
-        if str_to_int(tx_dict['txreceipt_status']) == 1:
-            calldata = tx_dict['input']
-            depositHash = get_bytes32_address(tx_dict['hash'])
-            calldata_dict = get_decode_calldata(calldata)
-            if calldata_dict.get('contract_type',''):
-
-                res_create = create_txl_etherscan_txlist(chain_id=chain_id,tx_dict=tx_dict)
-                print(f"create_txl_etherscan_txlist: {res_create}")
-
+        calldata = tx_dict['input']
+        depositHash = get_bytes32_address(tx_dict['hash'])
+        calldata_dict = get_decode_calldata(calldata)
+        if calldata_dict.get('contract_type',''):
+            if txl_dicts.get(add_0x_prefix(tx_dict['hash']),{}).get('status') == 1:
+                print(f"✅ 已经处理过: {tx_dict['hash']}")
+                continue
+
+            #一笔失败先处理后面的, 最后统一抛出, 调用方按失败的deposit重扫
+            try:
                 res = call_fill_relay_by_calldata(calldata_dict,chain_id,depositHash)
-                print(f"res: {res}")
-            else:
-                print(f"❌ contract_type不存在: {tx_dict['hash']}")
+            except Exception as e:
+                print(f"❌ call_fill_relay_by_calldata失败: {tx_dict['hash']} {e}")
+                failed.append(tx_dict)
+                continue
+            print(f"res: {res}")
+        else:
+            print(f"❌ contract_type不存在: {tx_dict['hash']}")
+    if failed:
+        raise FillRelayError(failed)
 
 #todo FILL_RATE 来自across
 def call_fill_relay_by_calldata(calldata_dict,originChainId,depositHash):
+    '''
+        webhook队列和etherscan/indexer cron的fill都走这里
+        先抢这笔deposit的租约, 没抢到说明别的worker正在fill或者已经fill过, 不花任何rpc请求
+    '''
+    lease = fill_lease_manager.acquire(depositHash.hex())
+    if lease is None:
+        print(f"❌ depositHash已经在处理或已处理: {depositHash.hex()}")
+        return None
+    with lease:
+        print(f"🔒 fill租约: {depositHash.hex()} fence={lease.fence}")
+        try:
+            res = fill_relay_by_calldata(calldata_dict,originChainId,depositHash,lease=lease)
+        except FillRejectedError as e:
+            #确定不能fill的, 租约换成短时间的拒绝标记, cron不会每轮都重新报价
+            print(f"❌ fill被拒绝: {depositHash.hex()} {e}")
+            lease.reject(str(e))
+            return None
+        #交易发出去了, 租约换成完成标记; 链上已经填充过的换成filled标记; 没发出去的退出时释放, 重试可以再拿
+        if res == "fillRelay_confirmed_by_existing":
+            lease.complete(None)
+        elif res:
+            lease.complete(res)
+    return res
+
+def fill_relay_by_calldata(calldata_dict,originChainId,depositHash,lease=None):
     res = None
     block_chainid = calldata_dict['destinationChainId']
     vault = to_checksum_address(calldata_dict['vault'])
@@ -464,17 +595,14 @@ def call_fill_relay_by_calldata(calldata_dict,originChainId,depositHash):
             outputAmount = int(outputAmount)
         else:
             if res_suggested_fees.get('message',None):
-                print(f"❌ res_suggested_fees: {res_suggested_fees['message']}")
-                return res
+                raise FillRejectedError(f"res_suggested_fees: {res_suggested_fees['message']}")
     else:
         min_amount = Decimal(str(token_input_dict['min_num']))
         max_amount = Decimal(str(token_input_dict['max_num']))
         if input_amount_human<min_amount:
-            print(f"❌ input_amount_human: {input_amount_human} < min_amount: {min_amount}")
-            return res
+            raise FillRejectedError(f"input_amount_human: {input_amount_human} < min_amount: {min_amount}")
         if input_amount_human>max_amount:
-            print(f"❌ input_amount_human: {input_amount_human} > max_amount: {max_amount}")
-            return res
+            raise FillRejectedError(f"input_amount_human: {input_amount_human} > max_amount: {max_amount}")
         input_amount_human_after = input_amount_human*Decimal(str(FILL_RATE))
         outputAmount = get_web3_wei_amount(input_amount_human_after,int(token_out_dict['decimals']))
 
@@ -482,19 +610,18 @@ def call_fill_relay_by_calldata(calldata_dict,originChainId,depositHash):
     recipient = to_checksum_address(calldata_dict['recipient'])
 
     if not check_fill_args(vault,depositHash,originChainId,block_chainid,outputToken):
-        print(f"check_fill_args 不通过")
-        return res
+        raise FillRejectedError("check_fill_args 不通过")
 
     # res = call_fill_relay(recipient, outputToken, outputAmount, originChainId, depositHash, message, 
     #                         block_chainid, private_key=VAULT_PRIVATE_KEY)
 
-    try:
-        res = call_fill_relay(recipient, outputToken, outputAmount, originChainId, depositHash, message, 
-                                block_chainid, private_key=VAULT_PRIVATE_KEY)
-    except Exception as e:
-        print(f"❌ call_fill_relay_by_alchemy失败: {e}")
+    #rpc/网络这类异常抛出去, 租约释放, 队列worker重试/进死信; 确定失败的(已填充/余额不足等)返回None不重试
+    res = call_fill_relay(recipient, outputToken, outputAmount, originChainId, depositHash, message, 
+                            block_chainid, private_key=VAULT_PRIVATE_KEY, lease=lease)
 
-    if res:
-        print(f"time: {time.time()}, create_fill_txl_etherscan: {res}")
-        create_fill_txl_etherscan_by_hash(tx_hash=res,chain_id=block_chainid)
+    if res and res != "fillRelay_confirmed_by_existing":
+        print(f"time: {time.time()}, track_tx: {res}")
+        txl_related_id = get_txl(tx_hash=add_0x_prefix(depositHash.hex())).get('id')
+        track_tx(chain_id=block_chainid, tx_hash=res, txl_related_id=txl_related_id,
+                    deposit_hash=add_0x_prefix(depositHash.hex()))
     return res
\ No newline at end of file
@@ -1,5 +1,7 @@
 import time
 
+from web3.contract.contract import ContractFunction
+
 from local_util import get_web3_human_amount,get_web3_human_amount,get_w3,\
     auto_inject_poa_middleware_if_needed
 
@@ -58,56 +60,62 @@ def get_erc_allowance(w3, token_address, spender_address, owner_address, human=F
         res = str(get_web3_human_amount(allowance, decimals=decimals))
     return res
 
-def get_safe_nonce(w3, account_address):
-    """获取安全的nonce，使用pending避免冲突"""
-    # 获取链上确认的nonce
-    confirmed_nonce = w3.eth.get_transaction_count(account_address, 'latest')
-    # 获取待处理的nonce  
-    pending_nonce = w3.eth.get_transaction_count(account_address, 'pending')
-    # 直接使用pending_nonce，让RPC节点自己处理nonce排队
-    safe_nonce = pending_nonce
-    has_pending = pending_nonce > confirmed_nonce
-    print(f"📊 Nonce信息: 已确认={confirmed_nonce}, 待处理={pending_nonce}, 使用={safe_nonce}, Pending交易={has_pending}")
-    return safe_nonce, has_pending
+def get_batch_results(w3, requests):
+    """
+    多个互不依赖的读请求合成一个JSON-RPC batch发送
 
-def wait_for_pending_transaction(w3, account_address, expected_nonce):
-    """等待pending交易完成"""
-    print(f"🔍 等待nonce {expected_nonce}的pending交易完成...")
-    
-    max_wait_time = 60  # 最多等待60秒
-    check_interval = 1  # 每1秒检查一次
-    
-    for i in range(max_wait_time // check_interval):
-        confirmed_nonce = w3.eth.get_transaction_count(account_address, 'latest')
-        pending_nonce = w3.eth.get_transaction_count(account_address, 'pending')
-        
-        # 如果confirmed nonce已经超过了expected nonce，说明交易已完成
-        if confirmed_nonce > expected_nonce:
-            print(f"✅ Pending交易已确认，当前confirmed nonce: {confirmed_nonce}")
-            return True
-        
-        # 如果没有pending交易了，也说明完成了
-        if confirmed_nonce == pending_nonce:
-            print(f"✅ 没有pending交易了，当前nonce: {confirmed_nonce}")
-            return True
-        
-        elapsed_time = (i + 1) * check_interval
-        print(f"⏳ 等待pending交易完成... ({elapsed_time}s/{max_wait_time}s) - 确认:{confirmed_nonce}, 待处理:{pending_nonce}")
-        
-        # 每隔10秒检查一次网络状态
-        if elapsed_time % 10 == 0:
-            try:
-                current_gas_price = w3.eth.gas_price
-                print(f"🔍 网络状态检查: 当前gas价格={w3.from_wei(current_gas_price, 'gwei'):.12f} gwei")
-            except:
-                pass
-        
-        time.sleep(check_interval)
-    
-    print(f"⏰ 等待超时，pending交易可能卡住了")
-    print(f"💡 建议: 如果是测试环境，可以考虑使用更高的gas价格")
-    print(f"📊 最终状态: 确认nonce={confirmed_nonce}, 待处理nonce={pending_nonce}")
-    return False
+    Args:
+        requests: [(key, func)] func在batch里调用, 返回w3.eth.xxx(...)或者contract.functions.xxx(...)
+    Returns:
+        {key: 结果}, 单个请求失败时为None
+    """
+    res = {}
+    if not requests:
+        return res
+    try:
+        with w3.batch_requests() as batch:
+            for key, func in requests:
+                batch.add(func())
+            batch_results = batch.execute()
+        return dict(zip([key for key, func in requests], batch_results))
+    except Exception as e:
+        # 节点不支持batch或者其中某个请求报错, 逐个请求
+        print(f"⚠️ batch请求失败，改为逐个请求: {e}")
+    for key, func in requests:
+        try:
+            result = func()
+            if isinstance(result, ContractFunction):
+                result = result.call()
+            res[key] = result
+        except Exception as e:
+            print(f"⚠️ {key} 请求失败: {e}")
+            res[key] = None
+    return res
+
+def get_chain_state_requests(w3, account_address, is_eip1559=True, with_gas=True):
+    """发送交易前需要的链上状态: nonce、最新区块、gas价格, with_gas=False时gas相关的由gas oracle提供"""
+    requests = [
+        ('nonce_latest', lambda: w3.eth.get_transaction_count(account_address, 'latest')),
+        ('nonce_pending', lambda: w3.eth.get_transaction_count(account_address, 'pending')),
+    ]
+    if with_gas:
+        requests += [
+            ('latest_block', lambda: w3.eth.get_block('latest')),
+            ('gas_price', lambda: w3.eth.gas_price),
+        ]
+    if with_gas and is_eip1559:
+        requests.append(('max_priority_fee', lambda: w3.eth.max_priority_fee))
+    return requests
+
+def get_chain_state(w3, account_address, is_eip1559=True):
+    return get_batch_results(w3, get_chain_state_requests(w3, account_address, is_eip1559=is_eip1559))
+
+def get_state_value(chain_state, key, func):
+    """优先用batch预取的值, 没有再单独请求"""
+    value = chain_state.get(key) if chain_state else None
+    if value is None:
+        value = func()
+    return value
 
 def handle_already_known_transaction(w3, account_address, nonce):
     """处理already known交易，尝试等待确认"""
@@ -129,13 +137,13 @@ def handle_already_known_transaction(w3, account_address, nonce):
     print(f"⏰ 等待超时，交易可能仍在pending状态")
     return False
 
-def get_optimal_gas_price(w3, chain_id, priority='standard', is_l2=True):
+def get_optimal_gas_price(w3, chain_id, priority='standard', is_l2=True, chain_state=None):
     """获取优化的gas价格"""
     if not chain_id:
         return None
     try:
         # 获取当前网络gas价格
-        current_gas_price = w3.eth.gas_price
+        current_gas_price = get_state_value(chain_state, 'gas_price', lambda: w3.eth.gas_price)
         
         # Polygon网络特殊处理：需要满足最低gas price要求
         if chain_id == 80002:  # Polygon Amoy
@@ -276,7 +284,7 @@ def check_eip1559_support(w3):
     except:
         return False
 
-def get_eip1559_params(w3, priority='standard', is_l2=None):
+def get_eip1559_params(w3, priority='standard', is_l2=None, chain_state=None):
     """获取EIP-1559参数"""
     chain_id = w3.eth.chain_id
     if not chain_id:
@@ -294,13 +302,13 @@ def get_eip1559_params(w3, priority='standard', is_l2=None):
         # 自动检测并注入POA中间件（如果需要）
         auto_inject_poa_middleware_if_needed(w3)
         
-        latest_block = w3.eth.get_block('latest')
+        latest_block = get_state_value(chain_state, 'latest_block', lambda: w3.eth.get_block('latest'))
         base_fee = latest_block.baseFeePerGas
         print(f"🔍 EIP-1559参数计算: Chain={chain_id}, Priority={priority}, is_L2={is_l2}, BaseFee={w3.from_wei(base_fee, 'gwei'):.12f} gwei")
         
         # 尝试获取网络建议的优先费用
         try:
-            suggested_priority_fee = w3.eth.max_priority_fee
+            suggested_priority_fee = get_state_value(chain_state, 'max_priority_fee', lambda: w3.eth.max_priority_fee)
         except:
             suggested_priority_fee = None
         
@@ -315,7 +323,7 @@ def get_eip1559_params(w3, priority='standard', is_l2=None):
                 
                 # 获取当前网络实际gas价格
                 try:
-                    current_gas_price = w3.eth.gas_price
+                    current_gas_price = get_state_value(chain_state, 'gas_price', lambda: w3.eth.gas_price)
                     current_gwei = w3.from_wei(current_gas_price, 'gwei')
                     print(f"📊 当前网络gas价格: {current_gwei:.2f} gwei")
                     
@@ -350,7 +358,7 @@ def get_eip1559_params(w3, priority='standard', is_l2=None):
             elif chain_id in [59141, 59144]:  # Linea Sepolia/Mainnet - L1模式动态计算
                 print(f"📊 Linea网络动态优先费用计算...")
                 try:
-                    current_gas_price = w3.eth.gas_price
+                    current_gas_price = get_state_value(chain_state, 'gas_price', lambda: w3.eth.gas_price)
                     current_gwei = w3.from_wei(current_gas_price, 'gwei')
                     print(f"📊 当前网络gas价格: {current_gwei:.2f} gwei")
                     
@@ -416,7 +424,7 @@ def get_eip1559_params(w3, priority='standard', is_l2=None):
                 print(f"📊 Arbitrum 最低优先费用: {w3.from_wei(min_priority_fee, 'gwei')} gwei")
             elif chain_id in [97, 56]:  # BSC Testnet/Mainnet - L2模式动态计算
                 try:
-                    current_gas_price = w3.eth.gas_price
+                    current_gas_price = get_state_value(chain_state, 'gas_price', lambda: w3.eth.gas_price)
                     current_gwei = w3.from_wei(current_gas_price, 'gwei')
                     print(f"📊 BSC L2模式当前网络gas价格: {current_gwei:.2f} gwei")
                     
@@ -458,13 +466,13 @@ def get_eip1559_params(w3, priority='standard', is_l2=None):
         print(f"⚠️ 获取EIP-1559参数失败: {e}")
         return None
 
-def get_network_congestion(w3):
+def get_network_congestion(w3, chain_state=None):
     """检测网络拥堵程度"""
     try:
         # 自动检测并注入POA中间件（如果需要）
         auto_inject_poa_middleware_if_needed(w3)
         
-        latest_block = w3.eth.get_block('latest')
+        latest_block = get_state_value(chain_state, 'latest_block', lambda: w3.eth.get_block('latest'))
         if latest_block.gasLimit > 0:
             utilization = latest_block.gasUsed / latest_block.gasLimit
             
@@ -664,7 +672,7 @@ def get_optimal_gas_limit(w3, chain_id, tx_type='contract_call', estimated_gas=N
     return final_gas_limit
 
 def get_gas_params(w3, account_address, chain_id=None, priority='standard', tx_type='contract_call', 
-                        estimated_gas=None, is_eip1559=True, is_l2=None):
+                        estimated_gas=None, is_eip1559=True, is_l2=None, chain_state=None, with_nonce=True):
     """
     获取优化的gas参数
     
@@ -675,6 +683,8 @@ def get_gas_params(w3, account_address, chain_id=None, priority='standard', tx_t
         priority: 优先级 ('slow', 'standard', 'fast')
         tx_type: 交易类型 ('eth_transfer', 'erc20_transfer', 'erc20_approve', 'contract_call')
         estimated_gas: 预估的gas使用量
+        chain_state: get_chain_state批量预取的nonce/区块/gas价格, 没有时单独请求
+        with_nonce: False时不分配nonce, 由调用方在发送前调用nonce_manager.allocate
     """
     # 如果没有提供chain_id，尝试从w3获取
     if chain_id is None:
@@ -695,35 +705,28 @@ def get_gas_params(w3, account_address, chain_id=None, priority='standard', tx_t
             print(f"⚠️ 无法检测网络类型，使用默认L2")
     
     print(f"⛽ 优化gas参数: Chain {chain_id}, Priority {priority}, Type {tx_type}")
+
+    # gas oracle后台算好的区块/gas价格, 数据新鲜时不再实时请求
+    from gas_oracle_util import get_oracle_chain_state
+    oracle_state = get_oracle_chain_state(chain_id)
+    if oracle_state:
+        chain_state = dict(oracle_state, **{k: v for k, v in (chain_state or {}).items() if v is not None})
     
     # 基础参数
-    safe_nonce, has_pending = get_safe_nonce(w3, account_address)
     gas_params = {
         'from': account_address,
-        'nonce': safe_nonce,
     }
-    
-    # 如果有pending交易，等待其完成而不是尝试替换
-    if has_pending:
-        print(f"⚠️ 检测到pending交易，等待其完成...")
-        if wait_for_pending_transaction(w3, account_address, safe_nonce - 1):
-            print(f"✅ Pending交易已完成，继续发送新交易")
-            # 重新获取nonce，因为pending交易已完成
-            safe_nonce, has_pending = get_safe_nonce(w3, account_address)
-            gas_params['nonce'] = safe_nonce
-            
-            # 等待pending交易完成后，返回特殊标记，让调用方重新检查relay状态
-            return "pending_completed_recheck_needed"
-        else:
-            print(f"⏰ Pending交易等待超时，可能需要手动处理")
-            return None
+    # nonce由nonce_manager本地连续分配, 有pending交易也不用等
+    if with_nonce:
+        from nonce_util import nonce_manager
+        gas_params['nonce'] = nonce_manager.allocate(w3, chain_id, account_address, chain_state=chain_state)
     
     # 设置gas limit - 传递更多上下文信息以便更好地估算
     gas_limit = get_optimal_gas_limit(w3, chain_id, tx_type, estimated_gas, account_address, None, 0, '0x', is_l2=is_l2)
     gas_params['gas'] = gas_limit
     
     # 检测网络拥堵并调整优先级
-    congestion = get_network_congestion(w3)
+    congestion = get_network_congestion(w3, chain_state=chain_state)
     if congestion == 'high' and priority == 'standard':
         priority = 'fast'
         print(f"⚠️ 检测到网络拥堵，自动调整为快速模式")
@@ -731,7 +734,7 @@ def get_gas_params(w3, account_address, chain_id=None, priority='standard', tx_t
     # 检查是否支持EIP-1559
     if is_eip1559:
         print(f"🚀 使用EIP-1559模式")
-        eip1559_params = get_eip1559_params(w3, priority, is_l2)
+        eip1559_params = get_eip1559_params(w3, priority, is_l2, chain_state=chain_state)
         if eip1559_params:
             gas_params.update(eip1559_params)
             
@@ -745,7 +748,7 @@ def get_gas_params(w3, account_address, chain_id=None, priority='standard', tx_t
     
     # 传统gasPrice模式
     print(f"⚡ 使用传统gasPrice模式")
-    gas_price = get_optimal_gas_price(w3, chain_id, priority, is_l2=is_l2)
+    gas_price = get_optimal_gas_price(w3, chain_id, priority, is_l2=is_l2, chain_state=chain_state)
     gas_params['gasPrice'] = gas_price
     
     # 显示gas价格信息
@@ -1,28 +1,30 @@
 import time
 
-from fastapi import FastAPI, BackgroundTasks
+from fastapi import FastAPI
 from typing import Dict, Any
 
-from web3_call import call_fill_relay_by_alchemy
+from queue_util import enqueue_job
+from alchemy_util import split_alchemy_payload
+from registry_util import start_registry_listener
 
 app = FastAPI()
 
-def process_fill_relay(data: Dict[str, Any], deposit_hash: str):
-    """后台处理fillRelay任务"""
-    try:
-        tx_hash = call_fill_relay_by_alchemy(data)
-        print('time: ', time.time(), 'tx_hash: ', tx_hash, 'depositHash: ', deposit_hash)
-    except Exception as e:
-        print('time: ', time.time(), 'error: ', e, 'depositHash: ', deposit_hash)
+@app.on_event("startup")
+def startup():
+    start_registry_listener()
 
 @app.post("/webhook")
-def webhook(data: Dict[str, Any], background_tasks: BackgroundTasks):
-    transaction_dict = data['event']['data']['block']['logs'][0]['transaction']
-    deposit_hash = transaction_dict['hash']
-    print('time: ', time.time(), 'depositHash: ', deposit_hash)
-    
-    # 添加后台任务
-    background_tasks.add_task(process_fill_relay, data, deposit_hash)
+def webhook(data: Dict[str, Any]):
+    # 一次推送可能有多笔deposit, 每笔单独入队, 由cron_fill_worker并发处理
+    deposit_hashes = []
+    job_ids = []
+    for payload in split_alchemy_payload(data):
+        deposit_hash = payload['event']['data']['block']['logs'][0]['transaction']['hash']
+        print('time: ', time.time(), 'depositHash: ', deposit_hash)
+        job_ids.append(enqueue_job(payload, deposit_hash=deposit_hash))
+        deposit_hashes.append(deposit_hash)
     
     # 立即返回响应
-    return {"status": "accepted", "depositHash": deposit_hash}
+    # depositHash/jobId保留第一笔, 兼容只读一个hash的调用方
+    return {"status": "accepted", "depositHash": deposit_hashes[0] if deposit_hashes else None,
+            "jobId": job_ids[0] if job_ids else None, "depositHashes": deposit_hashes, "jobIds": job_ids}